@@ -0,0 +1,98 @@
+import numpy as np
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+
+class AnnotationIndex:
+    """
+    Spatial index over annotation polygons for tile window lookups.
+
+    Wraps a shapely STRtree built once per slide, so finding the annotations
+    that intersect a tile costs a tree query instead of one shapely predicate
+    call per annotation. Results keep the original annotation order.
+
+    Parameters:
+    annotations (list): List of annotation polygons from GeoJSON
+    values (list): Mask value of every annotation for multi-class label
+                   masks (default None, all annotations use the mask value)
+    """
+
+    def __init__(self, annotations, values=None):
+        self.annotations = list(annotations)
+        self.values = None if values is None else np.asarray(values, dtype=np.uint8)
+        self._tree = STRtree(self.annotations) if self.annotations else None
+        self._overlapping = None
+
+    def __len__(self):
+        return len(self.annotations)
+
+    @property
+    def overlapping(self):
+        """
+        Flags of annotations within one pixel of at least one other annotation.
+
+        Rasterized edges are up to a pixel wide, so annotations that nearly
+        touch are flagged as well. Computed on first use with a single bulk
+        tree query.
+
+        Returns:
+        np.array: Boolean array with one flag per annotation
+        """
+        if self._overlapping is None:
+            self._overlapping = np.zeros(len(self.annotations), dtype=bool)
+            if self._tree is not None:
+                first, second = self._tree.query(self.annotations, predicate='dwithin',
+                                                 distance=1.0)
+                others = first != second
+                self._overlapping[first[others]] = True
+        return self._overlapping
+
+    def query_indices(self, x_start, y_start, x_end, y_end):
+        """
+        Return indices of annotations intersecting a window.
+
+        Parameters:
+        x_start (float): Left edge of the window
+        y_start (float): Top edge of the window
+        x_end (float): Right edge of the window
+        y_end (float): Bottom edge of the window
+
+        Returns:
+        list: Sorted indices into the annotation list
+        """
+        if self._tree is None:
+            return []
+        window = box(x_start, y_start, x_end, y_end)
+        hits = self._tree.query(window, predicate='intersects')
+        return sorted(int(i) for i in np.asarray(hits).ravel())
+
+    def query(self, x_start, y_start, x_end, y_end):
+        """
+        Return annotations intersecting a window.
+
+        Parameters:
+        x_start (float): Left edge of the window
+        y_start (float): Top edge of the window
+        x_end (float): Right edge of the window
+        y_end (float): Bottom edge of the window
+
+        Returns:
+        list: Annotation polygons intersecting the window, in original order
+        """
+        return [self.annotations[i]
+                for i in self.query_indices(x_start, y_start, x_end, y_end)]
+
+    def mask_values(self, indices, default_value):
+        """
+        Mask values of the given annotations.
+
+        Parameters:
+        indices (list): Indices into the annotation list
+        default_value (int): Value used when the index has no per-annotation values
+
+        Returns:
+        np.array: Mask value of every given annotation
+        """
+        if self.values is None:
+            return np.full(len(indices), default_value, dtype=np.uint8)
+        return self.values[indices]
@@ -1,111 +1,209 @@
 import numpy as np
-import cv2
-import json
 import os
 import math
 import argparse
-from pathlib import Path
-from shapely.geometry import shape, Point, Polygon
 import tifffile
 import glob
+import shutil
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 
+from annotation_index import AnnotationIndex
+from instrumentation import METRICS_FILENAME, PipelineMetrics, append_metrics, timed
+from geojson_loader import class_mask_values, load_annotations, parse_class_values
+from manifest import SlideManifest, file_fingerprint
+from profiling import PROFILE_REPORT_FILENAME, SlideProfiler, write_profile_report
+from slide_cache import DEFAULT_SLIDE_CACHE_BYTES, SlideCache
+from slide_reader import SlideReader, convert_to_bgr, select_level
+from tile_pipeline import DEFAULT_ENCODE_WORKERS, MASK_MODES, SAMPLING_MODES, run_tile_pipeline
+from output_formats import (MASK_CODECS, MASK_STORAGE_MODES, OUTPUT_FORMATS, TIFF_COMPRESSIONS,
+                            TILE_CODECS, ImageCodec, SparseMaskIndex, create_tile_sink)
 
-def load_geojson(geojson_path):
+
+def load_geojson(geojson_path, downsample=None, cache=True, include_classes=None,
+                 exclude_classes=None, metrics=None):
     """
-    Load GeoJSON file and extract rectangular annotations.
+    Load the annotations of a GeoJSON file as shapely geometries.
+    
+    Polygons and multipolygons are kept with their holes, and annotations can
+    be filtered by their QuPath classification. Geometries are built with
+    vectorized shapely constructors and cached as WKB next to the GeoJSON
+    file, so repeat runs skip parsing.
     
     Parameters:
     geojson_path (str): Path to GeoJSON file
+    downsample (tuple): (x, y) downsample factors of the pyramid level being tiled;
+                        level 0 coordinates are divided by them (default None, no rescaling)
+    cache (bool): Read and write the '.cache.npz' file next to the GeoJSON (default True)
+    include_classes (list): Keep only annotations with these QuPath classifications
+    exclude_classes (list): Drop annotations with these QuPath classifications
+    metrics (PipelineMetrics): Records the 'load_geojson' time if given
     
     Returns:
-    list: List of annotation polygons
+    list: Annotation Polygons and MultiPolygons in the coordinates of the level
+    """
+    with timed(metrics, 'load_geojson'):
+        annotations, _ = load_annotations(geojson_path, downsample=downsample, cache=cache,
+                                          include_classes=include_classes,
+                                          exclude_classes=exclude_classes)
+    return annotations
+
+
+# Prefix lengths used to match slides with GeoJSON files
+PREFIX_LENGTHS = (5, 8)
+
+
+def get_prefix_length(filename):
     """
-    with open(geojson_path, 'r') as f:
-        data = json.load(f)
+    Number of leading filename characters used for matching.
+    - If the name starts with 'DR': 5 characters
+    - If the name starts with 'B': 8 characters
+    - Otherwise: 5 characters (default)
     
-    annotations = []
-    for feature in data['features']:
-        geom = shape(feature['geometry'])
-        annotations.append(geom)
+    Parameters:
+    filename (str): Slide file name
     
-    print(f"Loaded {len(annotations)} annotations from GeoJSON")
-    return annotations
+    Returns:
+    int: Prefix length
+    """
+    if filename.startswith('DR'):
+        return 5
+    elif filename.startswith('B'):
+        return 8
+    return 5  # Default
 
 
-def find_matching_geojson(slide_path, geojson_dir):
+def build_geojson_index(geojson_dir):
+    """
+    Index the GeoJSON files of a directory by filename prefix.
+    
+    The directory is listed once, so matching a batch of slides does not
+    glob it again for every slide.
+    
+    Parameters:
+    geojson_dir (str): Directory containing GeoJSON files
+    
+    Returns:
+    dict: {prefix_length: {prefix: [sorted GeoJSON paths]}} for every prefix length
+    """
+    geojson_index = {prefix_length: {} for prefix_length in PREFIX_LENGTHS}
+    for geojson_file in sorted(glob.glob(os.path.join(geojson_dir, "*.geojson"))):
+        geojson_basename = os.path.basename(geojson_file)
+        for prefix_length, prefixes in geojson_index.items():
+            prefixes.setdefault(geojson_basename[:prefix_length], []).append(geojson_file)
+    return geojson_index
+
+
+def find_geojson_candidates(slide_path, geojson_index):
+    """
+    All GeoJSON files whose prefix matches a slide.
+    
+    Parameters:
+    slide_path (str): Path to slide image
+    geojson_index (dict): Index from build_geojson_index
+    
+    Returns:
+    list: Matching GeoJSON paths in sorted order (empty if none)
+    """
+    slide_basename = os.path.basename(slide_path)
+    prefix_length = get_prefix_length(slide_basename)
+    return geojson_index[prefix_length].get(slide_basename[:prefix_length], [])
+
+
+def find_matching_geojson(slide_path, geojson_dir, geojson_index=None):
     """
     Find matching GeoJSON file based on slide filename prefix.
     - If slide starts with 'DR': match on first 5 characters
     - If slide starts with 'B': match on first 8 characters
     - Otherwise: match on first 5 characters (default)
     
+    If several GeoJSON files share the prefix, the first in sorted order is used.
+    
     Parameters:
     slide_path (str): Path to slide image
     geojson_dir (str): Directory containing GeoJSON files
+    geojson_index (dict): Prebuilt index from build_geojson_index (built here if not provided)
     
     Returns:
     str: Path to matching GeoJSON file or None if not found
     """
-    slide_basename = os.path.basename(slide_path)
+    if geojson_index is None:
+        geojson_index = build_geojson_index(geojson_dir)
     
-    # Determine the number of characters to match based on prefix
-    if slide_basename.startswith('DR'):
-        prefix_length = 5
-    elif slide_basename.startswith('B'):
-        prefix_length = 8
-    else:
-        prefix_length = 5  # Default
+    candidates = find_geojson_candidates(slide_path, geojson_index)
+    if not candidates:
+        return None
     
-    slide_prefix = slide_basename[:prefix_length]
+    slide_basename = os.path.basename(slide_path)
+    prefix_length = get_prefix_length(slide_basename)
+    print(f"Matched slide '{slide_basename}' with GeoJSON '{os.path.basename(candidates[0])}' "
+          f"(prefix: '{slide_basename[:prefix_length]}', length: {prefix_length})")
+    return candidates[0]
+
+
+def report_ambiguous_matches(slide_files, geojson_index):
+    """
+    Print slides whose prefix matches more than one GeoJSON file.
     
-    # Search for GeoJSON files in the directory
-    geojson_files = glob.glob(os.path.join(geojson_dir, "*.geojson"))
+    Parameters:
+    slide_files (list): Paths to slide images
+    geojson_index (dict): Index from build_geojson_index
     
-    for geojson_file in geojson_files:
-        geojson_basename = os.path.basename(geojson_file)
-        geojson_prefix = geojson_basename[:prefix_length]
-        
-        if slide_prefix == geojson_prefix:
-            print(f"Matched slide '{slide_basename}' with GeoJSON '{geojson_basename}' "
-                  f"(prefix: '{slide_prefix}', length: {prefix_length})")
-            return geojson_file
+    Returns:
+    dict: Slide path -> list of matching GeoJSON paths, for ambiguous slides only
+    """
+    ambiguous = {}
+    for slide_path in slide_files:
+        candidates = find_geojson_candidates(slide_path, geojson_index)
+        if len(candidates) > 1:
+            ambiguous[slide_path] = candidates
     
-    return None
+    if ambiguous:
+        print(f"WARNING: {len(ambiguous)} slides match more than one GeoJSON file; "
+              f"the first listed is used:")
+        for slide_path, candidates in ambiguous.items():
+            print(f"  {os.path.basename(slide_path)}: "
+                  + ", ".join(os.path.basename(c) for c in candidates))
+    return ambiguous
 
 
-def load_slide_image(slide_path):
+def load_slide_image(slide_path, metrics=None, cache=None):
     """
     Load slide image using tifffile.
     
     Parameters:
     slide_path (str): Path to slide image
+    metrics (PipelineMetrics): Records the 'load_slide' and 'color' times and the
+                               bytes read if given
+    cache (SlideCache): On-disk cache of decoded slides; if given, the slide is decoded
+                        into it once and copied from its memory map on later loads
     
     Returns:
     np.array: Slide image in BGR format (for consistency with OpenCV)
     """
     print(f"Loading slide image: {slide_path}")
-    slide = tifffile.imread(slide_path)
+    if cache is not None:
+        with timed(metrics, 'load_slide'), SlideReader(slide_path, cache=cache) as reader:
+            if reader.cached is not None:
+                slide = reader.read_region(0, 0, reader.width, reader.height)
+                print(f"Slide dimensions: {reader.width} x {reader.height} (from the slide cache)")
+                return slide
+    
+    with timed(metrics, 'load_slide'):
+        slide = tifffile.imread(slide_path)
     
     if slide is None:
         raise ValueError(f"Could not load slide image from {slide_path}")
+    if metrics is not None:
+        metrics.add_bytes(read=os.path.getsize(slide_path))
     
     print(f"Original slide shape: {slide.shape}, dtype: {slide.dtype}")
     
-    # Handle different image formats
-    if len(slide.shape) == 2:
-        # Grayscale image, convert to BGR
-        slide = cv2.cvtColor(slide, cv2.COLOR_GRAY2BGR)
-        print("Converted grayscale to BGR")
-    elif len(slide.shape) == 3:
-        if slide.shape[2] == 4:
-            # RGBA image, convert to BGR
-            slide = cv2.cvtColor(slide, cv2.COLOR_RGBA2BGR)
-            print("Converted RGBA to BGR")
-        elif slide.shape[2] == 3:
-            # Assume RGB, convert to BGR for consistency with OpenCV
-            slide = cv2.cvtColor(slide, cv2.COLOR_RGB2BGR)
-            print("Converted RGB to BGR")
+    # Handle different image formats (grayscale, RGB, RGBA)
+    with timed(metrics, 'color'):
+        slide = convert_to_bgr(slide)
     
     slide_height, slide_width = slide.shape[:2]
     print(f"Slide dimensions: {slide_width} x {slide_height}")
@@ -129,10 +227,22 @@ def get_bounding_box_from_polygon(polygon):
 
 def create_tiles_and_masks_for_slide(slide_path, annotations, output_dir, tile_size=2000, 
                                       mask_value=255, background_value=0, 
-                                      save_only_annotated=False):
+                                      save_only_annotated=False, annotation_index=None,
+                                      encode_workers=DEFAULT_ENCODE_WORKERS, level=0,
+                                      completed_tiles=None, on_tile_done=None,
+                                      skip_background=False, min_tissue_fraction=0.05,
+                                      output_format='files', shard_size=1000, mask_mode='tile',
+                                      stride=None, sampling='grid', max_negative_patches=100,
+                                      sampling_seed=0, tile_codec='jpeg', mask_codec='png',
+                                      jpeg_quality=None, png_level=None, tiff_compression='lzw',
+                                      mask_storage='image', metrics=None, slide_cache=None):
     """
     Create tile images and corresponding mask tiles for a single slide.
     
+    Tiles are produced by a pipeline: a reader thread decodes tile windows,
+    masks are rasterized as tiles arrive, and a pool of encoder threads
+    writes them through a bounded queue to the chosen output format.
+    
     Parameters:
     slide_path (str): Path to the whole slide image
     annotations (list): List of annotation polygons from GeoJSON
@@ -141,138 +251,450 @@ def create_tiles_and_masks_for_slide(slide_path, annotations, output_dir, tile_s
     mask_value (int): Pixel value for annotated regions in mask (default 255)
     background_value (int): Pixel value for background in mask (default 0)
     save_only_annotated (bool): If True, only save tiles that contain annotations
+    annotation_index (AnnotationIndex): Prebuilt spatial index over annotations
+                                        (built here if not provided)
+    encode_workers (int): Number of encoder/writer threads (0 writes synchronously)
+    level (int): Pyramid level to tile (default 0). Annotations must be in the
+                 coordinates of this level (see load_geojson's downsample)
+    completed_tiles (dict): Tiles finished by an earlier run (tile index -> saved),
+                            which are not read or written again
+    on_tile_done (callable): Called as on_tile_done(tile_index, saved) once a tile
+                             is on disk, e.g. SlideManifest.record_tile
+    skip_background (bool): If True, run a tissue detection pre-pass on a thumbnail and
+                            skip unannotated tiles with too little tissue before decoding
+    min_tissue_fraction (float): Minimum tissue fraction of a kept tile (default 0.05)
+    output_format (str): 'files' (Da{n}.jpg / Da{n}_mask.png, default), 'webdataset'
+                         (tar shards) or 'tiff' (one multi-page TIFF); container formats
+                         write an index.json for random access
+    shard_size (int): Samples per tar shard for the webdataset format (default 1000)
+    mask_mode (str): 'tile' clips annotations per tile (default); 'band' rasterizes
+                     them once per band of tile rows and slices the tile masks
+    stride (int): Distance between tile origins (default tile_size). A smaller stride
+                  writes overlapping tiles; their shared slide segments are decoded once
+    sampling (str): 'grid' tiles the whole slide (default); 'annotation' cuts tile_size
+                    patches centred on (or covering) each annotation's bounding box plus
+                    up to max_negative_patches random patches without annotations, and
+                    decodes only those windows
+    max_negative_patches (int): Cap on negative patches per slide with 'annotation' sampling
+    sampling_seed (int): Seed of the negative patch sampler (default 0)
+    tile_codec (str): Tile encoding for the files and webdataset formats: 'jpeg' (default),
+                      'png', 'webp' (lossless), 'tiff' or 'npy'
+    mask_codec (str): Mask encoding: 'png' (default), 'webp' (lossless), 'tiff' or 'npy'
+    jpeg_quality (int): JPEG quality 0-100 (default None, OpenCV's 95)
+    png_level (int): PNG compression level 0-9 (default None, OpenCV's 1)
+    tiff_compression (str): Compression of 'tiff' tiles and masks: 'lzw' (default),
+                            'deflate', 'zstd' or 'none'
+    mask_storage (str): 'image' writes every mask with mask_codec (default); 'rle' keeps
+                        COCO-style run-length encoded masks in masks_rle.json and stores
+                        nothing for all-background masks (see output_formats.load_tile)
+    metrics (PipelineMetrics): If given, per-stage times and bytes read and written
+                               are recorded into it (see instrumentation.PipelineMetrics)
+    slide_cache (SlideCache): On-disk cache of decoded slide levels; the level is decoded
+                              into it on first use and read from its memory map afterwards
     
     Returns:
-    dict: Statistics about the processed slide
+    dict: Statistics about the processed slide, including the encode throughput
     """
     # Get slide basename for naming
     slide_basename = os.path.splitext(os.path.basename(slide_path))[0]
     
-    # Create output directories for this slide
+    # Patch windows are placed from the annotation bounding boxes
+    annotation_bounds = None
+    if sampling == 'annotation':
+        annotation_bounds = [get_bounding_box_from_polygon(annotation) for annotation in annotations]
+    elif sampling not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode '{sampling}' (choose from {', '.join(SAMPLING_MODES)})")
+    
+    # Create the output sink for this slide
     slide_output_dir = os.path.join(output_dir, slide_basename)
-    tiles_dir = os.path.join(slide_output_dir, 'tiles')
-    masks_dir = os.path.join(slide_output_dir, 'masks')
-    Path(tiles_dir).mkdir(parents=True, exist_ok=True)
-    Path(masks_dir).mkdir(parents=True, exist_ok=True)
+    codec_options = {'jpeg_quality': jpeg_quality, 'png_level': png_level,
+                     'tiff_compression': tiff_compression}
+    tile_encoder = ImageCodec(tile_codec, **codec_options)
+    if mask_storage == 'rle':
+        mask_encoder = SparseMaskIndex(slide_output_dir, background_value=background_value)
+    else:
+        mask_encoder = ImageCodec(mask_codec, **codec_options)
+    sink = create_tile_sink(output_format, slide_output_dir, slide_basename,
+                            encode_workers=encode_workers, shard_size=shard_size,
+                            tile_codec=tile_encoder, mask_codec=mask_encoder,
+                            metrics=metrics)
     
-    # Load the slide image using tifffile
-    slide = load_slide_image(slide_path)
-    slide_height, slide_width = slide.shape[:2]
+    # Spatial index so each tile only tests nearby annotations
+    if annotation_index is None:
+        annotation_index = AnnotationIndex(annotations)
     
-    # Calculate number of tiles needed
-    num_tiles_x = math.ceil(slide_width / tile_size)
-    num_tiles_y = math.ceil(slide_height / tile_size)
-    total_tiles = num_tiles_x * num_tiles_y
-    
-    print(f"Will process {num_tiles_x} x {num_tiles_y} = {total_tiles} tiles")
-    if save_only_annotated:
-        print("Only saving tiles with annotations")
-    
-    tile_index = 0
-    saved_tiles = 0
-    tiles_with_annotations = 0
-    
-    # Generate tiles
-    for row in range(num_tiles_y):
-        for col in range(num_tiles_x):
-            # Calculate tile position
-            x_start = col * tile_size
-            y_start = row * tile_size
-            x_end = min(x_start + tile_size, slide_width)
-            y_end = min(y_start + tile_size, slide_height)
-            
-            # Extract tile from slide
-            tile = slide[y_start:y_end, x_start:x_end]
-            
-            # Create a full-sized tile (pad if necessary for border tiles)
-            tile_full = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
-            actual_height, actual_width = tile.shape[:2]
-            tile_full[:actual_height, :actual_width] = tile
-            
-            # Create mask for this tile
-            mask = np.zeros((tile_size, tile_size), dtype=np.uint8) + background_value
-            
-            # Check which annotations intersect with this tile
-            tile_bbox = Polygon([
-                [x_start, y_start],
-                [x_end, y_start],
-                [x_end, y_end],
-                [x_start, y_end],
-                [x_start, y_start]
-            ])
-            
-            has_annotation = False
-            
-            for annotation in annotations:
-                # Check if annotation intersects with this tile
-                if annotation.intersects(tile_bbox):
-                    has_annotation = True
-                    
-                    # Get the intersection
-                    intersection = annotation.intersection(tile_bbox)
-                    
-                    # Convert to local tile coordinates
-                    if intersection.geom_type == 'Polygon':
-                        polys_to_draw = [intersection]
-                    elif intersection.geom_type == 'MultiPolygon':
-                        polys_to_draw = list(intersection.geoms)
-                    else:
-                        continue
-                    
-                    for poly in polys_to_draw:
-                        # Get coordinates and convert to local tile coordinates
-                        coords = np.array(poly.exterior.coords)
-                        local_coords = coords - [x_start, y_start]
-                        local_coords = local_coords.astype(np.int32)
-                        
-                        # Fill the polygon in the mask
-                        cv2.fillPoly(mask, [local_coords], mask_value)
-            
-            # Decide whether to save this tile
-            should_save = not save_only_annotated or has_annotation
-            
-            if should_save:
-                # Save tile and mask with Da{tile_index} naming
-                tile_filename = f"Da{tile_index}.jpg"
-                mask_filename = f"Da{tile_index}_mask.png"
-                
-                tile_path = os.path.join(tiles_dir, tile_filename)
-                mask_path = os.path.join(masks_dir, mask_filename)
-                
-                cv2.imwrite(tile_path, tile_full)
-                cv2.imwrite(mask_path, mask)
-                
-                saved_tiles += 1
-            
-            if has_annotation:
-                tiles_with_annotations += 1
-            
-            tile_index += 1
-            
-            if tile_index % 100 == 0:
-                print(f"  Processed {tile_index}/{total_tiles} tiles "
-                      f"({tiles_with_annotations} with annotations, {saved_tiles} saved)")
+    # Read, rasterize and write tiles; the slide is decoded window by window
+    print(f"Opening slide image: {slide_path}")
+    counts = run_tile_pipeline(
+        slide_path,
+        annotation_index,
+        sink,
+        tile_size=tile_size,
+        mask_value=mask_value,
+        background_value=background_value,
+        save_only_annotated=save_only_annotated,
+        level=level,
+        completed_tiles=completed_tiles,
+        on_tile_done=on_tile_done,
+        skip_background=skip_background,
+        min_tissue_fraction=min_tissue_fraction,
+        mask_mode=mask_mode,
+        stride=stride,
+        annotation_bounds=annotation_bounds,
+        max_negative_patches=max_negative_patches,
+        sampling_seed=sampling_seed,
+        metrics=metrics,
+        slide_cache=slide_cache
+    )
     
     print(f"Slide processing complete!")
-    print(f"  Processed {tile_index} tiles total")
-    print(f"  {tiles_with_annotations} tiles contain annotations")
-    print(f"  Saved {saved_tiles} tiles")
-    print(f"  Tiles saved to: {tiles_dir}")
-    print(f"  Masks saved to: {masks_dir}")
+    print(f"  Processed {counts['total_tiles']} tiles total")
+    print(f"  {counts['tiles_with_annotations']} tiles contain annotations")
+    print(f"  Saved {counts['saved_tiles']} tiles")
+    if skip_background:
+        print(f"  Skipped {counts['background_tiles_skipped']} background tiles")
+    encoding = sink.encode_stats()
+    if metrics is not None:
+        metrics.add('encode', encoding['encode_seconds'])
+        metrics.add_bytes(written=int(encoding['encoded_mb'] * 1e6))
+    if encoding['encode_mb_per_s'] is not None:
+        print(f"  Encoded {encoding['encoded_mb']} MB at {encoding['encode_mb_per_s']} MB/s "
+              f"of raw pixels per encoder thread")
+    print(f"  Tiles saved to: {sink.tiles_location}")
+    print(f"  Masks saved to: {sink.masks_location}")
     
+    if isinstance(mask_encoder, SparseMaskIndex):
+        print(f"  Stored {len(mask_encoder.masks)} run-length encoded masks, "
+              f"skipped {mask_encoder.empty_masks} empty masks")
+    if output_format == 'tiff':
+        codecs = ('tiff(zlib)', mask_encoder.description if mask_storage == 'rle' else 'tiff(zlib)')
+    else:
+        codecs = (tile_encoder.description, mask_encoder.description)
     return {
         'filename': slide_basename,
-        'total_tiles': tile_index,
-        'tiles_with_annotations': tiles_with_annotations,
-        'saved_tiles': saved_tiles,
-        'tiles_dir': tiles_dir,
-        'masks_dir': masks_dir
+        'total_tiles': counts['total_tiles'],
+        'tiles_with_annotations': counts['tiles_with_annotations'],
+        'saved_tiles': counts['saved_tiles'],
+        'background_tiles_skipped': counts['background_tiles_skipped'],
+        'level': level,
+        'output_format': output_format,
+        'tile_codec': codecs[0],
+        'mask_codec': codecs[1],
+        'encoded_mb': encoding['encoded_mb'],
+        'encode_seconds': encoding['encode_seconds'],
+        'encode_mb_per_s': encoding['encode_mb_per_s'],
+        'tiles_dir': sink.tiles_location,
+        'masks_dir': sink.masks_location
     }
 
 
+# Options that change how a slide is processed but not what is written
+RUNTIME_OPTIONS = ('encode_workers', 'slide_cache')
+
+
+def estimate_slide_memory(slide_path, geojson_path, tile_size=2000, level=None, target_mpp=None):
+    """
+    Estimate the peak memory needed to process one slide.
+    
+    Used to admit slides to the worker pool so that several huge slides are
+    not processed at the same time. The estimate covers the tile buffers, the
+    native TIFF segments decoded per tile window, the whole decoded page for
+    layouts without segment-wise access, and the parsed annotations.
+    
+    Parameters:
+    slide_path (str): Path to slide image
+    geojson_path (str): Path to matching GeoJSON file
+    tile_size (int): Size of output tiles
+    level (int): Pyramid level to tile
+    target_mpp (float): Target resolution used to choose the level
+    
+    Returns:
+    int: Estimated peak memory in bytes (0 if the slide cannot be opened)
+    """
+    try:
+        level = select_level(slide_path, level=level, target_mpp=target_mpp)
+        with SlideReader(slide_path, level) as reader:
+            itemsize = np.dtype(reader.dtype).itemsize
+            if reader.is_native:
+                covered_height = (math.ceil(tile_size / reader.segment_height) + 1) * reader.segment_height
+                covered_width = (math.ceil(tile_size / reader.segment_width) + 1) * reader.segment_width
+                pixels = min(covered_height, reader.height) * min(covered_width, reader.width)
+                slide_bytes = pixels * reader.samples * itemsize
+            else:
+                slide_bytes = reader.width * reader.height * max(reader.samples, 3) * itemsize * 2
+    except Exception:
+        return 0
+    
+    # Tile, padded tile, BGR copy and mask buffers
+    tile_bytes = tile_size * tile_size * 3 * 3 + tile_size * tile_size
+    # Parsed shapely geometries take roughly ten times the GeoJSON text size
+    annotation_bytes = os.path.getsize(geojson_path) * 10
+    return slide_bytes + tile_bytes + annotation_bytes
+
+
+def default_memory_budget():
+    """
+    Default memory budget for the worker pool: 75% of physical memory.
+    
+    Returns:
+    int: Budget in bytes, or None if physical memory cannot be determined
+    """
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.75)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def process_slide(slide_path, geojson_path, output_dir, level=None, target_mpp=None,
+                  resume=True, geojson_cache=True, include_classes=None, exclude_classes=None,
+                  class_values=None, metrics=False, profile=False, **slide_kwargs):
+    """
+    Load annotations for one slide and create its tiles and masks.
+    
+    Errors are caught and reported here so that a failing slide never stops
+    the rest of the batch, whether it runs in the main process or in a worker.
+    
+    Progress is recorded in a manifest in the slide's output directory. With
+    resume, a slide whose slide file, GeoJSON and tile parameters are
+    unchanged since a completed run is skipped, a partially written slide is
+    finished, and a slide whose inputs changed is regenerated from scratch.
+    
+    Parameters:
+    slide_path (str): Path to slide image
+    geojson_path (str): Path to matching GeoJSON file
+    output_dir (str): Output directory for all tiles and masks
+    level (int): Pyramid level to tile (default 0)
+    target_mpp (float): Target resolution in microns per pixel; the closest
+                        pyramid level is tiled (overrides level)
+    resume (bool): If True, skip or finish slides recorded in the manifest
+    geojson_cache (bool): If True, use the binary cache next to the GeoJSON file
+    include_classes (list): Keep only annotations with these classifications
+    exclude_classes (list): Drop annotations with these classifications
+    class_values (dict): Mask value per classification for a multi-class label
+                         mask; unlisted classes use the mask value
+    metrics (bool): If True, record per-stage timings, throughput, bytes read and
+                    written and peak RSS, add them to the statistics and append
+                    them as one JSON line to metrics.jsonl in output_dir
+    profile (bool): If True, profile create_tiles_and_masks_for_slide and write
+                    <slide>.prof (cProfile) and <slide>.collapsed (sampled stacks of
+                    all threads) to the slide's output directory
+    **slide_kwargs: Keyword arguments for create_tiles_and_masks_for_slide
+    
+    Returns:
+    dict: Statistics about the processed slide, or None if it was skipped
+    """
+    slide_basename = os.path.basename(slide_path)
+    manifest = None
+    slide_metrics = PipelineMetrics() if metrics else None
+    try:
+        # Pick the pyramid level and its scale relative to level 0
+        with timed(slide_metrics, 'load_slide'):
+            level = select_level(slide_path, level=level, target_mpp=target_mpp)
+            with SlideReader(slide_path, level) as reader:
+                downsample = reader.downsample
+                if level > 0 or target_mpp is not None:
+                    mpp_text = f", {reader.mpp:.3f} um/px" if reader.mpp else ""
+                    print(f"Using pyramid level {level} (downsample {downsample[0]:.2f}{mpp_text})")
+        
+        # Record progress in a per-slide manifest
+        slide_output_dir = os.path.join(output_dir, os.path.splitext(slide_basename)[0])
+        manifest = SlideManifest(slide_output_dir)
+        completed_tiles = None
+        slide_hash = file_fingerprint(slide_path)
+        geojson_hash = file_fingerprint(geojson_path)
+        params = {key: value for key, value in slide_kwargs.items()
+                  if key not in RUNTIME_OPTIONS}
+        params['level'] = level
+        class_options = {'include_classes': include_classes, 'exclude_classes': exclude_classes,
+                         'class_values': class_values}
+        params.update({key: value for key, value in class_options.items() if value})
+        state = manifest.state(slide_hash, geojson_hash, params) if resume else 'new'
+        
+        if state == 'complete':
+            print(f"Skipping '{slide_basename}': unchanged since last completed run")
+            return manifest.stats
+        output_format = slide_kwargs.get('output_format', 'files')
+        mask_storage = slide_kwargs.get('mask_storage', 'image')
+        if state == 'partial' and (output_format != 'files' or mask_storage != 'image'):
+            # Container formats and the sparse mask index cannot be appended to after a crash
+            if output_format != 'files':
+                reason = f"a partial {output_format} container"
+            else:
+                reason = f"a partial {mask_storage} mask index"
+            print(f"Restarting '{slide_basename}': {reason} cannot be resumed")
+            state = 'restart'
+        if state == 'partial':
+            completed_tiles = dict(manifest.completed_tiles)
+            print(f"Resuming '{slide_basename}': {len(completed_tiles)} tiles recorded")
+        else:
+            if state == 'changed':
+                print(f"Inputs of '{slide_basename}' changed; regenerating all tiles")
+            if state in ('changed', 'restart'):
+                # Drop outputs of the previous run so no stale tiles remain
+                shutil.rmtree(slide_output_dir, ignore_errors=True)
+            manifest.start(slide_hash, geojson_hash, params)
+        
+        # Load annotations in the coordinates of the chosen level
+        with timed(slide_metrics, 'load_geojson'):
+            annotations, classes = load_annotations(geojson_path, downsample=downsample,
+                                                    cache=geojson_cache,
+                                                    include_classes=include_classes,
+                                                    exclude_classes=exclude_classes)
+        
+        if len(annotations) == 0:
+            print(f"WARNING: No annotations found in GeoJSON file. Skipping this slide.")
+            return None
+        
+        # Build the spatial index once for this slide, with a label per class if requested
+        values = None
+        if class_values:
+            values = class_mask_values(classes, class_values, slide_kwargs.get('mask_value', 255))
+        annotation_index = AnnotationIndex(annotations, values=values)
+        
+        # Process the slide
+        profile_prefix = os.path.join(slide_output_dir, os.path.splitext(slide_basename)[0])
+        with SlideProfiler(profile_prefix) if profile else nullcontext():
+            stats = create_tiles_and_masks_for_slide(
+                slide_path,
+                annotations,
+                output_dir,
+                annotation_index=annotation_index,
+                level=level,
+                completed_tiles=completed_tiles,
+                on_tile_done=manifest.record_tile,
+                metrics=slide_metrics,
+                **slide_kwargs
+            )
+        if profile:
+            stats['profile'] = profile_prefix
+        
+        if slide_metrics is not None:
+            record = slide_metrics.summary(tiles=stats['total_tiles'])
+            stats.update(record)
+            append_metrics(os.path.join(output_dir, METRICS_FILENAME),
+                           {'filename': stats['filename'], **record})
+            print(f"  {record['tiles_per_s']} tiles/s, read {record['mb_read']} MB, "
+                  f"wrote {record['mb_written']} MB, peak RSS {record['peak_rss_mb']} MB")
+        
+        manifest.complete(stats)
+        return stats
+        
+    except Exception as e:
+        if manifest is not None:
+            manifest.flush()
+        print(f"ERROR processing slide '{slide_basename}': {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def run_slides_in_pool(jobs, output_dir, slide_kwargs, workers, memory_budget=None):
+    """
+    Process slides in a process pool with memory-based admission.
+    
+    A slide is only submitted while the summed memory estimates of the
+    running slides stay within the budget; a slide larger than the budget
+    runs on its own. Slides are admitted in order.
+    
+    If a worker dies (e.g. killed by the OOM killer) the pool breaks and every
+    slide running in it fails. The pool is then rebuilt and those slides are
+    retried once, each on its own, so only the slide that killed its worker
+    is recorded as failed.
+    
+    Parameters:
+    jobs (list): List of (slide_path, geojson_path, memory_estimate) tuples
+    output_dir (str): Output directory for all tiles and masks
+    slide_kwargs (dict): Keyword arguments for create_tiles_and_masks_for_slide
+    workers (int): Number of worker processes
+    memory_budget (int): Memory budget in bytes (None for no limit)
+    
+    Returns:
+    list: Per-slide statistics (None for skipped or failed slides), in job order
+    """
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    running = {}
+    retried = set()
+    memory_in_use = 0
+    
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while pending or running:
+            broken = []
+            pool_broken = False
+            
+            # Admit slides while there are free workers and memory to spare
+            while pending and len(running) < workers:
+                slide_path, geojson_path, estimate = jobs[pending[0]]
+                if running and (pending[0] in retried or not retried.isdisjoint(running.values())):
+                    # Retried slides run on their own
+                    break
+                if running and memory_budget is not None and memory_in_use + estimate > memory_budget:
+                    break
+                try:
+                    future = pool.submit(process_slide, slide_path, geojson_path, output_dir,
+                                         **slide_kwargs)
+                except BrokenProcessPool:
+                    # A worker died since the last check; the slide never started
+                    pool_broken = True
+                    break
+                job_index = pending.pop(0)
+                print(f"Submitting slide: {os.path.basename(slide_path)} "
+                      f"(estimated memory {estimate / 1e9:.2f} GB)")
+                running[future] = job_index
+                memory_in_use += estimate
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED) if running else (set(), set())
+            for future in done:
+                job_index = running.pop(future)
+                slide_path, _, estimate = jobs[job_index]
+                memory_in_use -= estimate
+                try:
+                    results[job_index] = future.result()
+                except BrokenProcessPool as e:
+                    pool_broken = True
+                    broken.append((job_index, e))
+                except Exception as e:
+                    print(f"ERROR processing slide '{os.path.basename(slide_path)}': {str(e)}")
+                    results[job_index] = None
+            
+            if pool_broken:
+                # The worker itself died (e.g. killed by the OOM killer); the other
+                # slides in the pool fail with it, so rebuild the pool and retry them
+                for job_index in running.values():
+                    broken.append((job_index, BrokenProcessPool('worker pool was rebuilt')))
+                    memory_in_use -= jobs[job_index][2]
+                running = {}
+                pool.shutdown(wait=True, cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=workers)
+                retry = []
+                for job_index, e in sorted(broken):
+                    slide_name = os.path.basename(jobs[job_index][0])
+                    if job_index in retried:
+                        print(f"ERROR processing slide '{slide_name}': worker died ({str(e)})")
+                        results[job_index] = None
+                    else:
+                        print(f"Worker pool broke while processing '{slide_name}'; retrying it")
+                        retried.add(job_index)
+                        retry.append(job_index)
+                pending = retry + pending
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    
+    return results
+
+
 def process_batch(slides_dir, geojson_dir, output_dir, tile_size=2000, 
                   mask_value=255, background_value=0, save_only_annotated=False,
-                  slide_extensions=None):
+                  slide_extensions=None, workers=1, max_memory_gb=None,
+                  encode_workers=DEFAULT_ENCODE_WORKERS, level=None, target_mpp=None,
+                  resume=True, skip_background=False, min_tissue_fraction=0.05,
+                  output_format='files', shard_size=1000, mask_mode='tile', stride=None,
+                  sampling='grid', max_negative_patches=100, sampling_seed=0,
+                  tile_codec='jpeg', mask_codec='png', jpeg_quality=None, png_level=None,
+                  tiff_compression='lzw', mask_storage='image', geojson_cache=True,
+                  include_classes=None, exclude_classes=None, class_values=None, metrics=False,
+                  profile=False, slide_cache_dir=None, slide_cache_bytes=DEFAULT_SLIDE_CACHE_BYTES):
     """
     Process a batch of slides and their matching GeoJSON files.
     
@@ -285,6 +707,44 @@ def process_batch(slides_dir, geojson_dir, output_dir, tile_size=2000,
     background_value (int): Pixel value for background in mask (default 0)
     save_only_annotated (bool): If True, only save tiles that contain annotations
     slide_extensions (list): List of slide file extensions to process
+    workers (int): Number of slides processed in parallel (default 1, sequential)
+    max_memory_gb (float): Memory budget for concurrently running slides in GB
+                           (default 75% of physical memory; only used with workers > 1)
+    encode_workers (int): Number of encoder/writer threads per slide
+    level (int): Pyramid level to tile (default 0, full resolution)
+    target_mpp (float): Target resolution in microns per pixel; the closest
+                        pyramid level of each slide is tiled (overrides level)
+    resume (bool): If True (default), skip slides completed by an earlier run with the
+                   same inputs and finish partially written ones (see process_slide)
+    skip_background (bool): If True, skip unannotated tiles without tissue before decoding
+    min_tissue_fraction (float): Minimum tissue fraction of a kept tile (default 0.05)
+    output_format (str): 'files' (default), 'webdataset' or 'tiff'
+    shard_size (int): Samples per tar shard for the webdataset format (default 1000)
+    mask_mode (str): 'tile' (default) or 'band' mask rasterization
+    stride (int): Distance between tile origins (default tile_size, no overlap)
+    sampling (str): 'grid' (default) tiles whole slides; 'annotation' cuts patches around
+                    annotations plus up to max_negative_patches negative patches per slide
+    max_negative_patches (int): Cap on negative patches per slide (default 100)
+    sampling_seed (int): Seed of the negative patch sampler (default 0)
+    tile_codec (str): Tile encoding: 'jpeg' (default), 'png', 'webp', 'tiff' or 'npy'
+    mask_codec (str): Mask encoding: 'png' (default), 'webp', 'tiff' or 'npy'
+    jpeg_quality (int): JPEG quality 0-100 (default None, OpenCV's default)
+    png_level (int): PNG compression level 0-9 (default None, OpenCV's default)
+    tiff_compression (str): Compression of 'tiff' tiles and masks (default 'lzw')
+    mask_storage (str): 'image' (default) or 'rle' (run-length encoded masks in one
+                        index file per slide, nothing stored for empty masks)
+    geojson_cache (bool): If True (default), cache parsed annotations next to each GeoJSON file
+    include_classes (list): Keep only annotations with these QuPath classifications
+    exclude_classes (list): Drop annotations with these QuPath classifications
+    class_values (dict): Mask value per classification, e.g. {'Vessel': 1, 'Tumor': 2},
+                         to write all classes into one label mask in a single pass
+    metrics (bool): If True, record per-stage timings and throughput of every slide in
+                    output_dir/metrics.jsonl and the summary CSV (see process_slide)
+    profile (bool): If True, profile every slide (see process_slide) and write the
+                    top functions across the batch to output_dir/profile_report.txt
+    slide_cache_dir (str): Directory of an on-disk cache of decoded slide levels shared
+                           by later runs (default None, no cache; see slide_cache.SlideCache)
+    slide_cache_bytes (int): Disk budget of the slide cache (default 64 GiB)
     """
     if slide_extensions is None:
         slide_extensions = ['.tif', '.tiff', '.svs', '.ndpi', '.scn', '.mrxs', '.jpg', '.png']
@@ -305,58 +765,83 @@ def process_batch(slides_dir, geojson_dir, output_dir, tile_size=2000,
     skipped_count = 0
     batch_stats = []
     
+    slide_kwargs = {
+        'tile_size': tile_size,
+        'mask_value': mask_value,
+        'background_value': background_value,
+        'save_only_annotated': save_only_annotated,
+        'encode_workers': encode_workers,
+        'skip_background': skip_background,
+        'min_tissue_fraction': min_tissue_fraction,
+        'output_format': output_format,
+        'shard_size': shard_size,
+        'mask_mode': mask_mode,
+        'stride': stride,
+        'sampling': sampling,
+        'max_negative_patches': max_negative_patches,
+        'sampling_seed': sampling_seed,
+        'tile_codec': tile_codec,
+        'mask_codec': mask_codec,
+        'jpeg_quality': jpeg_quality,
+        'png_level': png_level,
+        'tiff_compression': tiff_compression,
+        'mask_storage': mask_storage,
+        'level': level,
+        'target_mpp': target_mpp,
+        'resume': resume,
+        'geojson_cache': geojson_cache,
+        'include_classes': include_classes,
+        'exclude_classes': exclude_classes,
+        'class_values': class_values,
+        'metrics': metrics,
+        'profile': profile,
+        'slide_cache': SlideCache(slide_cache_dir, slide_cache_bytes) if slide_cache_dir else None,
+    }
+    
+    # Match slides with GeoJSON files up front from a single directory listing
+    geojson_index = build_geojson_index(geojson_dir)
+    report_ambiguous_matches(slide_files, geojson_index)
+    jobs = []
     for idx, slide_path in enumerate(slide_files, 1):
         slide_basename = os.path.basename(slide_path)
-        print(f"\n[{idx}/{len(slide_files)}] Processing slide: {slide_basename}")
-        print("-" * 80)
         
         # Find matching GeoJSON file
-        geojson_path = find_matching_geojson(slide_path, geojson_dir)
+        geojson_path = find_matching_geojson(slide_path, geojson_dir, geojson_index)
         
         if geojson_path is None:
-            # Determine prefix length for error message
-            if slide_basename.startswith('DR'):
-                prefix_length = 5
-            elif slide_basename.startswith('B'):
-                prefix_length = 8
-            else:
-                prefix_length = 5
-            
+            prefix_length = get_prefix_length(slide_basename)
             print(f"WARNING: No matching GeoJSON found for '{slide_basename}' "
                   f"(prefix: '{slide_basename[:prefix_length]}', length: {prefix_length})")
             print(f"Skipping this slide.")
             skipped_count += 1
             continue
         
-        try:
-            # Load annotations
-            annotations = load_geojson(geojson_path)
-            
-            if len(annotations) == 0:
-                print(f"WARNING: No annotations found in GeoJSON file. Skipping this slide.")
-                skipped_count += 1
-                continue
-            
-            # Process the slide
-            stats = create_tiles_and_masks_for_slide(
-                slide_path,
-                annotations,
-                output_dir,
-                tile_size=tile_size,
-                mask_value=mask_value,
-                background_value=background_value,
-                save_only_annotated=save_only_annotated
-            )
-            
+        jobs.append((slide_path, geojson_path))
+    
+    if workers > 1 and len(jobs) > 1:
+        memory_budget = default_memory_budget() if max_memory_gb is None else int(max_memory_gb * 1e9)
+        print(f"\nProcessing {len(jobs)} slides with {workers} workers"
+              + (f" (memory budget {memory_budget / 1e9:.1f} GB)" if memory_budget else ""))
+        print("-" * 80)
+        pool_jobs = [
+            (slide_path, geojson_path,
+             estimate_slide_memory(slide_path, geojson_path, tile_size, level=level, target_mpp=target_mpp))
+            for slide_path, geojson_path in jobs
+        ]
+        results = run_slides_in_pool(pool_jobs, output_dir, slide_kwargs, workers, memory_budget)
+    else:
+        results = []
+        for idx, (slide_path, geojson_path) in enumerate(jobs, 1):
+            print(f"\n[{idx}/{len(jobs)}] Processing slide: {os.path.basename(slide_path)}")
+            print("-" * 80)
+            results.append(process_slide(slide_path, geojson_path, output_dir, **slide_kwargs))
+    
+    for stats in results:
+        if stats is None:
+            skipped_count += 1
+        else:
             batch_stats.append(stats)
             processed_count += 1
-            
-        except Exception as e:
-            print(f"ERROR processing slide '{slide_basename}': {str(e)}")
-            import traceback
-            traceback.print_exc()
-            skipped_count += 1
-            continue
     
     # Print summary
     print("\n" + "=" * 80)
@@ -399,6 +884,14 @@ def process_batch(slides_dir, geojson_dir, output_dir, tile_size=2000,
         print()
         print("CSV Preview:")
         print(df[['filename', 'total_tiles', 'tiles_with_annotations', 'saved_tiles']].to_string(index=False))
+        
+        if profile:
+            report_path = os.path.join(output_dir, PROFILE_REPORT_FILENAME)
+            report = write_profile_report([stats['profile'] for stats in batch_stats
+                                           if stats.get('profile')], report_path)
+            print()
+            print(report)
+            print(f"Profile report saved to: {report_path}")
     
     print("=" * 80)
     print(f"Output saved to: {output_dir}")
@@ -424,13 +917,116 @@ if __name__ == "__main__":
     parser.add_argument('--only_annotated', action='store_true',
                        help='Only save tiles that contain annotations')
     parser.add_argument('--extensions', type=str, default='.tif,.tiff,.svs,.ndpi,.scn,.mrxs,.jpg,.png',
-                       help='Comma-separated list of slide file extensions (default: .tif,.tiff,.svs,.ndpi,.scn,.mrxs,.jpg,.png)')
+                       help='Comma-separated list of slide file extensions '
+                            '(default: .tif,.tiff,.svs,.ndpi,.scn,.mrxs,.jpg,.png)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of slides to process in parallel (default 1)')
+    parser.add_argument('--max_memory_gb', type=float, default=None,
+                       help='Memory budget in GB for slides running in parallel (default 75%% of '
+                            'physical memory)')
+    parser.add_argument('--encode_workers', type=int, default=DEFAULT_ENCODE_WORKERS,
+                       help=f'Encoder/writer threads per slide (default {DEFAULT_ENCODE_WORKERS}, '
+                            '0 for synchronous writes)')
+    parser.add_argument('--level', type=int, default=None,
+                       help='Pyramid level to tile (default 0, full resolution)')
+    parser.add_argument('--target_mpp', type=float, default=None,
+                       help='Target resolution in microns per pixel; tiles the closest pyramid '
+                            'level (overrides --level)')
+    parser.add_argument('--overwrite', action='store_true',
+                       help='Regenerate all slides instead of resuming from the per-slide manifests')
+    parser.add_argument('--skip_background', action='store_true',
+                       help='Detect tissue on a thumbnail and skip unannotated background tiles '
+                            'before decoding')
+    parser.add_argument('--min_tissue_fraction', type=float, default=0.05,
+                       help='Minimum tissue fraction of a tile kept with --skip_background (default 0.05)')
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, default='files',
+                       help='Output backend: files (one JPG/PNG per tile, default), webdataset '
+                            '(tar shards) or tiff (one multi-page TIFF per slide)')
+    parser.add_argument('--shard_size', type=int, default=1000,
+                       help='Samples per tar shard with --output_format webdataset (default 1000)')
+    parser.add_argument('--mask_mode', choices=MASK_MODES, default='tile',
+                       help='Mask rasterization: tile (clip annotations per tile, default) or band '
+                            '(rasterize once per band of tile rows and slice tile masks)')
+    parser.add_argument('--sampling', choices=SAMPLING_MODES, default='grid',
+                       help='grid (tile whole slides, default) or annotation (patches centred on '
+                            'annotations plus capped random negatives; only those windows are decoded)')
+    parser.add_argument('--max_negative_patches', type=int, default=100,
+                       help='Maximum number of patches without annotations per slide with '
+                            '--sampling annotation (default 100)')
+    parser.add_argument('--sampling_seed', type=int, default=0,
+                       help='Seed for negative patch sampling (default 0)')
+    parser.add_argument('--tile_codec', choices=TILE_CODECS, default='jpeg',
+                       help='Tile encoding for the files and webdataset formats (default jpeg; '
+                            'webp is lossless)')
+    parser.add_argument('--mask_codec', choices=MASK_CODECS, default='png',
+                       help='Mask encoding for the files and webdataset formats (default png; all lossless)')
+    parser.add_argument('--jpeg_quality', type=int, default=None,
+                       help='JPEG quality 0-100 (default OpenCV\'s 95)')
+    parser.add_argument('--png_level', type=int, default=None,
+                       help='PNG compression level 0-9; lower is faster (default OpenCV\'s 1)')
+    parser.add_argument('--tiff_compression', choices=tuple(TIFF_COMPRESSIONS), default='lzw',
+                       help='Compression of tiff tiles and masks (default lzw; zstd needs libtiff support)')
+    parser.add_argument('--mask_storage', choices=MASK_STORAGE_MODES, default='image',
+                       help='image (one mask image per tile, default) or rle (run-length encoded masks '
+                            'in masks_rle.json per slide, nothing stored for empty masks)')
+    overlap_group = parser.add_mutually_exclusive_group()
+    overlap_group.add_argument('--stride', type=int, default=None,
+                               help='Distance between tile origins in pixels (default --tile_size, '
+                                    'no overlap)')
+    overlap_group.add_argument('--overlap', type=int, default=None,
+                               help='Overlap between neighbouring tiles in pixels (stride = '
+                                    'tile_size - overlap)')
+    parser.add_argument('--no_geojson_cache', action='store_true',
+                       help='Do not read or write the parsed-annotation cache next to each GeoJSON file')
+    parser.add_argument('--include_classes', type=str, default=None,
+                       help='Comma-separated QuPath classifications to keep (default all)')
+    parser.add_argument('--exclude_classes', type=str, default=None,
+                       help='Comma-separated QuPath classifications to drop')
+    parser.add_argument('--class_values', type=str, default=None,
+                       help='Multi-class label mask values, e.g. "Vessel=1,Tumor=2,Necrosis=3"; '
+                            'unlisted classes use --mask_value')
+    parser.add_argument('--profile', action='store_true',
+                       help='Profile every slide: write <slide>.prof and <slide>.collapsed (flame graph '
+                            'stacks) to its output directory and profile_report.txt to the output directory')
+    parser.add_argument('--metrics', action='store_true',
+                       help='Record per-stage timings, tiles/s, bytes read/written and peak RSS per slide '
+                            'in metrics.jsonl and the summary CSV')
+    parser.add_argument('--slide_cache_dir', type=str, default=None,
+                       help='Cache decoded slides in this directory, so later runs on the same slides '
+                            'read tiles from a memory map instead of decoding the slide again')
+    parser.add_argument('--slide_cache_gb', type=float, default=DEFAULT_SLIDE_CACHE_BYTES / 1024 ** 3,
+                       help='Disk budget of the slide cache in GB; least recently used slides are evicted '
+                            f'(default {DEFAULT_SLIDE_CACHE_BYTES // 1024 ** 3})')
     
     args = parser.parse_args()
     
     # Parse extensions
     slide_extensions = [ext.strip() for ext in args.extensions.split(',')]
     
+    # Tile stride from --stride or --overlap
+    stride = args.stride
+    if args.overlap is not None:
+        stride = args.tile_size - args.overlap
+    if stride is not None and stride <= 0:
+        parser.error('--stride must be positive and --overlap smaller than --tile_size')
+    if args.sampling == 'annotation' and (args.mask_mode == 'band' or stride is not None):
+        parser.error('--sampling annotation cannot be combined with --mask_mode band, --stride or --overlap')
+    
+    # Check the codecs before any slide is read
+    try:
+        for codec in (args.tile_codec, args.mask_codec):
+            ImageCodec(codec, tiff_compression=args.tiff_compression)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    # Parse class filters and label values
+    include_classes = [c.strip() for c in args.include_classes.split(',')] if args.include_classes else None
+    exclude_classes = [c.strip() for c in args.exclude_classes.split(',')] if args.exclude_classes else None
+    try:
+        class_values = parse_class_values(args.class_values) if args.class_values else None
+    except ValueError as e:
+        parser.error(str(e))
+    
     # Process the batch
     process_batch(
         args.slides_dir,
@@ -440,5 +1036,34 @@ if __name__ == "__main__":
         mask_value=args.mask_value,
         background_value=args.background_value,
         save_only_annotated=args.only_annotated,
-        slide_extensions=slide_extensions
+        slide_extensions=slide_extensions,
+        workers=args.workers,
+        max_memory_gb=args.max_memory_gb,
+        encode_workers=args.encode_workers,
+        level=args.level,
+        target_mpp=args.target_mpp,
+        resume=not args.overwrite,
+        skip_background=args.skip_background,
+        min_tissue_fraction=args.min_tissue_fraction,
+        output_format=args.output_format,
+        shard_size=args.shard_size,
+        mask_mode=args.mask_mode,
+        stride=stride,
+        sampling=args.sampling,
+        max_negative_patches=args.max_negative_patches,
+        sampling_seed=args.sampling_seed,
+        tile_codec=args.tile_codec,
+        mask_codec=args.mask_codec,
+        jpeg_quality=args.jpeg_quality,
+        png_level=args.png_level,
+        tiff_compression=args.tiff_compression,
+        mask_storage=args.mask_storage,
+        geojson_cache=not args.no_geojson_cache,
+        include_classes=include_classes,
+        exclude_classes=exclude_classes,
+        class_values=class_values,
+        metrics=args.metrics,
+        profile=args.profile,
+        slide_cache_dir=args.slide_cache_dir,
+        slide_cache_bytes=int(args.slide_cache_gb * 1024 ** 3)
     )
@@ -0,0 +1,112 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+from shapely.geometry import Polygon
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from annotation_index import AnnotationIndex
+
+
+'''
+Compare the per-tile annotation lookup of the old linear scan with AnnotationIndex.
+
+python benchmarks/bench_annotation_index.py --counts 500,2000,10000,20000
+'''
+
+
+def make_annotations(count, slide_width, slide_height, seed=0):
+    """
+    Generate random vessel-like polygons scattered over a slide.
+
+    Parameters:
+    count (int): Number of polygons
+    slide_width (int): Slide width in pixels
+    slide_height (int): Slide height in pixels
+    seed (int): Random seed
+
+    Returns:
+    list: List of shapely polygons
+    """
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+    annotations = []
+    for _ in range(count):
+        cx = rng.uniform(0, slide_width)
+        cy = rng.uniform(0, slide_height)
+        radius = rng.uniform(10, 300)
+        ring = np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)])
+        annotations.append(Polygon(ring))
+    return annotations
+
+
+def tile_windows(slide_width, slide_height, tile_size):
+    """Yield (x_start, y_start, x_end, y_end) for every tile of the slide."""
+    for row in range(math.ceil(slide_height / tile_size)):
+        for col in range(math.ceil(slide_width / tile_size)):
+            x_start = col * tile_size
+            y_start = row * tile_size
+            yield (x_start, y_start,
+                   min(x_start + tile_size, slide_width),
+                   min(y_start + tile_size, slide_height))
+
+
+def time_linear_scan(annotations, windows):
+    start = time.perf_counter()
+    hits = 0
+    for x_start, y_start, x_end, y_end in windows:
+        tile_bbox = Polygon([[x_start, y_start], [x_end, y_start],
+                             [x_end, y_end], [x_start, y_end]])
+        for annotation in annotations:
+            if annotation.intersects(tile_bbox):
+                hits += 1
+    return time.perf_counter() - start, hits
+
+
+def time_index(annotations, windows):
+    start = time.perf_counter()
+    index = AnnotationIndex(annotations)
+    build_time = time.perf_counter() - start
+    hits = 0
+    for window in windows:
+        hits += len(index.query_indices(*window))
+    return time.perf_counter() - start, build_time, hits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark annotation-to-tile lookup: linear scan vs STRtree index'
+    )
+    parser.add_argument('--counts', type=str, default='500,2000,5000,20000',
+                        help='Comma-separated annotation counts to benchmark')
+    parser.add_argument('--slide_width', type=int, default=100000,
+                        help='Synthetic slide width in pixels (default 100000)')
+    parser.add_argument('--slide_height', type=int, default=80000,
+                        help='Synthetic slide height in pixels (default 80000)')
+    parser.add_argument('--tile_size', type=int, default=2000,
+                        help='Tile size in pixels (default 2000)')
+    parser.add_argument('--max_linear_calls', type=float, default=2e7,
+                        help='Skip the linear scan above this many predicate calls')
+    args = parser.parse_args()
+
+    windows = list(tile_windows(args.slide_width, args.slide_height, args.tile_size))
+    print(f"Slide {args.slide_width} x {args.slide_height}, tile size {args.tile_size}: "
+          f"{len(windows)} tiles")
+    print(f"{'annotations':>12} {'linear (s)':>12} {'index (s)':>12} "
+          f"{'build (s)':>10} {'speedup':>9}")
+
+    for count in [int(c) for c in args.counts.split(',')]:
+        annotations = make_annotations(count, args.slide_width, args.slide_height)
+        index_time, build_time, index_hits = time_index(annotations, windows)
+
+        if count * len(windows) <= args.max_linear_calls:
+            linear_time, linear_hits = time_linear_scan(annotations, windows)
+            assert linear_hits == index_hits, (linear_hits, index_hits)
+            print(f"{count:>12} {linear_time:>12.3f} {index_time:>12.3f} "
+                  f"{build_time:>10.3f} {linear_time / index_time:>8.1f}x")
+        else:
+            print(f"{count:>12} {'skipped':>12} {index_time:>12.3f} {build_time:>10.3f} {'-':>9}")
@@ -0,0 +1,446 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import cv2
+import shapely
+import tifffile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from batch_geojson_to_tiles_and_masks import (create_tiles_and_masks_for_slide, load_geojson,
+                                              process_batch)
+from instrumentation import PipelineMetrics
+from tile_pipeline import DEFAULT_ENCODE_WORKERS
+
+
+'''
+End-to-end benchmarks on synthetic pyramidal slides and GeoJSON annotations.
+
+Times load_geojson, create_tiles_and_masks_for_slide and process_batch across
+tile sizes, annotation counts and worker counts, and writes a JSON report.
+Pass the report of an earlier commit with --compare to print the change.
+Runs offline; generated inputs are kept in --work_dir and reused.
+
+python benchmarks/bench_pipeline.py --output before.json
+python benchmarks/bench_pipeline.py --output after.json --compare before.json
+'''
+
+
+# Width of the cells of the tissue map that synthetic slides are drawn from
+TISSUE_CELL = 32
+
+CLASSES = ('Tumor', 'Vessel', 'Stroma')
+
+
+def make_tissue_map(width, height, seed=0, blobs=12):
+    """
+    Low-resolution tissue probability map: a few smooth blobs on glass.
+
+    Parameters:
+    width (int): Slide width in pixels
+    height (int): Slide height in pixels
+    seed (int): Random seed
+    blobs (int): Number of tissue blobs
+
+    Returns:
+    np.array: float32 map in [0, 1], one value per TISSUE_CELL x TISSUE_CELL pixels
+    """
+    rng = np.random.default_rng(seed)
+    map_height = -(-height // TISSUE_CELL) + 1
+    map_width = -(-width // TISSUE_CELL) + 1
+    ys, xs = np.mgrid[0:map_height, 0:map_width].astype(np.float32)
+    tissue = np.zeros((map_height, map_width), dtype=np.float32)
+    for _ in range(blobs):
+        cx, cy = rng.uniform(0, map_width), rng.uniform(0, map_height)
+        radius = rng.uniform(0.05, 0.25) * min(map_width, map_height)
+        tissue += np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (2 * radius ** 2))
+    return np.clip(tissue, 0, 1)
+
+
+def slide_tiles(tissue_map, width, height, downsample, tile, seed=0):
+    """
+    Generate the RGB tiles of one pyramid level in TIFF tile order.
+
+    Parameters:
+    tissue_map (np.array): Map from make_tissue_map
+    width (int): Level width in pixels
+    height (int): Level height in pixels
+    downsample (int): Downsample factor of the level
+    tile (int): TIFF tile size
+    seed (int): Random seed of the texture
+
+    Yields:
+    np.array: (tile, tile, 3) uint8 tile
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(-12, 13, (tile, tile, 3), dtype=np.int16)
+    glass = np.array([240, 238, 242], dtype=np.float32)
+    stain = np.array([190, 110, 165], dtype=np.float32)
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            rows = ((y + np.arange(tile)) * downsample) // TISSUE_CELL
+            cols = ((x + np.arange(tile)) * downsample) // TISSUE_CELL
+            rows = np.minimum(rows, tissue_map.shape[0] - 1)
+            cols = np.minimum(cols, tissue_map.shape[1] - 1)
+            weight = tissue_map[rows[:, None], cols[None, :], None]
+            pixels = glass + weight * (stain - glass)
+            shift = (x // tile + y // tile) % tile
+            pixels = pixels + np.roll(noise, shift, axis=0) * weight
+            yield np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def make_pyramidal_tiff(path, width, height, tile=256, min_level_size=512,
+                        compression='zlib', mpp=0.25, seed=0):
+    """
+    Write a synthetic pyramidal TIFF (level 0 plus 4x downsampled SubIFDs).
+
+    Parameters:
+    path (str): Output path
+    width (int): Level 0 width in pixels
+    height (int): Level 0 height in pixels
+    tile (int): TIFF tile size (default 256)
+    min_level_size (int): Stop adding levels once a side is below this size
+    compression (str): TIFF compression, 'zlib' (default) or 'none'
+    mpp (float): Level 0 resolution in microns per pixel
+    seed (int): Random seed
+
+    Returns:
+    int: Number of pyramid levels
+    """
+    tissue_map = make_tissue_map(width, height, seed=seed)
+    downsamples = [1]
+    while min(width, height) // (downsamples[-1] * 4) >= min_level_size:
+        downsamples.append(downsamples[-1] * 4)
+    # Resolution in pixels per centimetre
+    resolution = (1e4 / mpp, 1e4 / mpp)
+    options = {'tile': (tile, tile), 'photometric': 'rgb', 'dtype': np.uint8,
+               'compression': None if compression == 'none' else compression,
+               'resolutionunit': 'CENTIMETER', 'metadata': None}
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for level, downsample in enumerate(downsamples):
+            level_width, level_height = width // downsample, height // downsample
+            tif.write(slide_tiles(tissue_map, level_width, level_height, downsample, tile, seed),
+                      shape=(level_height, level_width, 3),
+                      subifds=len(downsamples) - 1 if level == 0 else None,
+                      subfiletype=1 if level > 0 else 0,
+                      resolution=(resolution[0] / downsample, resolution[1] / downsample),
+                      **options)
+    return len(downsamples)
+
+
+def make_geojson(path, count, width, height, vertices=16, min_radius=20, max_radius=400, seed=0):
+    """
+    Write a QuPath-style GeoJSON of random star-shaped polygons.
+
+    Parameters:
+    path (str): Output path
+    count (int): Number of polygons
+    width (int): Slide width in pixels
+    height (int): Slide height in pixels
+    vertices (int): Vertices per polygon, i.e. the polygon complexity
+    min_radius (float): Smallest polygon radius in pixels
+    max_radius (float): Largest polygon radius in pixels
+    seed (int): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    features = []
+    for i in range(count):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        # Radial jitter keeps the ring simple while giving irregular outlines
+        radii = rng.uniform(min_radius, max_radius) * rng.uniform(0.6, 1.0, vertices)
+        ring = np.column_stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)])
+        ring = np.round(ring, 1).tolist()
+        ring.append(ring[0])
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+            'properties': {'objectType': 'annotation',
+                           'classification': {'name': CLASSES[i % len(CLASSES)]}},
+        })
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+def prepare_inputs(work_dir, slides, width, height, counts, vertices, compression):
+    """
+    Generate (or reuse) the synthetic slides and one GeoJSON set per annotation count.
+
+    Slides are named SYN01.tif, SYN02.tif, ... and GeoJSON files SYN01_<count>.geojson,
+    so the batch CLI matches them by their 5-character prefix.
+
+    Returns:
+    tuple: (slides directory, {count: GeoJSON directory})
+    """
+    slides_dir = os.path.join(work_dir, f"slides_{width}x{height}_{compression}")
+    os.makedirs(slides_dir, exist_ok=True)
+    for i in range(1, slides + 1):
+        path = os.path.join(slides_dir, f"SYN{i:02d}.tif")
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            levels = make_pyramidal_tiff(path + '.tmp', width, height,
+                                         compression=compression, seed=i)
+            os.replace(path + '.tmp', path)
+            print(f"Generated {path} ({levels} levels, {os.path.getsize(path) / 1e6:.1f} MB) "
+                  f"in {time.perf_counter() - start:.1f}s")
+
+    geojson_dirs = {}
+    for count in counts:
+        geojson_dir = os.path.join(work_dir, f"geojson_{width}x{height}_{count}x{vertices}")
+        os.makedirs(geojson_dir, exist_ok=True)
+        for i in range(1, slides + 1):
+            path = os.path.join(geojson_dir, f"SYN{i:02d}_{count}.geojson")
+            if not os.path.exists(path):
+                make_geojson(path, count, width, height, vertices=vertices, seed=i)
+        geojson_dirs[count] = geojson_dir
+    return slides_dir, geojson_dirs
+
+
+@contextmanager
+def quiet(enabled=True):
+    """Silence stdout, including that of worker processes, inside the block."""
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def best_of(repeats, run, setup=None):
+    """
+    Run `run` `repeats` times and keep the fastest.
+
+    Parameters:
+    repeats (int): Number of runs
+    run (callable): Timed function; its last return value is kept
+    setup (callable): Untimed preparation before every run
+
+    Returns:
+    tuple: (fastest seconds, return value of the fastest run)
+    """
+    best = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result)
+    return best
+
+
+def environment():
+    """Machine and library versions recorded with every report."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'shapely': shapely.__version__,
+        'tifffile': tifffile.__version__,
+    }
+
+
+def bench_load_geojson(geojson_dirs, repeats):
+    """Time parsing each GeoJSON set from scratch and from the WKB cache."""
+    results = []
+    for count, geojson_dir in geojson_dirs.items():
+        path = os.path.join(geojson_dir, sorted(os.listdir(geojson_dir))[0])
+        cache_path = path + '.cache.npz'
+
+        def drop_cache():
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+
+        with quiet():
+            parse_seconds, _ = best_of(repeats, lambda: load_geojson(path, cache=False))
+            load_geojson(path, cache=True)
+            cached_seconds, _ = best_of(repeats, lambda: load_geojson(path, cache=True))
+            drop_cache()
+        for mode, seconds in (('parse', parse_seconds), ('cached', cached_seconds)):
+            results.append({'benchmark': 'load_geojson',
+                            'params': {'annotations': count, 'mode': mode},
+                            'seconds': round(seconds, 4),
+                            'annotations_per_s': round(count / seconds, 1)})
+            print(f"load_geojson       annotations={count:<7} {mode:<8} {seconds:8.3f}s")
+    return results
+
+
+def bench_slide(slides_dir, geojson_dirs, tile_sizes, output_dir, repeats, encode_workers):
+    """Time create_tiles_and_masks_for_slide per tile size and annotation count."""
+    results = []
+    slide_path = os.path.join(slides_dir, 'SYN01.tif')
+    for count, geojson_dir in geojson_dirs.items():
+        with quiet():
+            annotations = load_geojson(os.path.join(geojson_dir, f"SYN01_{count}.geojson"))
+        for tile_size in tile_sizes:
+            runs = []
+
+            def run():
+                metrics = PipelineMetrics()
+                stats = create_tiles_and_masks_for_slide(
+                    slide_path, annotations, output_dir, tile_size=tile_size,
+                    encode_workers=encode_workers, metrics=metrics)
+                runs.append(metrics.summary(tiles=stats['total_tiles']))
+                return stats
+
+            with quiet():
+                seconds, stats = best_of(repeats, run,
+                                         setup=lambda: shutil.rmtree(output_dir, ignore_errors=True))
+            stages = {key: value for key, value in min(runs, key=lambda r: r['wall_s']).items()
+                      if key.startswith('time_')}
+            results.append({'benchmark': 'create_tiles_and_masks_for_slide',
+                            'params': {'annotations': count, 'tile_size': tile_size},
+                            'seconds': round(seconds, 4),
+                            'tiles': stats['total_tiles'],
+                            'tiles_per_s': round(stats['total_tiles'] / seconds, 2),
+                            'stages': stages})
+            print(f"create_tiles       annotations={count:<7} tile_size={tile_size:<6} "
+                  f"{seconds:8.3f}s  {stats['total_tiles'] / seconds:8.1f} tiles/s")
+    return results
+
+
+def bench_batch(slides_dir, geojson_dir, count, tile_size, worker_counts, output_dir,
+                repeats, encode_workers):
+    """Time process_batch over all synthetic slides per worker count."""
+    results = []
+    for workers in worker_counts:
+        with quiet():
+            seconds, _ = best_of(
+                repeats,
+                lambda: process_batch(slides_dir, geojson_dir, output_dir, tile_size=tile_size,
+                                      workers=workers, encode_workers=encode_workers,
+                                      resume=False, geojson_cache=False),
+                setup=lambda: shutil.rmtree(output_dir, ignore_errors=True))
+        slides = len([name for name in os.listdir(slides_dir) if name.endswith('.tif')])
+        results.append({'benchmark': 'process_batch',
+                        'params': {'annotations': count, 'tile_size': tile_size,
+                                   'workers': workers, 'slides': slides},
+                        'seconds': round(seconds, 4),
+                        'slides_per_min': round(slides * 60 / seconds, 2)})
+        print(f"process_batch      workers={workers:<3} slides={slides:<3} {seconds:8.3f}s")
+    return results
+
+
+def result_key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare_reports(previous, current):
+    """Print the change in time of every benchmark present in both reports."""
+    before = {result_key(r): r for r in previous['results']}
+    print(f"\nCompared with {previous['environment'].get('commit') or 'previous report'} "
+          f"(>1x is faster now):")
+    for result in current['results']:
+        old = before.get(result_key(result))
+        if old is None:
+            continue
+        params = ', '.join(f"{k}={v}" for k, v in result['params'].items())
+        print(f"  {result['benchmark']:<34} {params:<55} {old['seconds']:8.3f}s -> "
+              f"{result['seconds']:8.3f}s  {old['seconds'] / result['seconds']:5.2f}x")
+
+
+def parse_ints(text):
+    return [int(value) for value in text.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the tiling pipeline on synthetic pyramidal slides and GeoJSON'
+    )
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Directory for generated inputs and outputs, reused between runs '
+                             '(default: a temporary directory)')
+    parser.add_argument('--output', type=str, default='pipeline_report.json',
+                        help='Path of the JSON report (default pipeline_report.json)')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Report of an earlier run to compare against')
+    parser.add_argument('--width', type=int, default=8192,
+                        help='Synthetic slide width in pixels (default 8192)')
+    parser.add_argument('--height', type=int, default=6144,
+                        help='Synthetic slide height in pixels (default 6144)')
+    parser.add_argument('--slides', type=int, default=2,
+                        help='Number of synthetic slides for process_batch (default 2)')
+    parser.add_argument('--compression', choices=('zlib', 'none'), default='zlib',
+                        help='TIFF compression of the synthetic slides (default zlib)')
+    parser.add_argument('--annotations', type=str, default='100,1000,5000',
+                        help='Comma-separated annotation counts per slide (default 100,1000,5000)')
+    parser.add_argument('--vertices', type=int, default=16,
+                        help='Vertices per synthetic polygon (default 16)')
+    parser.add_argument('--tile_sizes', type=str, default='512,1024,2000',
+                        help='Comma-separated tile sizes (default 512,1024,2000)')
+    parser.add_argument('--workers', type=str, default='1,2',
+                        help='Comma-separated worker counts for process_batch (default 1,2)')
+    parser.add_argument('--encode_workers', type=int, default=DEFAULT_ENCODE_WORKERS,
+                        help=f'Encoder/writer threads per slide (default {DEFAULT_ENCODE_WORKERS})')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='Runs per measurement; the fastest is reported (default 1)')
+    parser.add_argument('--skip', type=str, default='',
+                        help='Comma-separated benchmarks to skip: geojson, slide, batch')
+    args = parser.parse_args()
+
+    counts = parse_ints(args.annotations)
+    tile_sizes = parse_ints(args.tile_sizes)
+    skip = {name.strip() for name in args.skip.split(',') if name.strip()}
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        slides_dir, geojson_dirs = prepare_inputs(work_dir, args.slides, args.width, args.height,
+                                                  counts, args.vertices, args.compression)
+        output_dir = os.path.join(work_dir, 'output')
+        results = []
+        if 'geojson' not in skip:
+            results += bench_load_geojson(geojson_dirs, args.repeats)
+        if 'slide' not in skip:
+            results += bench_slide(slides_dir, geojson_dirs, tile_sizes, output_dir, args.repeats,
+                                   args.encode_workers)
+        if 'batch' not in skip:
+            results += bench_batch(slides_dir, geojson_dirs[counts[0]], counts[0], tile_sizes[-1],
+                                   parse_ints(args.workers), output_dir, args.repeats,
+                                   args.encode_workers)
+        shutil.rmtree(output_dir, ignore_errors=True)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'environment': environment(),
+        'config': {'width': args.width, 'height': args.height, 'slides': args.slides,
+                   'compression': args.compression, 'vertices': args.vertices,
+                   'encode_workers': args.encode_workers, 'repeats': args.repeats},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(json.load(f), report)
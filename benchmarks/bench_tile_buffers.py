@@ -0,0 +1,139 @@
+import argparse
+import collections
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from annotation_index import AnnotationIndex
+from tile_pipeline import BufferPool, pad_tile, rasterize_tile_mask
+
+
+'''
+Compare per-tile allocations of the old tiling loop (fresh zero-filled tile and
+mask for every tile) with the pooled buffers and zero-copy interior tiles.
+
+python benchmarks/bench_tile_buffers.py --tile_size 2000 --tiles 200
+'''
+
+
+def make_tiles(count, tile_size, border_every, seed=0):
+    """
+    Generate decoded tiles as the reader stage yields them.
+
+    Parameters:
+    count (int): Number of tiles
+    tile_size (int): Size of tiles
+    border_every (int): Every n-th tile is a clipped border tile
+    seed (int): Random seed
+
+    Returns:
+    list: (tile, x_end, y_end) with the tile in BGR format
+    """
+    rng = np.random.default_rng(seed)
+    source = rng.integers(0, 256, (tile_size, tile_size, 3), dtype=np.uint8)
+    tiles = []
+    for i in range(count):
+        if border_every and i % border_every == border_every - 1:
+            height, width = tile_size, tile_size // 3
+        else:
+            height, width = tile_size, tile_size
+        tiles.append((source[:height, :width].copy(), width, height))
+    return tiles
+
+
+def old_loop(tiles, tile_size, index, in_flight):
+    """Tile loop before buffer reuse: every tile and mask is freshly allocated."""
+    for tile, x_end, y_end in tiles:
+        tile_full = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+        tile_full[:tile.shape[0], :tile.shape[1]] = tile
+        mask, _ = rasterize_tile_mask(index, 0, 0, x_end, y_end, tile_size)
+        in_flight.append((tile_full, mask, []))
+        yield
+
+
+def new_loop(tiles, tile_size, index, in_flight):
+    """Tile loop with pooled border tiles and masks and zero-copy interior tiles."""
+    depth = in_flight.maxlen
+    tile_buffers = BufferPool((tile_size, tile_size, 3), max_free=depth + 1)
+    mask_buffers = BufferPool((tile_size, tile_size), max_free=depth + 1)
+    for tile, x_end, y_end in tiles:
+        buffers = []
+        if tile.shape[:2] == (tile_size, tile_size):
+            tile_full = tile
+        else:
+            tile_full = pad_tile(tile, tile_buffers.acquire())
+            buffers.append((tile_buffers, tile_full))
+        mask, _ = rasterize_tile_mask(index, 0, 0, x_end, y_end, tile_size,
+                                      out=mask_buffers.acquire())
+        buffers.append((mask_buffers, mask))
+        # The oldest queued write finishes and hands its buffers back
+        if len(in_flight) == depth:
+            for pool, buffer in in_flight[0][2]:
+                pool.release(buffer)
+        in_flight.append((tile_full, mask, buffers))
+        yield
+    new_loop.allocations = tile_buffers.allocations + mask_buffers.allocations
+
+
+def run(loop, tiles, tile_size, depth, trace):
+    """
+    Run a tile loop with `depth` writes in flight.
+
+    Returns:
+    tuple: (seconds per tile, fresh bytes per tile or None)
+    """
+    index = AnnotationIndex([])
+    in_flight = collections.deque(maxlen=depth)
+    fresh = 0
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    steps = loop(tiles, tile_size, index, in_flight)
+    while True:
+        if trace:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        if next(steps, StopIteration) is StopIteration:
+            break
+        if trace:
+            fresh += tracemalloc.get_traced_memory()[1] - before
+    elapsed = time.perf_counter() - start
+    if trace:
+        tracemalloc.stop()
+    return elapsed / len(tiles), (fresh / len(tiles) if trace else None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark per-tile buffer allocations of the tiling loop'
+    )
+    parser.add_argument('--tile_size', type=int, default=2000,
+                        help='Tile size in pixels (default 2000)')
+    parser.add_argument('--tiles', type=int, default=200,
+                        help='Number of tiles per run (default 200)')
+    parser.add_argument('--border_every', type=int, default=10,
+                        help='Every n-th tile is a border tile that needs padding (default 10)')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='Writes in flight, i.e. the writer queue depth (default 8)')
+    args = parser.parse_args()
+
+    tiles = make_tiles(args.tiles, args.tile_size, args.border_every)
+    print(f"{args.tiles} tiles of {args.tile_size} px, every {args.border_every}th on the "
+          f"border, {args.depth} writes in flight")
+    print(f"{'loop':>8} {'ms/tile':>10} {'MB fresh/tile':>14}")
+
+    results = {}
+    for name, loop in (('old', old_loop), ('pooled', new_loop)):
+        per_tile, _ = run(loop, tiles, args.tile_size, args.depth, trace=False)
+        _, fresh = run(loop, tiles, args.tile_size, args.depth, trace=True)
+        results[name] = per_tile
+        print(f"{name:>8} {per_tile * 1000:>10.2f} {fresh / 1e6:>14.2f}")
+
+    print(f"Pooled buffers allocated: {new_loop.allocations} "
+          f"(old loop: {2 * args.tiles} tiles and masks)")
+    print(f"Speedup: {results['old'] / results['pooled']:.2f}x")
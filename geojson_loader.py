@@ -0,0 +1,338 @@
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Parsed geometries are cached next to the GeoJSON file as '<name>.geojson.cache.npz'
+CACHE_SUFFIX = '.cache.npz'
+CACHE_VERSION = 2
+
+
+def read_json(path):
+    """
+    Parse a JSON file, with orjson if it is installed.
+
+    Parameters:
+    path (str): Path to JSON file
+
+    Returns:
+    object: Parsed JSON document
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def feature_classification(feature):
+    """
+    QuPath classification name of a GeoJSON feature.
+
+    Handles 'classification' given as {'name': ...}, as {'names': [...]}
+    for derived classes (joined as 'A: B', as QuPath displays them) or as
+    a plain string.
+
+    Parameters:
+    feature (dict): GeoJSON feature
+
+    Returns:
+    str: Classification name, or None if the feature is unclassified
+    """
+    classification = (feature.get('properties') or {}).get('classification')
+    if isinstance(classification, str):
+        return classification or None
+    if isinstance(classification, dict):
+        if classification.get('name'):
+            return classification['name']
+        if classification.get('names'):
+            return ': '.join(classification['names'])
+    return None
+
+
+def _ragged_polygons(polygons):
+    # Flatten Polygon coordinate lists into one coordinate buffer with offsets
+    coords = []
+    ring_offsets = [0]
+    polygon_offsets = [0]
+    for rings in polygons:
+        for ring in rings:
+            coords.extend(ring)
+            ring_offsets.append(len(coords))
+        polygon_offsets.append(len(ring_offsets) - 1)
+    return coords, ring_offsets, polygon_offsets
+
+
+def _from_ragged(geometry_type, coords, offsets):
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.size == 0:
+        coords = coords.reshape(0, 2)
+    return shapely.from_ragged_array(
+        geometry_type, coords, tuple(np.asarray(o, dtype=np.int64) for o in offsets))
+
+
+def geometries_from_geojson(geometries):
+    """
+    Build shapely geometries from GeoJSON geometry objects.
+
+    Polygons and MultiPolygons are flattened into coordinate buffers and
+    built in one vectorized call per type; other geometry types, and groups
+    with mixed coordinate dimensions or unclosed rings, fall back to
+    shapely.geometry.shape per geometry.
+
+    Parameters:
+    geometries (list): GeoJSON geometry dictionaries
+
+    Returns:
+    np.array: Object array of shapely geometries, in input order
+    """
+    result = np.empty(len(geometries), dtype=object)
+    groups = {'Polygon': ([], []), 'MultiPolygon': ([], [])}
+    for position, geometry in enumerate(geometries):
+        group = groups.get(geometry['type'])
+        if group is None:
+            result[position] = shape(geometry)
+        else:
+            group[0].append(position)
+            group[1].append(geometry['coordinates'])
+
+    positions, polygons = groups['Polygon']
+    if positions:
+        try:
+            coords, ring_offsets, polygon_offsets = _ragged_polygons(polygons)
+            result[positions] = _from_ragged(shapely.GeometryType.POLYGON, coords,
+                                             (ring_offsets, polygon_offsets))
+        except (ValueError, shapely.errors.GEOSException):
+            result[positions] = [shape({'type': 'Polygon', 'coordinates': c}) for c in polygons]
+
+    positions, multipolygons = groups['MultiPolygon']
+    if positions:
+        try:
+            parts = [polygon for multipolygon in multipolygons for polygon in multipolygon]
+            coords, ring_offsets, polygon_offsets = _ragged_polygons(parts)
+            multipolygon_offsets = np.cumsum([0] + [len(m) for m in multipolygons])
+            result[positions] = _from_ragged(shapely.GeometryType.MULTIPOLYGON, coords,
+                                             (ring_offsets, polygon_offsets, multipolygon_offsets))
+        except (ValueError, shapely.errors.GEOSException):
+            result[positions] = [shape({'type': 'MultiPolygon', 'coordinates': c})
+                                 for c in multipolygons]
+
+    return result
+
+
+def _source_signature(path):
+    stat = os.stat(path)
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_cache(geojson_path):
+    """
+    Load cached geometries of a GeoJSON file.
+
+    Parameters:
+    geojson_path (str): Path to GeoJSON file
+
+    Returns:
+    tuple: (object array of geometries, list of classification names),
+           or None if there is no valid cache
+    """
+    cache_path = geojson_path + CACHE_SUFFIX
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            if not np.array_equal(cache['source'], _source_signature(geojson_path)):
+                return None
+            data = cache['wkb'].tobytes()
+            offsets = cache['offsets']
+            classes = [name or None for name in cache['classes'].tolist()]
+    except (OSError, ValueError, KeyError):
+        return None
+    wkb = np.array([data[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+                   dtype=object)
+    return shapely.from_wkb(wkb), classes
+
+
+def save_cache(geojson_path, geometries, classes):
+    """
+    Cache geometries (as WKB) and classifications of a GeoJSON file next to it.
+
+    The cache records the size and modification time of the GeoJSON file and
+    is ignored once the file changes. Failing to write it (e.g. in a
+    read-only directory) only prints a warning.
+
+    Parameters:
+    geojson_path (str): Path to GeoJSON file
+    geometries (np.array): Geometries parsed from the file
+    classes (list): Classification name of every geometry (None if unclassified)
+    """
+    cache_path = geojson_path + CACHE_SUFFIX
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in wkb], out=offsets[1:])
+    tmp_path = cache_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, source=_source_signature(geojson_path),
+                     wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8), offsets=offsets,
+                     classes=np.array([name or '' for name in classes], dtype=str))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"WARNING: Could not write GeoJSON cache '{cache_path}': {e}")
+
+
+def read_geojson_annotations(geojson_path, cache=True):
+    """
+    Read the feature geometries and classifications of a GeoJSON file.
+
+    With cache, both are read from the cache next to the file if it is up to
+    date, and the cache is written after parsing otherwise.
+
+    Parameters:
+    geojson_path (str): Path to GeoJSON file
+    cache (bool): Use and write the binary cache (default True)
+
+    Returns:
+    tuple: (object array of shapely geometries, list of classification names
+           with None for unclassified features), one entry per feature
+    """
+    if cache:
+        cached = load_cache(geojson_path)
+        if cached is not None:
+            return cached
+
+    data = read_json(geojson_path)
+    features = data['features']
+    geometries = geometries_from_geojson([feature['geometry'] for feature in features])
+    classes = [feature_classification(feature) for feature in features]
+
+    if cache:
+        save_cache(geojson_path, geometries, classes)
+    return geometries, classes
+
+
+def filter_by_class(classes, include_classes=None, exclude_classes=None):
+    """
+    Select annotations by classification name.
+
+    Parameters:
+    classes (list): Classification name of every annotation (None if unclassified)
+    include_classes (list): Keep only these classes (default None, keep all)
+    exclude_classes (list): Drop these classes (default None)
+
+    Returns:
+    np.array: Boolean array, True for annotations to keep
+    """
+    keep = np.ones(len(classes), dtype=bool)
+    if include_classes:
+        include = set(include_classes)
+        keep &= np.array([name in include for name in classes], dtype=bool)
+    if exclude_classes:
+        exclude = set(exclude_classes)
+        keep &= np.array([name not in exclude for name in classes], dtype=bool)
+    return keep
+
+
+def class_mask_values(classes, class_values, default_value=255):
+    """
+    Mask value of every annotation for a multi-class label mask.
+
+    Parameters:
+    classes (list): Classification name of every annotation (None if unclassified)
+    class_values (dict): Mask value per classification name
+    default_value (int): Value of annotations whose class is not listed
+
+    Returns:
+    list: Mask value of every annotation
+    """
+    return [class_values.get(name, default_value) for name in classes]
+
+
+def describe_classes(classes):
+    """
+    Summarize annotation counts per class, e.g. 'Vessel: 120, Tumor: 4'.
+
+    Parameters:
+    classes (list): Classification name of every annotation
+
+    Returns:
+    str: Counts per class, most frequent first
+    """
+    counts = Counter(name or 'Unclassified' for name in classes)
+    return ', '.join(f"{name}: {count}" for name, count in counts.most_common())
+
+
+def parse_class_values(text):
+    """
+    Parse a 'Class=value,Class=value' mapping from the command line.
+
+    Parameters:
+    text (str): Comma-separated name=value pairs
+
+    Returns:
+    dict: Mask value per classification name
+    """
+    class_values = {}
+    for item in text.split(','):
+        name, _, value = item.rpartition('=')
+        if not name or not value.strip().isdigit() or int(value) > 255:
+            raise ValueError(f"Invalid class value '{item}' (expected Name=0..255)")
+        class_values[name.strip()] = int(value)
+    return class_values
+
+
+def load_annotations(geojson_path, downsample=None, cache=True,
+                     include_classes=None, exclude_classes=None):
+    """
+    Load, filter and rescale the annotations of a GeoJSON file.
+
+    Parameters:
+    geojson_path (str): Path to GeoJSON file
+    downsample (tuple): (x, y) downsample factors of the pyramid level being tiled;
+                        level 0 coordinates are divided by them (default None, no rescaling)
+    cache (bool): Read and write the binary cache next to the GeoJSON (default True)
+    include_classes (list): Keep only annotations of these classes (default None, all)
+    exclude_classes (list): Drop annotations of these classes (default None)
+
+    Returns:
+    tuple: (list of annotation geometries, list of their classification names)
+    """
+    geometries, classes = read_geojson_annotations(geojson_path, cache=cache)
+
+    if include_classes or exclude_classes:
+        keep = filter_by_class(classes, include_classes, exclude_classes)
+        print(f"Keeping {int(keep.sum())} of {len(classes)} annotations after class filters")
+        geometries = geometries[keep]
+        classes = [name for name, kept in zip(classes, keep) if kept]
+
+    # Rescale level 0 coordinates to the pyramid level being tiled
+    if downsample is not None and tuple(downsample) != (1.0, 1.0):
+        geometries = scale_geometries(geometries, downsample)
+
+    print(f"Loaded {len(geometries)} annotations from GeoJSON"
+          + (f" ({describe_classes(classes)})" if any(classes) else ""))
+    return list(geometries), classes
+
+
+def scale_geometries(geometries, downsample):
+    """
+    Divide geometry coordinates by per-axis downsample factors.
+
+    Parameters:
+    geometries (np.array): Shapely geometries
+    downsample (tuple): (x, y) downsample factors
+
+    Returns:
+    np.array: Rescaled geometries
+    """
+    factors = np.array([1.0 / downsample[0], 1.0 / downsample[1]])
+    return shapely.transform(geometries, lambda coords: coords * factors)
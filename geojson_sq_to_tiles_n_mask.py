@@ -1,33 +1,43 @@
-import numpy as np
 import cv2
-import json
 import os
-import math
 import argparse
-from pathlib import Path
-from shapely.geometry import shape, Point, Polygon
 import tifffile
+from contextlib import nullcontext
 
+from annotation_index import AnnotationIndex
+from geojson_loader import class_mask_values, load_annotations, parse_class_values
+from output_formats import (MASK_CODECS, MASK_STORAGE_MODES, TIFF_COMPRESSIONS, TILE_CODECS,
+                            FileTileSink, ImageCodec, SparseMaskIndex)
+from profiling import PROFILE_REPORT_FILENAME, SlideProfiler, write_profile_report
+from slide_cache import DEFAULT_SLIDE_CACHE_BYTES, SlideCache
+from slide_reader import SlideReader, select_level
+from tile_pipeline import DEFAULT_ENCODE_WORKERS, SAMPLING_MODES, run_tile_pipeline
 
-def load_geojson(geojson_path):
+
+def load_geojson(geojson_path, downsample=None, cache=True, include_classes=None,
+                 exclude_classes=None):
     """
-    Load GeoJSON file and extract rectangular annotations.
+    Load the annotations of a GeoJSON file as shapely geometries.
+
+    Polygons and multipolygons are kept with their holes, and annotations can
+    be filtered by their QuPath classification. Geometries are built with
+    vectorized shapely constructors and cached as WKB next to the GeoJSON
+    file, so repeat runs skip parsing.
 
     Parameters:
     geojson_path (str): Path to GeoJSON file
+    downsample (tuple): (x, y) downsample factors of the pyramid level being tiled;
+                        level 0 coordinates are divided by them (default None, no rescaling)
+    cache (bool): Read and write the '.cache.npz' file next to the GeoJSON (default True)
+    include_classes (list): Keep only annotations with these QuPath classifications
+    exclude_classes (list): Drop annotations with these QuPath classifications
 
     Returns:
-    list: List of annotation polygons
+    list: Annotation Polygons and MultiPolygons in the coordinates of the level
     """
-    with open(geojson_path, 'r') as f:
-        data = json.load(f)
-
-    annotations = []
-    for feature in data['features']:
-        geom = shape(feature['geometry'])
-        annotations.append(geom)
-
-    print(f"Loaded {len(annotations)} annotations from GeoJSON")
+    annotations, _ = load_annotations(geojson_path, downsample=downsample, cache=cache,
+                                      include_classes=include_classes,
+                                      exclude_classes=exclude_classes)
     return annotations
 
 
@@ -85,7 +95,8 @@ def get_bounding_box_from_polygon(polygon):
 
 
 def create_tiles_and_masks(slide_path, annotations, output_dir, tile_size=2000,
-                           mask_value=255, background_value=0):
+                           mask_value=255, background_value=0,
+                           encode_workers=DEFAULT_ENCODE_WORKERS, level=0):
     """
     Create tile images and corresponding mask tiles from slide image and annotations.
 
@@ -96,115 +107,30 @@ def create_tiles_and_masks(slide_path, annotations, output_dir, tile_size=2000,
     tile_size (int): Size of output tiles (default 2000x2000)
     mask_value (int): Pixel value for annotated regions in mask (default 255)
     background_value (int): Pixel value for background in mask (default 0)
+    encode_workers (int): Number of encoder/writer threads (0 writes synchronously)
+    level (int): Pyramid level to tile; annotations must be in its coordinates
     """
-    # Create output directories
-    tiles_dir = os.path.join(output_dir, 'tiles')
-    masks_dir = os.path.join(output_dir, 'masks')
-    Path(tiles_dir).mkdir(parents=True, exist_ok=True)
-    Path(masks_dir).mkdir(parents=True, exist_ok=True)
-
-    # Load the slide image using tifffile
-    slide = load_slide_image(slide_path)
-    slide_height, slide_width = slide.shape[:2]
-
-    # Calculate number of tiles needed
-    num_tiles_x = math.ceil(slide_width / tile_size)
-    num_tiles_y = math.ceil(slide_height / tile_size)
-    total_tiles = num_tiles_x * num_tiles_y
-
-    print(f"Will create {num_tiles_x} x {num_tiles_y} = {total_tiles} tiles")
-
-    tile_count = 0
-    tiles_with_annotations = 0
-
-    # Generate tiles
-    for row in range(num_tiles_y):
-        for col in range(num_tiles_x):
-            # Calculate tile position
-            x_start = col * tile_size
-            y_start = row * tile_size
-            x_end = min(x_start + tile_size, slide_width)
-            y_end = min(y_start + tile_size, slide_height)
-
-            # Extract tile from slide
-            tile = slide[y_start:y_end, x_start:x_end]
-
-            # Create a full-sized tile (pad if necessary for border tiles)
-            tile_full = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
-            actual_height, actual_width = tile.shape[:2]
-            tile_full[:actual_height, :actual_width] = tile
-
-            # Create mask for this tile
-            mask = np.zeros((tile_size, tile_size), dtype=np.uint8) + background_value
-
-            # Check which annotations intersect with this tile
-            tile_bbox = Polygon([
-                [x_start, y_start],
-                [x_end, y_start],
-                [x_end, y_end],
-                [x_start, y_end],
-                [x_start, y_start]
-            ])
-
-            has_annotation = False
-
-            for annotation in annotations:
-                # Check if annotation intersects with this tile
-                if annotation.intersects(tile_bbox):
-                    has_annotation = True
-
-                    # Get the intersection
-                    intersection = annotation.intersection(tile_bbox)
-
-                    # Convert to local tile coordinates
-                    if intersection.geom_type == 'Polygon':
-                        polys_to_draw = [intersection]
-                    elif intersection.geom_type == 'MultiPolygon':
-                        polys_to_draw = list(intersection.geoms)
-                    else:
-                        continue
-
-                    for poly in polys_to_draw:
-                        # Get coordinates and convert to local tile coordinates
-                        coords = np.array(poly.exterior.coords)
-                        local_coords = coords - [x_start, y_start]
-                        local_coords = local_coords.astype(np.int32)
-
-                        # Fill the polygon in the mask
-                        cv2.fillPoly(mask, [local_coords], mask_value)
-
-            # Save tile and mask with Da{tile_count} naming
-            tile_filename = f"Da{tile_count}.jpg"
-            mask_filename = f"Da{tile_count}_mask.png"
-
-            tile_path = os.path.join(tiles_dir, tile_filename)
-            mask_path = os.path.join(masks_dir, mask_filename)
-
-            cv2.imwrite(tile_path, tile_full)
-            cv2.imwrite(mask_path, mask)
-
-            if has_annotation:
-                tiles_with_annotations += 1
-
-            tile_count += 1
-
-            if tile_count % 100 == 0:
-                print(f"Processed {tile_count}/{total_tiles} tiles ({tiles_with_annotations} with annotations)")
-
-    print(f"\nProcessing complete!")
-    print(f"Created {tile_count} tiles total")
-    print(f"{tiles_with_annotations} tiles contain annotations")
-    print(f"Tiles saved to: {tiles_dir}")
-    print(f"Masks saved to: {masks_dir}")
+    create_tiles_and_masks_filtered(slide_path, annotations, output_dir, tile_size=tile_size,
+                                    mask_value=mask_value, background_value=background_value,
+                                    save_only_annotated=False, encode_workers=encode_workers,
+                                    level=level)
 
 
 def create_tiles_and_masks_filtered(slide_path, annotations, output_dir, tile_size=2000,
                                     mask_value=255, background_value=0,
-                                    save_only_annotated=False):
+                                    save_only_annotated=False,
+                                    encode_workers=DEFAULT_ENCODE_WORKERS, level=0,
+                                    annotation_values=None, stride=None, sampling='grid',
+                                    max_negative_patches=100, sampling_seed=0,
+                                    tile_codec=None, mask_codec=None, mask_storage='image',
+                                    slide_cache=None):
     """
     Create tile images and corresponding mask tiles from slide image and annotations.
     Option to save only tiles that contain annotations.
 
+    The slide is read window by window and tiles go through the same
+    reader / rasterizer / encoder pipeline as the batch script.
+
     Parameters:
     slide_path (str): Path to the whole slide image
     annotations (list): List of annotation polygons from GeoJSON
@@ -213,117 +139,62 @@ def create_tiles_and_masks_filtered(slide_path, annotations, output_dir, tile_si
     mask_value (int): Pixel value for annotated regions in mask (default 255)
     background_value (int): Pixel value for background in mask (default 0)
     save_only_annotated (bool): If True, only save tiles that contain annotations
+    encode_workers (int): Number of encoder/writer threads (0 writes synchronously)
+    level (int): Pyramid level to tile; annotations must be in its coordinates
+    annotation_values (list): Mask value of every annotation for a multi-class
+                              label mask (default None, all use mask_value)
+    stride (int): Distance between tile origins (default tile_size, no overlap)
+    sampling (str): 'grid' tiles the whole slide (default); 'annotation' cuts patches
+                    around each annotation's bounding box plus random negative patches
+    max_negative_patches (int): Cap on negative patches with 'annotation' sampling (default 100)
+    sampling_seed (int): Seed of the negative patch sampler (default 0)
+    tile_codec (ImageCodec): Tile encoder (default JPEG)
+    mask_codec (ImageCodec): Mask encoder (default PNG)
+    mask_storage (str): 'image' (default) or 'rle' to keep run-length encoded masks in
+                        masks_rle.json in output_dir, with nothing stored for empty masks
+    slide_cache (SlideCache): On-disk cache of decoded slide levels (default None)
     """
     # Create output directories
     tiles_dir = os.path.join(output_dir, 'tiles')
     masks_dir = os.path.join(output_dir, 'masks')
-    Path(tiles_dir).mkdir(parents=True, exist_ok=True)
-    Path(masks_dir).mkdir(parents=True, exist_ok=True)
-
-    # Load the slide image using tifffile
-    slide = load_slide_image(slide_path)
-    slide_height, slide_width = slide.shape[:2]
-
-    # Calculate number of tiles needed
-    num_tiles_x = math.ceil(slide_width / tile_size)
-    num_tiles_y = math.ceil(slide_height / tile_size)
-    total_tiles = num_tiles_x * num_tiles_y
-
-    print(f"Will process {num_tiles_x} x {num_tiles_y} = {total_tiles} tiles")
-    if save_only_annotated:
-        print("Only saving tiles with annotations")
-
-    tile_index = 0
-    saved_tiles = 0
-    tiles_with_annotations = 0
-
-    # Generate tiles
-    for row in range(num_tiles_y):
-        for col in range(num_tiles_x):
-            # Calculate tile position
-            x_start = col * tile_size
-            y_start = row * tile_size
-            x_end = min(x_start + tile_size, slide_width)
-            y_end = min(y_start + tile_size, slide_height)
-
-            # Extract tile from slide
-            tile = slide[y_start:y_end, x_start:x_end]
-
-            # Create a full-sized tile (pad if necessary for border tiles)
-            tile_full = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
-            actual_height, actual_width = tile.shape[:2]
-            tile_full[:actual_height, :actual_width] = tile
-
-            # Create mask for this tile
-            mask = np.zeros((tile_size, tile_size), dtype=np.uint8) + background_value
-
-            # Check which annotations intersect with this tile
-            tile_bbox = Polygon([
-                [x_start, y_start],
-                [x_end, y_start],
-                [x_end, y_end],
-                [x_start, y_end],
-                [x_start, y_start]
-            ])
-
-            has_annotation = False
-
-            for annotation in annotations:
-                # Check if annotation intersects with this tile
-                if annotation.intersects(tile_bbox):
-                    has_annotation = True
-
-                    # Get the intersection
-                    intersection = annotation.intersection(tile_bbox)
-
-                    # Convert to local tile coordinates
-                    if intersection.geom_type == 'Polygon':
-                        polys_to_draw = [intersection]
-                    elif intersection.geom_type == 'MultiPolygon':
-                        polys_to_draw = list(intersection.geoms)
-                    else:
-                        continue
-
-                    for poly in polys_to_draw:
-                        # Get coordinates and convert to local tile coordinates
-                        coords = np.array(poly.exterior.coords)
-                        local_coords = coords - [x_start, y_start]
-                        local_coords = local_coords.astype(np.int32)
-
-                        # Fill the polygon in the mask
-                        cv2.fillPoly(mask, [local_coords], mask_value)
-
-            # Decide whether to save this tile
-            should_save = not save_only_annotated or has_annotation
-
-            if should_save:
-                # Save tile and mask with Da{tile_index} naming
-                tile_filename = f"Da{tile_index}.jpg"
-                mask_filename = f"Da{tile_index}_mask.png"
-
-                tile_path = os.path.join(tiles_dir, tile_filename)
-                mask_path = os.path.join(masks_dir, mask_filename)
-
-                cv2.imwrite(tile_path, tile_full)
-                cv2.imwrite(mask_path, mask)
-
-                saved_tiles += 1
-
-            if has_annotation:
-                tiles_with_annotations += 1
-
-            tile_index += 1
-
-            if tile_index % 100 == 0:
-                print(f"Processed {tile_index}/{total_tiles} tiles "
-                      f"({tiles_with_annotations} with annotations, {saved_tiles} saved)")
+    if mask_storage == 'rle':
+        mask_codec = SparseMaskIndex(output_dir, background_value=background_value)
+    sink = FileTileSink(tiles_dir, masks_dir, encode_workers=encode_workers,
+                        tile_codec=tile_codec, mask_codec=mask_codec)
+
+    # Patch windows are placed from the annotation bounding boxes
+    annotation_bounds = None
+    if sampling == 'annotation':
+        annotation_bounds = [get_bounding_box_from_polygon(annotation) for annotation in annotations]
+
+    # Read, rasterize and write tiles; the slide is decoded window by window
+    print(f"Opening slide image: {slide_path}")
+    counts = run_tile_pipeline(
+        slide_path,
+        AnnotationIndex(annotations, values=annotation_values),
+        sink,
+        tile_size=tile_size,
+        mask_value=mask_value,
+        background_value=background_value,
+        save_only_annotated=save_only_annotated,
+        level=level,
+        stride=stride,
+        annotation_bounds=annotation_bounds,
+        max_negative_patches=max_negative_patches,
+        sampling_seed=sampling_seed,
+        slide_cache=slide_cache
+    )
 
     print(f"\nProcessing complete!")
-    print(f"Processed {tile_index} tiles total")
-    print(f"{tiles_with_annotations} tiles contain annotations")
-    print(f"Saved {saved_tiles} tiles")
+    print(f"Processed {counts['total_tiles']} tiles total")
+    print(f"{counts['tiles_with_annotations']} tiles contain annotations")
+    print(f"Saved {counts['saved_tiles']} tiles")
+    encoding = sink.encode_stats()
+    if encoding['encode_mb_per_s'] is not None:
+        print(f"Encoded {encoding['encoded_mb']} MB at {encoding['encode_mb_per_s']} MB/s "
+              f"of raw pixels per encoder thread")
     print(f"Tiles saved to: {tiles_dir}")
-    print(f"Masks saved to: {masks_dir}")
+    print(f"Masks saved to: {sink.masks_location}")
 
 
 if __name__ == "__main__":
@@ -345,19 +216,132 @@ if __name__ == "__main__":
                         help='Pixel value for background in mask (default 0)')
     parser.add_argument('--only_annotated', action='store_true',
                         help='Only save tiles that contain annotations')
+    parser.add_argument('--encode_workers', type=int, default=DEFAULT_ENCODE_WORKERS,
+                        help=f'Encoder/writer threads (default {DEFAULT_ENCODE_WORKERS}, 0 for '
+                             'synchronous writes)')
+    parser.add_argument('--level', type=int, default=None,
+                        help='Pyramid level to tile (default 0, full resolution)')
+    parser.add_argument('--target_mpp', type=float, default=None,
+                        help='Target resolution in microns per pixel; tiles the closest pyramid '
+                             'level (overrides --level)')
+    parser.add_argument('--no_geojson_cache', action='store_true',
+                        help='Do not read or write the parsed-annotation cache next to the GeoJSON file')
+    parser.add_argument('--include_classes', type=str, default=None,
+                        help='Comma-separated QuPath classifications to keep (default all)')
+    parser.add_argument('--exclude_classes', type=str, default=None,
+                        help='Comma-separated QuPath classifications to drop')
+    parser.add_argument('--class_values', type=str, default=None,
+                        help='Multi-class label mask values, e.g. "Vessel=1,Tumor=2,Necrosis=3"; '
+                             'unlisted classes use --mask_value')
+    parser.add_argument('--sampling', choices=SAMPLING_MODES, default='grid',
+                        help='grid (tile the whole slide, default) or annotation (patches centred on '
+                             'annotations plus capped random negatives; only those windows are decoded)')
+    parser.add_argument('--max_negative_patches', type=int, default=100,
+                        help='Maximum number of patches without annotations with --sampling '
+                             'annotation (default 100)')
+    parser.add_argument('--sampling_seed', type=int, default=0,
+                        help='Seed for negative patch sampling (default 0)')
+    parser.add_argument('--tile_codec', choices=TILE_CODECS, default='jpeg',
+                        help='Tile encoding (default jpeg; webp is lossless)')
+    parser.add_argument('--mask_codec', choices=MASK_CODECS, default='png',
+                        help='Mask encoding (default png; all lossless)')
+    parser.add_argument('--jpeg_quality', type=int, default=None,
+                        help='JPEG quality 0-100 (default OpenCV\'s 95)')
+    parser.add_argument('--png_level', type=int, default=None,
+                        help='PNG compression level 0-9; lower is faster (default OpenCV\'s 1)')
+    parser.add_argument('--tiff_compression', choices=tuple(TIFF_COMPRESSIONS), default='lzw',
+                        help='Compression of tiff tiles and masks (default lzw; zstd needs libtiff support)')
+    parser.add_argument('--mask_storage', choices=MASK_STORAGE_MODES, default='image',
+                        help='image (one mask image per tile, default) or rle (run-length encoded masks '
+                             'in masks_rle.json, nothing stored for empty masks)')
+    overlap_group = parser.add_mutually_exclusive_group()
+    overlap_group.add_argument('--stride', type=int, default=None,
+                               help='Distance between tile origins in pixels (default --tile_size, '
+                                    'no overlap)')
+    overlap_group.add_argument('--overlap', type=int, default=None,
+                               help='Overlap between neighbouring tiles in pixels (stride = '
+                                    'tile_size - overlap)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the slide: write <slide>.prof, <slide>.collapsed (flame graph stacks) '
+                             'and profile_report.txt to the output directory')
+    parser.add_argument('--slide_cache_dir', type=str, default=None,
+                        help='Cache the decoded slide in this directory for later runs on the same slide')
+    parser.add_argument('--slide_cache_gb', type=float, default=DEFAULT_SLIDE_CACHE_BYTES / 1024 ** 3,
+                        help='Disk budget of the slide cache in GB (default '
+                             f'{DEFAULT_SLIDE_CACHE_BYTES // 1024 ** 3})')
 
     args = parser.parse_args()
 
-    # Load annotations from GeoJSON
-    annotations = load_geojson(args.geojson)
+    # Tile stride from --stride or --overlap
+    stride = args.stride
+    if args.overlap is not None:
+        stride = args.tile_size - args.overlap
+    if stride is not None and stride <= 0:
+        parser.error('--stride must be positive and --overlap smaller than --tile_size')
+    if args.sampling == 'annotation' and stride is not None:
+        parser.error('--sampling annotation cannot be combined with --stride or --overlap')
+
+    # Build the encoders before any slide is read
+    codec_options = {'jpeg_quality': args.jpeg_quality, 'png_level': args.png_level,
+                     'tiff_compression': args.tiff_compression}
+    try:
+        tile_codec = ImageCodec(args.tile_codec, **codec_options)
+        mask_codec = ImageCodec(args.mask_codec, **codec_options)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        class_values = parse_class_values(args.class_values) if args.class_values else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Pick the pyramid level and its scale relative to level 0
+    level = select_level(args.slide, level=args.level, target_mpp=args.target_mpp)
+    with SlideReader(args.slide, level) as reader:
+        downsample = reader.downsample
+    if level > 0:
+        print(f"Using pyramid level {level} (downsample {downsample[0]:.2f})")
+
+    # Load annotations from GeoJSON, in the coordinates of the chosen level
+    include_classes = [c.strip() for c in args.include_classes.split(',')] if args.include_classes else None
+    exclude_classes = [c.strip() for c in args.exclude_classes.split(',')] if args.exclude_classes else None
+    annotations, classes = load_annotations(
+        args.geojson,
+        downsample=downsample,
+        cache=not args.no_geojson_cache,
+        include_classes=include_classes,
+        exclude_classes=exclude_classes
+    )
+    annotation_values = None
+    if class_values:
+        annotation_values = class_mask_values(classes, class_values, args.mask_value)
 
     # Create tiles and masks
-    create_tiles_and_masks_filtered(
-        args.slide,
-        annotations,
-        args.output_dir,
-        tile_size=args.tile_size,
-        mask_value=args.mask_value,
-        background_value=args.background_value,
-        save_only_annotated=args.only_annotated
-    )
\ No newline at end of file
+    profile_prefix = os.path.join(args.output_dir, os.path.splitext(os.path.basename(args.slide))[0])
+    with SlideProfiler(profile_prefix) if args.profile else nullcontext():
+        create_tiles_and_masks_filtered(
+            args.slide,
+            annotations,
+            args.output_dir,
+            tile_size=args.tile_size,
+            mask_value=args.mask_value,
+            background_value=args.background_value,
+            save_only_annotated=args.only_annotated,
+            encode_workers=args.encode_workers,
+            level=level,
+            annotation_values=annotation_values,
+            stride=stride,
+            sampling=args.sampling,
+            max_negative_patches=args.max_negative_patches,
+            sampling_seed=args.sampling_seed,
+            tile_codec=tile_codec,
+            mask_codec=mask_codec,
+            mask_storage=args.mask_storage,
+            slide_cache=(SlideCache(args.slide_cache_dir, int(args.slide_cache_gb * 1024 ** 3))
+                         if args.slide_cache_dir else None)
+        )
+
+    if args.profile:
+        report_path = os.path.join(args.output_dir, PROFILE_REPORT_FILENAME)
+        print()
+        print(write_profile_report([profile_prefix], report_path))
+        print(f"Profile report saved to: {report_path}")
\ No newline at end of file
@@ -0,0 +1,611 @@
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from contextlib import closing
+
+import numpy as np
+import cv2
+import tifffile
+
+from instrumentation import timed
+from slide_reader import SlideReader, select_level
+from tile_pipeline import (cache_overlapping_segments, iter_tile_windows, pad_tile, prefetch,
+                           read_tiles, tile_grid_size)
+from tissue_detection import detect_tissue
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+BACKENDS = ('onnx', 'torchscript')
+BLEND_MODES = ('gaussian', 'uniform')
+ACTIVATIONS = ('sigmoid', 'softmax', 'none')
+
+# Tile size of the output TIFF and of the blocks predictions are accumulated in
+OUTPUT_TILE_SIZE = 512
+
+
+class OnnxBackend:
+    """
+    Run an ONNX segmentation model with ONNX Runtime on the CPU.
+
+    Parameters:
+    model_path (str): Path to the .onnx model
+    threads (int): Intra-op threads (default None, ONNX Runtime's default)
+    """
+
+    def __init__(self, model_path, threads=None):
+        if onnxruntime is None:
+            raise ImportError("The ONNX backend needs onnxruntime (pip install onnxruntime)")
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        """
+        Parameters:
+        batch (np.array): float32 batch of shape (N, 3, H, W)
+
+        Returns:
+        np.array: First model output, (N, C, H, W) or (N, H, W)
+        """
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class TorchScriptBackend:
+    """
+    Run a TorchScript segmentation model with PyTorch on the CPU.
+
+    Models returning a tuple, list or dict (e.g. torchvision's {'out': ...})
+    use their first output.
+
+    Parameters:
+    model_path (str): Path to the TorchScript model (torch.jit.save)
+    threads (int): Intra-op threads (default None, PyTorch's default)
+    """
+
+    def __init__(self, model_path, threads=None):
+        if torch is None:
+            raise ImportError("The TorchScript backend needs PyTorch (pip install torch)")
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = torch.jit.load(model_path, map_location='cpu').eval()
+
+    def predict(self, batch):
+        """
+        Parameters:
+        batch (np.array): float32 batch of shape (N, 3, H, W)
+
+        Returns:
+        np.array: First model output, (N, C, H, W) or (N, H, W)
+        """
+        with torch.inference_mode():
+            output = self.model(torch.from_numpy(batch))
+        if isinstance(output, dict):
+            output = next(iter(output.values()))
+        elif isinstance(output, (tuple, list)):
+            output = output[0]
+        return output.numpy()
+
+
+class FunctionBackend:
+    """
+    Wrap a Python function mapping a (N, 3, H, W) float32 batch to model outputs,
+    e.g. a model from another framework or a classical filter.
+
+    Parameters:
+    function (callable): Prediction function
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def predict(self, batch):
+        return self.function(batch)
+
+
+def load_backend(model_path, backend=None, threads=None):
+    """
+    Load a model with the backend for its format.
+
+    Parameters:
+    model_path (str): Path to the model
+    backend (str): 'onnx' or 'torchscript' (default None, 'onnx' for .onnx files
+                   and 'torchscript' otherwise)
+    threads (int): Intra-op threads of the backend
+
+    Returns:
+    object: Backend with predict(batch)
+    """
+    if backend is None:
+        backend = 'onnx' if model_path.lower().endswith('.onnx') else 'torchscript'
+    if backend == 'onnx':
+        return OnnxBackend(model_path, threads=threads)
+    if backend == 'torchscript':
+        return TorchScriptBackend(model_path, threads=threads)
+    raise ValueError(f"Unknown backend '{backend}' (choose from {', '.join(BACKENDS)})")
+
+
+def blend_weights(tile_size, mode='gaussian', sigma_scale=0.125):
+    """
+    Per-pixel weights of one window when blending overlapping predictions.
+
+    'gaussian' down-weights window borders, where models see the least
+    context; 'uniform' averages overlapping predictions.
+
+    Parameters:
+    tile_size (int): Window size
+    mode (str): 'gaussian' (default) or 'uniform'
+    sigma_scale (float): Gaussian sigma as a fraction of the window size
+
+    Returns:
+    np.array: float32 (tile_size, tile_size) weights, all positive
+    """
+    if mode == 'uniform':
+        return np.ones((tile_size, tile_size), dtype=np.float32)
+    if mode != 'gaussian':
+        raise ValueError(f"Unknown blend mode '{mode}' (choose from {', '.join(BLEND_MODES)})")
+    centre = (tile_size - 1) / 2.0
+    axis = np.exp(-0.5 * ((np.arange(tile_size) - centre) / (sigma_scale * tile_size)) ** 2)
+    weights = np.outer(axis, axis).astype(np.float32)
+    # Keep border weights above zero so pixels seen by a single window are kept
+    return np.maximum(weights / weights.max(), 1e-3)
+
+
+def prepare_batch(tiles, out, mean=None, std=None):
+    """
+    Convert BGR uint8 tiles into a normalized float32 RGB batch in NCHW layout.
+
+    Parameters:
+    tiles (np.array): (N, H, W, 3) BGR uint8 tiles
+    out (np.array): float32 (N, 3, H, W) buffer to write into
+    mean (tuple): Per-channel RGB mean subtracted after scaling to [0, 1] (default none)
+    std (tuple): Per-channel RGB standard deviation divided by (default none)
+
+    Returns:
+    np.array: `out`
+    """
+    # BGR to RGB and NHWC to NCHW in one strided copy
+    np.multiply(tiles[..., ::-1].transpose(0, 3, 1, 2), np.float32(1 / 255), out=out)
+    if mean is not None:
+        out -= np.asarray(mean, dtype=np.float32)[None, :, None, None]
+    if std is not None:
+        out /= np.asarray(std, dtype=np.float32)[None, :, None, None]
+    return out
+
+
+def foreground_probabilities(output, activation='sigmoid', channel=None):
+    """
+    Foreground probability maps from raw model outputs.
+
+    Parameters:
+    output (np.array): (N, C, H, W) or (N, H, W) model outputs
+    activation (str): 'sigmoid' (default), 'softmax' (over channels) or 'none'
+                      if the model already outputs probabilities
+    channel (int): Foreground channel (default 1 with several channels, else 0)
+
+    Returns:
+    np.array: float32 (N, H, W) probabilities
+    """
+    output = np.asarray(output, dtype=np.float32)
+    if output.ndim == 3:
+        output = output[:, None]
+    if activation == 'softmax':
+        output = np.exp(output - output.max(axis=1, keepdims=True))
+        output /= output.sum(axis=1, keepdims=True)
+    elif activation == 'sigmoid':
+        output = 1.0 / (1.0 + np.exp(-output))
+    elif activation != 'none':
+        raise ValueError(f"Unknown activation '{activation}' (choose from {', '.join(ACTIVATIONS)})")
+    if channel is None:
+        channel = 1 if output.shape[1] > 1 else 0
+    return output[:, channel]
+
+
+class PredictionStitcher:
+    """
+    Blend overlapping window predictions into a slide-sized uint8 map.
+
+    Weighted predictions and weights are accumulated in blocks of
+    block_size x block_size pixels, allocated only where windows were
+    predicted. Windows must arrive in row-major order: once a window
+    starts below a block row, no later window can reach it, so the row is
+    normalized, written to `out` and freed. At most the blocks under one
+    row of windows are held in memory.
+
+    Parameters:
+    out (np.array): (height, width) uint8 output, e.g. a memory-mapped .npy
+    block_size (int): Accumulator block size (default OUTPUT_TILE_SIZE)
+    threshold (float): If given, write mask_value where the probability is at
+                       least threshold and 0 elsewhere, instead of probabilities x 255
+    mask_value (int): Value of thresholded foreground (default 255)
+    """
+
+    def __init__(self, out, block_size=OUTPUT_TILE_SIZE, threshold=None, mask_value=255):
+        self.out = out
+        self.height, self.width = out.shape
+        self.block_size = block_size
+        self.threshold = threshold
+        self.mask_value = mask_value
+        self.blocks = {}
+        self._next_row = 0
+
+    def add(self, x_start, y_start, probabilities, weights):
+        """
+        Add the prediction of one window.
+
+        Parameters:
+        x_start, y_start (int): Window origin
+        probabilities (np.array): (h, w) float32 probabilities, clipped to the slide
+        weights (np.array): Blend weights of the window (at least (h, w))
+        """
+        self.flush(y_start)
+        height, width = probabilities.shape
+        size = self.block_size
+        for row in range(y_start // size, (y_start + height - 1) // size + 1):
+            for col in range(x_start // size, (x_start + width - 1) // size + 1):
+                block = self.blocks.get((row, col))
+                if block is None:
+                    block = np.zeros((2, size, size), dtype=np.float32)
+                    self.blocks[(row, col)] = block
+                # Overlap of the window with this block, in slide coordinates
+                x0, x1 = max(x_start, col * size), min(x_start + width, (col + 1) * size)
+                y0, y1 = max(y_start, row * size), min(y_start + height, (row + 1) * size)
+                window_weights = weights[y0 - y_start:y1 - y_start, x0 - x_start:x1 - x_start]
+                block_y, block_x = y0 - row * size, x0 - col * size
+                block[0, block_y:block_y + y1 - y0, block_x:block_x + x1 - x0] += (
+                    probabilities[y0 - y_start:y1 - y_start, x0 - x_start:x1 - x_start]
+                    * window_weights)
+                block[1, block_y:block_y + y1 - y0, block_x:block_x + x1 - x0] += window_weights
+
+    def flush(self, y_limit=None):
+        """
+        Write and free all block rows that end at or above y_limit (default all).
+
+        Parameters:
+        y_limit (int): No later window starts above this row
+        """
+        size = self.block_size
+        last_row = -(-self.height // size) if y_limit is None else y_limit // size
+        for row in range(self._next_row, last_row):
+            for col in range(-(-self.width // size)):
+                block = self.blocks.pop((row, col), None)
+                if block is None:
+                    continue
+                y0, x0 = row * size, col * size
+                height, width = min(size, self.height - y0), min(size, self.width - x0)
+                weighted, weight = block[0, :height, :width], block[1, :height, :width]
+                probabilities = np.divide(weighted, weight, out=np.zeros_like(weighted),
+                                          where=weight > 0)
+                if self.threshold is not None:
+                    values = np.where(probabilities >= self.threshold, self.mask_value, 0)
+                else:
+                    values = np.rint(probabilities * 255)
+                self.out[y0:y0 + height, x0:x0 + width] = np.clip(values, 0, 255)
+        self._next_row = max(self._next_row, last_row)
+
+
+def downsample_image(image, out, interpolation, block_rows=4096):
+    """
+    Halve an image into `out`, block by block so memory-mapped inputs stay on disk.
+
+    Parameters:
+    image (np.array): (height, width) uint8 image
+    out (np.array): (ceil(height / 2), ceil(width / 2)) uint8 output
+    interpolation (int): OpenCV interpolation flag
+    block_rows (int): Input rows per block (even)
+    """
+    for y in range(0, image.shape[0], block_rows):
+        block = np.asarray(image[y:y + block_rows])
+        rows = -(-block.shape[0] // 2)
+        out[y // 2:y // 2 + rows] = cv2.resize(block, (out.shape[1], rows),
+                                               interpolation=interpolation)
+
+
+def _image_tiles(image, tile_size):
+    # Full tiles in row-major order, as tifffile expects; edge tiles are zero-padded
+    for y in range(0, image.shape[0], tile_size):
+        for x in range(0, image.shape[1], tile_size):
+            tile = np.zeros((tile_size, tile_size), dtype=np.uint8)
+            block = image[y:y + tile_size, x:x + tile_size]
+            tile[:block.shape[0], :block.shape[1]] = block
+            yield tile
+
+
+def write_pyramid_tiff(path, image, tile_size=OUTPUT_TILE_SIZE, mpp=None, is_mask=False,
+                       work_dir=None):
+    """
+    Write a single-channel image as a tiled, zlib-compressed pyramidal TIFF.
+
+    Level 0 is followed by 2x downsampled levels in SubIFDs, down to one
+    tile, so the result opens in the same viewers (and SlideReader) as the
+    slides. Downsampled levels are built in memory-mapped files in work_dir.
+
+    Parameters:
+    path (str): Output path
+    image (np.array): (height, width) uint8 level 0, may be memory-mapped
+    tile_size (int): TIFF tile size (default OUTPUT_TILE_SIZE)
+    mpp (float): Level 0 resolution in microns per pixel, stored in the resolution tags
+    is_mask (bool): Downsample with nearest neighbour (labels) instead of area averaging
+    work_dir (str): Directory for the downsampled levels (default: next to path)
+    """
+    interpolation = cv2.INTER_NEAREST if is_mask else cv2.INTER_AREA
+    levels = [image]
+    work_dir = tempfile.mkdtemp(prefix='pyramid_', dir=work_dir or os.path.dirname(path) or '.')
+    try:
+        while max(levels[-1].shape) > tile_size:
+            height, width = levels[-1].shape
+            level = np.lib.format.open_memmap(
+                os.path.join(work_dir, f"level{len(levels)}.npy"), mode='w+', dtype=np.uint8,
+                shape=(-(-height // 2), -(-width // 2)))
+            downsample_image(levels[-1], level, interpolation)
+            levels.append(level)
+
+        options = {'tile': (tile_size, tile_size), 'photometric': 'minisblack',
+                   'compression': 'zlib', 'dtype': np.uint8, 'metadata': None}
+        tmp_path = path + '.tmp'
+        with tifffile.TiffWriter(tmp_path, bigtiff=True) as tif:
+            for index, level in enumerate(levels):
+                if mpp:
+                    # Pixels per centimetre at this level
+                    resolution = 1e4 / (mpp * 2 ** index)
+                    options.update(resolution=(resolution, resolution), resolutionunit='CENTIMETER')
+                tif.write(_image_tiles(level, tile_size), shape=level.shape,
+                          subifds=len(levels) - 1 if index == 0 else None,
+                          subfiletype=1 if index > 0 else 0, **options)
+        os.replace(tmp_path, path)
+    finally:
+        del levels[1:]
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_inference(slide_path, backend, output_path, tile_size=512, stride=None, batch_size=8,
+                  level=0, blend='gaussian', activation='sigmoid', channel=None, threshold=None,
+                  mask_value=255, mean=None, std=None, skip_background=False,
+                  min_tissue_fraction=0.05, metrics=None):
+    """
+    Segment a whole slide with a sliding window and write a pyramidal mask TIFF.
+
+    Windows come from the same tile grid, reader thread and segment cache as
+    the tiling pipeline. They are predicted in batches of batch_size, the
+    overlapping predictions are blended (see blend_weights) by a
+    PredictionStitcher into a memory-mapped map next to the output, and the
+    map is written as a pyramidal TIFF. Memory holds one batch of windows
+    plus the accumulator blocks under one row of windows.
+
+    Parameters:
+    slide_path (str): Path to the whole slide image
+    backend: Model backend with predict(batch) (see load_backend)
+    output_path (str): Path of the output TIFF
+    tile_size (int): Model input size (default 512)
+    stride (int): Distance between windows (default tile_size // 2 for 50% overlap)
+    batch_size (int): Windows per model call (default 8)
+    level (int): Pyramid level to segment (default 0)
+    blend (str): 'gaussian' (default) or 'uniform' blending of overlaps
+    activation (str): 'sigmoid' (default), 'softmax' or 'none' (model outputs probabilities)
+    channel (int): Foreground output channel (default 1 with several channels, else 0)
+    threshold (float): If given, write a binary mask (mask_value / 0) instead of
+                       probabilities scaled to 0-255
+    mask_value (int): Foreground value of the thresholded mask (default 255)
+    mean (tuple): RGB mean for input normalization after scaling to [0, 1] (default none)
+    std (tuple): RGB standard deviation for input normalization (default none)
+    skip_background (bool): If True, windows without tissue are not predicted (left 0)
+    min_tissue_fraction (float): Minimum tissue fraction of a predicted window (default 0.05)
+    metrics (PipelineMetrics): If given, records 'decode', 'color', 'tissue', 'inference',
+                               'stitch' and 'write' time and bytes read and written
+
+    Returns:
+    dict: Window counts, timing and the output path
+    """
+    start = time.perf_counter()
+    stride = stride or max(1, tile_size // 2)
+    weights = blend_weights(tile_size, blend)
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='inference_', dir=output_dir)
+
+    try:
+        with SlideReader(slide_path, level) as reader:
+            reader.metrics = metrics
+            slide_width, slide_height = reader.dimensions
+            mpp = reader.mpp
+            num_tiles_x, num_tiles_y = tile_grid_size(slide_width, slide_height, tile_size, stride)
+            total_windows = num_tiles_x * num_tiles_y
+            print(f"Slide dimensions: {slide_width} x {slide_height}; {num_tiles_x} x {num_tiles_y} = "
+                  f"{total_windows} windows of {tile_size} px (stride {stride})")
+
+            windows = iter_tile_windows(slide_width, slide_height, tile_size, stride)
+            if skip_background:
+                with timed(metrics, 'tissue'):
+                    tissue_mask = detect_tissue(slide_path, level=level)
+                windows = [window for window in windows
+                           if tissue_mask.fraction(*window[1:]) >= min_tissue_fraction]
+                print(f"Skipping {total_windows - len(windows)} windows without tissue")
+            if stride < tile_size:
+                cache_overlapping_segments(reader, tile_size)
+
+            prediction = np.lib.format.open_memmap(os.path.join(work_dir, 'prediction.npy'),
+                                                   mode='w+', dtype=np.uint8,
+                                                   shape=(slide_height, slide_width))
+            stitcher = PredictionStitcher(prediction, threshold=threshold, mask_value=mask_value)
+
+            # One batch of tiles and model inputs, reused for every batch
+            tiles = np.zeros((batch_size, tile_size, tile_size, 3), dtype=np.uint8)
+            inputs = np.zeros((batch_size, 3, tile_size, tile_size), dtype=np.float32)
+            batch_windows = []
+
+            def predict_batch():
+                count = len(batch_windows)
+                with timed(metrics, 'inference'):
+                    batch = prepare_batch(tiles[:count], inputs[:count], mean, std)
+                    probabilities = foreground_probabilities(backend.predict(batch),
+                                                             activation, channel)
+                with timed(metrics, 'stitch'):
+                    for (_, x_start, y_start, x_end, y_end), window_probabilities in zip(
+                            batch_windows, probabilities):
+                        if window_probabilities.shape != (tile_size, tile_size):
+                            # Models with strided outputs predict at a lower resolution
+                            window_probabilities = cv2.resize(window_probabilities,
+                                                              (tile_size, tile_size),
+                                                              interpolation=cv2.INTER_LINEAR)
+                        stitcher.add(x_start, y_start,
+                                     window_probabilities[:y_end - y_start, :x_end - x_start],
+                                     weights)
+                batch_windows.clear()
+
+            predicted = 0
+            with closing(prefetch(read_tiles(reader, windows), depth=batch_size)) as reads:
+                for window, tile in reads:
+                    pad_tile(tile, tiles[len(batch_windows)])
+                    batch_windows.append(window)
+                    if len(batch_windows) == batch_size:
+                        predict_batch()
+                    predicted += 1
+                    if predicted % 100 == 0:
+                        print(f"Predicted {predicted} windows...")
+            if batch_windows:
+                predict_batch()
+            stitcher.flush()
+            prediction.flush()
+
+        print(f"Writing pyramidal TIFF: {output_path}")
+        with timed(metrics, 'write'):
+            write_pyramid_tiff(output_path, prediction, mpp=mpp, is_mask=threshold is not None,
+                               work_dir=work_dir)
+        if metrics is not None:
+            metrics.add_bytes(written=os.path.getsize(output_path))
+        del prediction
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    seconds = time.perf_counter() - start
+    print(f"Predicted {predicted} windows in {seconds:.1f}s ({predicted / seconds:.1f} windows/s)")
+    return {
+        'filename': os.path.splitext(os.path.basename(slide_path))[0],
+        'total_windows': total_windows,
+        'predicted_windows': predicted,
+        'seconds': round(seconds, 3),
+        'windows_per_s': round(predicted / seconds, 2) if seconds > 0 else None,
+        'output_path': output_path,
+    }
+
+
+def parse_floats(text):
+    return tuple(float(value) for value in text.split(','))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Segment whole slides with a sliding-window model and write pyramidal mask TIFFs'
+    )
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('--slide', help='Path to one whole slide image')
+    source_group.add_argument('--slides_dir', help='Directory of slide images to segment')
+    parser.add_argument('--model', required=True,
+                        help='Path to an ONNX (.onnx) or TorchScript model')
+    parser.add_argument('--output_dir', required=True,
+                        help='Output directory; each slide is written as <slide>_prediction.tif')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help='Model backend (default: onnx for .onnx files, torchscript otherwise)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Intra-op threads of the backend (default: the backend\'s default)')
+    parser.add_argument('--tile_size', type=int, default=512,
+                        help='Model input size in pixels (default 512)')
+    overlap_group = parser.add_mutually_exclusive_group()
+    overlap_group.add_argument('--stride', type=int, default=None,
+                               help='Distance between windows in pixels (default tile_size / 2)')
+    overlap_group.add_argument('--overlap', type=int, default=None,
+                               help='Overlap between neighbouring windows in pixels (stride = tile_size - overlap)')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Windows per model call; bounds the memory used for tiles (default 8)')
+    parser.add_argument('--level', type=int, default=None,
+                        help='Pyramid level to segment (default 0, full resolution)')
+    parser.add_argument('--target_mpp', type=float, default=None,
+                        help='Target resolution in microns per pixel; segments the closest pyramid level '
+                             '(overrides --level)')
+    parser.add_argument('--blend', choices=BLEND_MODES, default='gaussian',
+                        help='Blending of overlapping predictions (default gaussian)')
+    parser.add_argument('--activation', choices=ACTIVATIONS, default='sigmoid',
+                        help='Activation applied to the model outputs (default sigmoid; none if the model '
+                             'outputs probabilities)')
+    parser.add_argument('--channel', type=int, default=None,
+                        help='Foreground output channel (default 1 for multi-channel outputs, else 0)')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Write a binary mask at this probability instead of probabilities scaled to 0-255')
+    parser.add_argument('--mask_value', type=int, default=255,
+                        help='Foreground value of the binary mask with --threshold (default 255)')
+    parser.add_argument('--mean', type=str, default=None,
+                        help='Comma-separated RGB mean for input normalization, e.g. 0.485,0.456,0.406')
+    parser.add_argument('--std', type=str, default=None,
+                        help='Comma-separated RGB standard deviation, e.g. 0.229,0.224,0.225')
+    parser.add_argument('--skip_background', action='store_true',
+                        help='Detect tissue on a thumbnail and only predict windows with tissue')
+    parser.add_argument('--min_tissue_fraction', type=float, default=0.05,
+                        help='Minimum tissue fraction of a predicted window with --skip_background (default 0.05)')
+    parser.add_argument('--extensions', type=str, default='.tif,.tiff,.svs,.ndpi,.scn',
+                        help='Comma-separated slide extensions with --slides_dir (default: .tif,.tiff,.svs,.ndpi,.scn)')
+
+    args = parser.parse_args()
+
+    stride = args.stride
+    if args.overlap is not None:
+        stride = args.tile_size - args.overlap
+    if stride is not None and not 0 < stride <= args.tile_size:
+        parser.error('--stride must be between 1 and --tile_size (and --overlap smaller than --tile_size)')
+    mean = parse_floats(args.mean) if args.mean else None
+    std = parse_floats(args.std) if args.std else None
+
+    if args.slide:
+        slide_paths = [args.slide]
+    else:
+        slide_paths = sorted({path for ext in args.extensions.split(',')
+                              for pattern in (ext.strip(), ext.strip().upper())
+                              for path in glob.glob(os.path.join(args.slides_dir, f"*{pattern}"))})
+        print(f"Found {len(slide_paths)} slide files in {args.slides_dir}")
+
+    try:
+        backend = load_backend(args.model, backend=args.backend, threads=args.threads)
+    except (ImportError, ValueError) as e:
+        parser.error(str(e))
+
+    for index, slide_path in enumerate(slide_paths, 1):
+        print(f"\n[{index}/{len(slide_paths)}] Segmenting slide: {os.path.basename(slide_path)}")
+        print("-" * 80)
+        slide_basename = os.path.splitext(os.path.basename(slide_path))[0]
+        try:
+            level = select_level(slide_path, level=args.level, target_mpp=args.target_mpp)
+            run_inference(
+                slide_path,
+                backend,
+                os.path.join(args.output_dir, f"{slide_basename}_prediction.tif"),
+                tile_size=args.tile_size,
+                stride=stride,
+                batch_size=args.batch_size,
+                level=level,
+                blend=args.blend,
+                activation=args.activation,
+                channel=args.channel,
+                threshold=args.threshold,
+                mask_value=args.mask_value,
+                mean=mean,
+                std=std,
+                skip_background=args.skip_background,
+                min_tissue_fraction=args.min_tissue_fraction
+            )
+        except Exception as e:
+            print(f"ERROR segmenting slide '{os.path.basename(slide_path)}': {str(e)}")
+            import traceback
+            traceback.print_exc()
@@ -0,0 +1,183 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+METRICS_FILENAME = 'metrics.jsonl'
+
+# Stages in pipeline order; anything else recorded is reported after them
+STAGES = ('load_geojson', 'load_slide', 'tissue', 'decode', 'color', 'geometry',
+          'rasterize', 'writer_wait', 'encode', 'write')
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process to its current size.
+
+    Only Linux supports this (through /proc/self/clear_refs).
+
+    Returns:
+    bool: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process since it started or since
+    the last reset_peak_rss.
+
+    Returns:
+    float: Peak RSS in MB, or None where the resource module is unavailable
+    """
+    try:
+        # VmHWM is the value reset_peak_rss resets; ru_maxrss also keeps the
+        # peaks of exited threads on some kernels
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1e3, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / 1e6 if sys.platform == 'darwin' else peak / 1e3, 1)
+
+
+class PipelineMetrics:
+    """
+    Cumulative time per pipeline stage plus bytes read and written.
+
+    Stages run in several threads (reader, rasterizer, writers), so stage
+    times are summed over threads and can add up to more than the wall time.
+    All methods are thread-safe.
+
+    The peak RSS is reset when the metrics are created, so it covers only the
+    slide being measured. Where it cannot be reset, a peak is only reported
+    if the slide raised it above the peak of earlier work in the process.
+
+    Stages: load_geojson, load_slide, tissue, decode (reading and
+    decompressing slide segments), color (conversion to BGR), geometry
+    (index queries and clipping), rasterize (filling masks), writer_wait
+    (blocked on a full writer queue), encode and write (disk).
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._peak_rss_reset = reset_peak_rss()
+        self._start_peak_rss = peak_rss_mb()
+
+    def add(self, stage, seconds):
+        """
+        Add time to a stage.
+
+        Parameters:
+        stage (str): Stage name
+        seconds (float): Elapsed time
+        """
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add_bytes(self, read=0, written=0):
+        """
+        Count bytes read from the slide or written to the output.
+
+        Parameters:
+        read (int): Bytes read
+        written (int): Bytes written
+        """
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def summary(self, tiles=None):
+        """
+        Flat summary for the JSON lines log and the batch summary CSV.
+
+        Parameters:
+        tiles (int): Number of tiles processed, for the tiles/sec rate
+
+        Returns:
+        dict: time_<stage>_s per stage, wall_s, tiles_per_s, mb_read, mb_written
+              and peak_rss_mb (peak RSS while measuring, None if unknown)
+        """
+        wall = time.perf_counter() - self._start
+        peak_rss = peak_rss_mb()
+        if not self._peak_rss_reset and peak_rss is not None and peak_rss <= self._start_peak_rss:
+            # The process peak was reached before this slide; its own peak is unknown
+            peak_rss = None
+        with self._lock:
+            ordered = [s for s in STAGES if s in self.seconds]
+            ordered += sorted(s for s in self.seconds if s not in STAGES)
+            record = {f"time_{s}_s": round(self.seconds[s], 3) for s in ordered}
+            record.update({
+                'wall_s': round(wall, 3),
+                'tiles_per_s': round(tiles / wall, 2) if tiles and wall > 0 else None,
+                'mb_read': round(self.bytes_read / 1e6, 2),
+                'mb_written': round(self.bytes_written / 1e6, 2),
+                'peak_rss_mb': peak_rss,
+            })
+        return record
+
+
+def timed(metrics, stage):
+    """
+    Context manager timing a stage, or doing nothing without metrics.
+
+    Parameters:
+    metrics (PipelineMetrics): Metrics to record into (None disables timing)
+    stage (str): Stage name
+
+    Returns:
+    Context manager
+    """
+    return metrics.stage(stage) if metrics is not None else nullcontext()
+
+
+def append_metrics(path, record):
+    """
+    Append a record as one JSON line.
+
+    The line is written with a single append, so slides finishing in
+    parallel worker processes do not interleave their records.
+
+    Parameters:
+    path (str): Path to the JSON lines file
+    record (dict): Record to append
+    """
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+# Slides are fingerprinted from their size and head/tail blocks; hashing a
+# multi-gigabyte WSI in full on every rerun would cost as much as tiling it
+FINGERPRINT_SAMPLE_BYTES = 4 * 1024 * 1024
+
+
+def file_fingerprint(path, sample_bytes=FINGERPRINT_SAMPLE_BYTES):
+    """
+    Content hash of a file for change detection.
+
+    Files up to 2 * sample_bytes are hashed in full; larger files are hashed
+    from their size, first and last sample_bytes.
+
+    Parameters:
+    path (str): Path to file
+    sample_bytes (int): Bytes hashed from each end of large files (None hashes everything)
+
+    Returns:
+    str: Hex digest
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as f:
+        if sample_bytes is None or size <= 2 * sample_bytes:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        else:
+            digest.update(f.read(sample_bytes))
+            f.seek(size - sample_bytes)
+            digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+
+class SlideManifest:
+    """
+    Append-only JSON lines record of the tiles written for one slide.
+
+    The manifest lives in the slide's output directory and holds a header
+    with the slide and GeoJSON fingerprints and the tile parameters, the
+    indices of processed tiles (flushed in batches) and a completion record
+    with the slide statistics. A truncated last line from a crash is cut off
+    on load, so appends start on a fresh line, and unreadable lines are
+    skipped.
+
+    Each slide is processed by a single process, so no file locking is
+    needed even when slides run in a process pool.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    flush_every (int): Number of processed tiles buffered before appending
+    """
+
+    def __init__(self, slide_output_dir, flush_every=50):
+        self.path = os.path.join(slide_output_dir, MANIFEST_FILENAME)
+        self.flush_every = flush_every
+        self.header = None
+        self.completed_tiles = {}  # tile index -> saved (bool)
+        self.stats = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            end = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Drop a line cut short by a crash, so the next append starts on a fresh line
+                    f.truncate(end)
+                    break
+                end += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('type') == 'header':
+                    self.header = record
+                elif record.get('type') == 'tiles':
+                    self.completed_tiles.update((i, True) for i in record.get('saved', []))
+                    self.completed_tiles.update((i, False) for i in record.get('unsaved', []))
+                elif record.get('type') == 'complete':
+                    self.stats = record['stats']
+
+    def _append(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def state(self, slide_hash, geojson_hash, params):
+        """
+        Compare the recorded run with the current inputs.
+
+        Parameters:
+        slide_hash (str): Fingerprint of the slide
+        geojson_hash (str): Fingerprint of the GeoJSON file
+        params (dict): Tile parameters that affect the output
+
+        Returns:
+        str: 'new', 'changed', 'partial' or 'complete'
+        """
+        if self.header is None:
+            return 'new'
+        if (self.header['slide_hash'] != slide_hash or
+                self.header['geojson_hash'] != geojson_hash or
+                self.header['params'] != params):
+            return 'changed'
+        return 'complete' if self.stats is not None else 'partial'
+
+    def start(self, slide_hash, geojson_hash, params):
+        """
+        Start a fresh record, discarding any previous one.
+
+        Parameters:
+        slide_hash (str): Fingerprint of the slide
+        geojson_hash (str): Fingerprint of the GeoJSON file
+        params (dict): Tile parameters that affect the output
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.header = {
+            'type': 'header',
+            'slide_hash': slide_hash,
+            'geojson_hash': geojson_hash,
+            'params': params,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self.completed_tiles = {}
+        self.stats = None
+        self._pending = {}
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(self.header) + '\n')
+
+    def record_tile(self, tile_index, saved):
+        """
+        Record a processed tile; safe to call from writer threads.
+
+        Parameters:
+        tile_index (int): Index of the tile
+        saved (bool): Whether the tile and mask were written to disk
+        """
+        with self._lock:
+            self._pending[tile_index] = saved
+            if len(self._pending) >= self.flush_every:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        self._append({
+            'type': 'tiles',
+            'saved': sorted(i for i, saved in self._pending.items() if saved),
+            'unsaved': sorted(i for i, saved in self._pending.items() if not saved),
+        })
+        self.completed_tiles.update(self._pending)
+        self._pending = {}
+
+    def flush(self):
+        """Append buffered tile records to the manifest."""
+        with self._lock:
+            self._flush_locked()
+
+    def complete(self, stats):
+        """
+        Mark the slide as complete.
+
+        Parameters:
+        stats (dict): Statistics returned by create_tiles_and_masks_for_slide
+        """
+        with self._lock:
+            self._flush_locked()
+            self.stats = stats
+            self._append({'type': 'complete', 'stats': stats,
+                          'finished': time.strftime('%Y-%m-%dT%H:%M:%S')})
@@ -0,0 +1,796 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import cv2
+import tifffile
+
+from instrumentation import timed
+from tile_pipeline import DEFAULT_ENCODE_WORKERS, TileWriterPool, write_file_atomic
+
+
+OUTPUT_FORMATS = ('files', 'webdataset', 'tiff')
+INDEX_FILENAME = 'index.json'
+
+# 'image' writes every mask with the mask codec; 'rle' keeps run-length encoded
+# masks of a slide in one index file and stores nothing for empty masks
+MASK_STORAGE_MODES = ('image', 'rle')
+MASK_RLE_FILENAME = 'masks_rle.json'
+
+# Codecs for tile and mask files; masks must stay exact, so JPEG is tiles only
+CODEC_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp', 'tiff': '.tif', 'npy': '.npy'}
+TILE_CODECS = tuple(CODEC_EXTENSIONS)
+MASK_CODECS = ('png', 'webp', 'tiff', 'npy')
+TIFF_COMPRESSIONS = {
+    'none': cv2.IMWRITE_TIFF_COMPRESSION_NONE,
+    'lzw': cv2.IMWRITE_TIFF_COMPRESSION_LZW,
+    'deflate': cv2.IMWRITE_TIFF_COMPRESSION_ADOBE_DEFLATE,
+    'zstd': cv2.IMWRITE_TIFF_COMPRESSION_ZSTD,
+}
+
+
+def encode_image(image, extension, params=None):
+    """
+    Encode an image in memory with OpenCV.
+
+    Parameters:
+    image (np.array): Image to encode
+    extension (str): Format extension, e.g. '.jpg' or '.png'
+    params (list): OpenCV imwrite flags and values (default None, OpenCV defaults)
+
+    Returns:
+    bytes: Encoded image
+    """
+    ok, encoded = cv2.imencode(extension, image, params or [])
+    if not ok:
+        raise IOError(f"Could not encode image as {extension}")
+    return encoded.tobytes()
+
+
+def decode_image(data, extension):
+    """
+    Decode an image encoded by ImageCodec.
+
+    Parameters:
+    data (bytes): Encoded image
+    extension (str): Format extension, e.g. '.jpg' or '.npy'
+
+    Returns:
+    np.array: Decoded image, with the channels it was written with
+    """
+    if extension == '.npy':
+        return np.load(io.BytesIO(data))
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+class ImageCodec:
+    """
+    Tile or mask encoder with its parameters and throughput counters.
+
+    'webp' is always lossless. 'npy' stores the raw array, which is the
+    fastest to write and read back but the largest on disk. Encoding time
+    and raw/encoded bytes are summed over all writer threads.
+
+    Parameters:
+    name (str): 'jpeg', 'png', 'webp', 'tiff' or 'npy'
+    jpeg_quality (int): JPEG quality 0-100 (default None, OpenCV's 95)
+    png_level (int): PNG zlib compression level 0-9 (default None, OpenCV's 1)
+    tiff_compression (str): 'lzw' (default), 'deflate', 'zstd' or 'none'
+    """
+
+    def __init__(self, name, jpeg_quality=None, png_level=None, tiff_compression='lzw'):
+        if name not in CODEC_EXTENSIONS:
+            raise ValueError(f"Unknown codec '{name}' (choose from {', '.join(TILE_CODECS)})")
+        self.name = name
+        self.extension = CODEC_EXTENSIONS[name]
+        self.params = []
+        if name == 'jpeg' and jpeg_quality is not None:
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+        elif name == 'png' and png_level is not None:
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_level)]
+        elif name == 'webp':
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, 101]  # above 100 selects lossless
+        elif name == 'tiff':
+            if tiff_compression not in TIFF_COMPRESSIONS:
+                raise ValueError(f"Unknown TIFF compression '{tiff_compression}' "
+                                 f"(choose from {', '.join(TIFF_COMPRESSIONS)})")
+            self.params = [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSIONS[tiff_compression]]
+            # ZSTD depends on how libtiff was built; fail before any slide is read
+            try:
+                encode_image(np.zeros((8, 8), dtype=np.uint8), self.extension, self.params)
+            except (IOError, cv2.error):
+                raise ValueError(f"TIFF compression '{tiff_compression}' is not supported "
+                                 f"by this OpenCV build")
+        self._lock = threading.Lock()
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def description(self):
+        """str: Codec name with its parameters, e.g. 'jpeg(q=90)'"""
+        if self.name == 'jpeg' and self.params:
+            return f"jpeg(q={self.params[1]})"
+        if self.name == 'png' and self.params:
+            return f"png(level={self.params[1]})"
+        if self.name == 'tiff':
+            compression = [k for k, v in TIFF_COMPRESSIONS.items() if v == self.params[1]][0]
+            return f"tiff({compression})"
+        return self.name
+
+    def encode(self, image):
+        """
+        Encode an image and count its size and encoding time.
+
+        Parameters:
+        image (np.array): Image to encode
+
+        Returns:
+        bytes: Encoded image
+        """
+        start = time.perf_counter()
+        if self.name == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, np.ascontiguousarray(image))
+            data = buffer.getvalue()
+        else:
+            data = encode_image(image, self.extension, self.params)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.raw_bytes += image.nbytes
+            self.encoded_bytes += len(data)
+            self.seconds += elapsed
+        return data
+
+
+def encode_stats(codecs):
+    """
+    Summarize the encoding throughput of the codecs of a sink.
+
+    Parameters:
+    codecs (list): ImageCodec instances
+
+    Returns:
+    dict: Raw and encoded megabytes, encoder seconds (summed over threads) and
+          raw megabytes encoded per encoder second
+    """
+    raw_bytes = sum(codec.raw_bytes for codec in codecs)
+    seconds = sum(codec.seconds for codec in codecs)
+    return {
+        'encoded_mb': round(sum(codec.encoded_bytes for codec in codecs) / 1e6, 2),
+        'encode_seconds': round(seconds, 3),
+        'encode_mb_per_s': round(raw_bytes / 1e6 / seconds, 1) if seconds > 0 else None,
+    }
+
+
+def rle_encode(mask, background_value=0):
+    """
+    Run-length encode a mask in COCO style.
+
+    Runs are counted over the column-major flattened mask and start with a
+    background run (possibly of length 0). Binary masks get COCO's
+    uncompressed RLE plus their foreground 'value'; masks with several
+    foreground values list the value of every run in 'values'.
+
+    Parameters:
+    mask (np.array): 2D mask
+    background_value (int): Value of the background runs
+
+    Returns:
+    dict: {'size': [h, w], 'counts': [...], and 'value' or 'values'},
+          or None if the mask is all background
+    """
+    flat = mask.ravel(order='F')
+    starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    if len(starts) == 0 and flat[0] == background_value:
+        return None
+    bounds = np.concatenate(([0], starts, [flat.size]))
+    counts = np.diff(bounds)
+    values = flat[bounds[:-1]]
+    if values[0] != background_value:
+        counts = np.concatenate(([0], counts))
+        values = np.concatenate(([background_value], values))
+    rle = {'size': list(mask.shape), 'counts': counts.tolist()}
+    # Adjacent runs differ, so with background on every even run the odd runs are foreground
+    foreground = values[1::2]
+    if np.all(values[0::2] == background_value) and np.all(foreground == foreground[0]):
+        rle['value'] = int(foreground[0])
+    else:
+        rle['values'] = values.tolist()
+    return rle
+
+
+def rle_decode(rle, background_value=0):
+    """
+    Decode a mask encoded by rle_encode.
+
+    Parameters:
+    rle (dict): Run-length encoding
+    background_value (int): Value of the background runs
+
+    Returns:
+    np.array: 2D uint8 mask
+    """
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    if 'values' in rle:
+        values = np.asarray(rle['values'], dtype=np.uint8)
+    else:
+        values = np.full(len(counts), background_value, dtype=np.uint8)
+        values[1::2] = rle['value']
+    flat = np.repeat(values, counts)
+    return flat.reshape((width, height)).T.copy()
+
+
+class SparseMaskIndex:
+    """
+    Run-length encoded masks of a slide in one JSON file (masks_rle.json).
+
+    Masks that are all background are not stored at all; the file records
+    the mask shape and background value so they can be rebuilt on demand.
+    The file is written when the sink closes. Encoding is counted like an
+    ImageCodec, so the throughput columns work for both.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    background_value (int): Pixel value for background in mask
+    """
+
+    description = 'rle'
+    extension = None
+
+    def __init__(self, slide_output_dir, background_value=0):
+        self.path = os.path.join(slide_output_dir, MASK_RLE_FILENAME)
+        self.background_value = background_value
+        self.shape = None
+        self.masks = {}
+        self.empty_masks = 0
+        self._lock = threading.Lock()
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.seconds = 0.0
+
+    def add(self, tile_index, mask):
+        """
+        Encode the mask of a tile; safe to call from writer threads.
+
+        Parameters:
+        tile_index (int): Index of the tile
+        mask (np.array): Mask of the tile
+        """
+        start = time.perf_counter()
+        rle = rle_encode(mask, self.background_value)
+        size = len(json.dumps(rle['counts'])) if rle is not None else 0
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.shape = list(mask.shape)
+            if rle is None:
+                self.empty_masks += 1
+            else:
+                self.masks[tile_index] = rle
+            self.raw_bytes += mask.nbytes
+            self.encoded_bytes += size
+            self.seconds += elapsed
+
+    def close(self):
+        """Write the index file."""
+        index = {
+            'shape': self.shape,
+            'background_value': self.background_value,
+            'masks': {str(tile_index): self.masks[tile_index] for tile_index in sorted(self.masks)},
+        }
+        write_file_atomic(self.path, json.dumps(index).encode())
+
+
+def load_sparse_mask(slide_output_dir, tile_index, index=None):
+    """
+    Decode one mask from a slide's masks_rle.json.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    tile_index (int): Index of a saved tile
+    index (dict): Parsed masks_rle.json, to avoid re-reading it for every tile
+
+    Returns:
+    np.array: Mask of the tile (all background if nothing was stored for it)
+    """
+    if index is None:
+        with open(os.path.join(slide_output_dir, MASK_RLE_FILENAME), 'r') as f:
+            index = json.load(f)
+    rle = index['masks'].get(str(tile_index))
+    if rle is None:
+        return np.full(index['shape'], index['background_value'], dtype=np.uint8)
+    return rle_decode(rle, index['background_value'])
+
+
+class FileTileSink:
+    """
+    Write each tile and mask as its own file (Da{n}.jpg / Da{n}_mask.png by default).
+
+    Parameters:
+    tiles_dir (str): Directory for tile images
+    masks_dir (str): Directory for mask images
+    encode_workers (int): Number of encoder/writer threads
+    tile_codec (ImageCodec): Tile encoder (default JPEG)
+    mask_codec (ImageCodec): Mask encoder (default PNG), or a SparseMaskIndex to
+                             keep run-length encoded masks instead of mask files
+
+    Set the `metrics` attribute to a PipelineMetrics to record 'write' time.
+    """
+
+    def __init__(self, tiles_dir, masks_dir, encode_workers=DEFAULT_ENCODE_WORKERS,
+                 tile_codec=None, mask_codec=None):
+        self.tiles_dir = tiles_dir
+        self.masks_dir = masks_dir
+        self.tile_codec = tile_codec or ImageCodec('jpeg')
+        self.mask_codec = mask_codec or ImageCodec('png')
+        self.tiles_location = tiles_dir
+        Path(tiles_dir).mkdir(parents=True, exist_ok=True)
+        if isinstance(self.mask_codec, SparseMaskIndex):
+            self.masks_location = self.mask_codec.path
+        else:
+            self.masks_location = masks_dir
+            Path(masks_dir).mkdir(parents=True, exist_ok=True)
+        self.writer = TileWriterPool(encode_workers)
+        self.metrics = None
+
+    def _write(self, tile_index, tile, mask):
+        tile_bytes = self.tile_codec.encode(tile)
+        with timed(self.metrics, 'write'):
+            write_file_atomic(os.path.join(self.tiles_dir, f"Da{tile_index}{self.tile_codec.extension}"),
+                              tile_bytes)
+        if isinstance(self.mask_codec, SparseMaskIndex):
+            self.mask_codec.add(tile_index, mask)
+        else:
+            mask_bytes = self.mask_codec.encode(mask)
+            with timed(self.metrics, 'write'):
+                write_file_atomic(os.path.join(self.masks_dir, f"Da{tile_index}_mask{self.mask_codec.extension}"),
+                                  mask_bytes)
+
+    def write_tile(self, tile_index, tile, mask, on_done=None):
+        """
+        Queue a tile and its mask for writing.
+
+        Parameters:
+        tile_index (int): Index of the tile
+        tile (np.array): Tile in BGR format
+        mask (np.array): Mask of the tile
+        on_done (callable): Called once both are on disk
+        """
+        self.writer.run(self._write, tile_index, tile, mask, on_done=on_done)
+
+    def encode_stats(self):
+        """dict: Encoding throughput of tiles and masks (see encode_stats)"""
+        return encode_stats([self.tile_codec, self.mask_codec])
+
+    def _finish(self):
+        if isinstance(self.mask_codec, SparseMaskIndex):
+            self.mask_codec.close()
+
+    def close(self):
+        """Wait for queued writes and write the sparse mask index, if any."""
+        self.writer.close()
+        self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self._finish()
+
+
+class WebDatasetTileSink:
+    """
+    Write tiles and masks into WebDataset-style tar shards.
+
+    Each sample is stored as two members sharing the key Da{n}:
+    'Da{n}.jpg' (tile) and 'Da{n}.mask.png' (mask), or the extensions of the
+    chosen codecs. A new shard starts every
+    `shard_size` samples. index.json maps every tile index to its shard and
+    the byte offsets of its members, so single tiles can be read without
+    scanning the tar.
+
+    Encoding runs in the writer threads; appending to the shard is serialized.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    slide_basename (str): Slide name, used as the shard name prefix
+    encode_workers (int): Number of encoder threads
+    shard_size (int): Maximum number of samples per shard
+    tile_codec (ImageCodec): Tile encoder (default JPEG)
+    mask_codec (ImageCodec): Mask encoder (default PNG), or a SparseMaskIndex to
+                             keep run-length encoded masks instead of mask members
+
+    Set the `metrics` attribute to a PipelineMetrics to record 'write' time.
+    """
+
+    def __init__(self, slide_output_dir, slide_basename, encode_workers=DEFAULT_ENCODE_WORKERS,
+                 shard_size=1000, tile_codec=None, mask_codec=None):
+        self.slide_output_dir = slide_output_dir
+        self.shards_dir = os.path.join(slide_output_dir, 'shards')
+        Path(self.shards_dir).mkdir(parents=True, exist_ok=True)
+        self.tiles_location = self.shards_dir
+        self.masks_location = self.shards_dir
+        self.slide_basename = slide_basename
+        self.shard_size = shard_size
+        self.tile_codec = tile_codec or ImageCodec('jpeg')
+        self.mask_codec = mask_codec or ImageCodec('png')
+        self.writer = TileWriterPool(encode_workers)
+        self.metrics = None
+        self.index = {}
+        self._lock = threading.Lock()
+        self._tar = None
+        self._shard_name = None
+        self._shard_count = 0
+        self._samples_in_shard = 0
+
+    def _next_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+        self._shard_name = f"{self.slide_basename}-{self._shard_count:05d}.tar"
+        self._tar = tarfile.open(os.path.join(self.shards_dir, self._shard_name), 'w')
+        self._shard_count += 1
+        self._samples_in_shard = 0
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        header = info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+        offset_data = self._tar.offset + len(header)
+        self._tar.addfile(info, io.BytesIO(data))
+        return [offset_data, info.size]
+
+    def _encode_and_append(self, tile_index, tile, mask):
+        tile_bytes = self.tile_codec.encode(tile)
+        sparse = isinstance(self.mask_codec, SparseMaskIndex)
+        if sparse:
+            self.mask_codec.add(tile_index, mask)
+        else:
+            mask_bytes = self.mask_codec.encode(mask)
+        with self._lock, timed(self.metrics, 'write'):
+            if self._tar is None or self._samples_in_shard >= self.shard_size:
+                self._next_shard()
+            key = f"Da{tile_index}"
+            entry = {
+                'shard': self._shard_name,
+                'tile': self._add_member(f"{key}{self.tile_codec.extension}", tile_bytes),
+            }
+            if not sparse:
+                entry['mask'] = self._add_member(f"{key}.mask{self.mask_codec.extension}", mask_bytes)
+            self.index[tile_index] = entry
+            self._samples_in_shard += 1
+
+    def write_tile(self, tile_index, tile, mask, on_done=None):
+        """
+        Queue a tile and its mask for the current shard.
+
+        Parameters:
+        tile_index (int): Index of the tile
+        tile (np.array): Tile in BGR format
+        mask (np.array): Mask of the tile
+        on_done (callable): Called once both are appended
+        """
+        self.writer.run(self._encode_and_append, tile_index, tile, mask, on_done=on_done)
+
+    def encode_stats(self):
+        """dict: Encoding throughput of tiles and masks (see encode_stats)"""
+        return encode_stats([self.tile_codec, self.mask_codec])
+
+    def _finish(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        if isinstance(self.mask_codec, SparseMaskIndex):
+            self.mask_codec.close()
+        write_index(self.slide_output_dir, 'webdataset', self.index,
+                    tile_extension=self.tile_codec.extension,
+                    mask_extension=self.mask_codec.extension)
+
+    def close(self):
+        """Wait for queued writes, close the last shard and write the index."""
+        self.writer.close()
+        self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self._finish()
+        elif self._tar is not None:
+            self._tar.close()
+
+
+class TiffTileSink:
+    """
+    Write tiles and masks as pages of one BigTIFF file per slide.
+
+    Tiles are stored as RGB pages and masks as grayscale pages, both with
+    lossless zlib compression. index.json maps every tile index to its tile
+    and mask page numbers for random access. The tile and mask codecs of the
+    other formats do not apply. Compressing and writing a page happen in one
+    call, so their time is reported together as encoding.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    slide_basename (str): Slide name, used for the TIFF file name
+    encode_workers (int): Number of threads compressing segments of each page
+    mask_index (SparseMaskIndex): If given, masks are run-length encoded into it
+                                  instead of written as pages
+    """
+
+    def __init__(self, slide_output_dir, slide_basename, encode_workers=DEFAULT_ENCODE_WORKERS,
+                 mask_index=None):
+        self.slide_output_dir = slide_output_dir
+        Path(slide_output_dir).mkdir(parents=True, exist_ok=True)
+        self.path = os.path.join(slide_output_dir, f"{slide_basename}_tiles.tif")
+        self.mask_index = mask_index
+        self.tiles_location = self.path
+        self.masks_location = self.path if mask_index is None else mask_index.path
+        self.encode_workers = max(1, encode_workers)
+        # Pages are appended in order by a single writer thread
+        self.writer = TileWriterPool(1 if encode_workers > 0 else 0)
+        self.metrics = None
+        self.index = {}
+        self._tif = tifffile.TiffWriter(self.path, bigtiff=True)
+        self._pages = 0
+        self._raw_bytes = 0
+        self._seconds = 0.0
+
+    def _append(self, tile_index, tile, mask):
+        options = {'compression': 'zlib', 'metadata': None, 'maxworkers': self.encode_workers,
+                   'rowsperstrip': 64}
+        start = time.perf_counter()
+        self._tif.write(cv2.cvtColor(tile, cv2.COLOR_BGR2RGB), photometric='rgb', **options)
+        entry = {'file': os.path.basename(self.path), 'tile': self._pages}
+        self._pages += 1
+        if self.mask_index is None:
+            self._tif.write(mask, photometric='minisblack', **options)
+            entry['mask'] = self._pages
+            self._pages += 1
+            self._raw_bytes += mask.nbytes
+        self._seconds += time.perf_counter() - start
+        self._raw_bytes += tile.nbytes
+        if self.mask_index is not None:
+            self.mask_index.add(tile_index, mask)
+        self.index[tile_index] = entry
+
+    def write_tile(self, tile_index, tile, mask, on_done=None):
+        """
+        Queue a tile and its mask as the next pages.
+
+        Parameters:
+        tile_index (int): Index of the tile
+        tile (np.array): Tile in BGR format
+        mask (np.array): Mask of the tile
+        on_done (callable): Called once both pages are written
+        """
+        self.writer.run(self._append, tile_index, tile, mask, on_done=on_done)
+
+    def encode_stats(self):
+        """dict: Throughput of compressing and appending pages (see encode_stats)"""
+        return {
+            'encoded_mb': round(os.path.getsize(self.path) / 1e6, 2),
+            'encode_seconds': round(self._seconds, 3),
+            'encode_mb_per_s': (round(self._raw_bytes / 1e6 / self._seconds, 1)
+                                if self._seconds > 0 else None),
+        }
+
+    def _finish(self):
+        self._tif.close()
+        if self.mask_index is not None:
+            self.mask_index.close()
+        write_index(self.slide_output_dir, 'tiff', self.index)
+
+    def close(self):
+        """Wait for queued pages, close the TIFF and write the index."""
+        self.writer.close()
+        self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self._finish()
+        else:
+            self._tif.close()
+
+
+def write_index(slide_output_dir, output_format, tiles, **fields):
+    """
+    Write the random-access index of a container output format.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    output_format (str): Name of the output format
+    tiles (dict): Per-tile location records keyed by tile index
+    **fields: Further top-level entries, e.g. the tile and mask extensions
+    """
+    index = {
+        'format': output_format,
+        **fields,
+        'tiles': {str(tile_index): tiles[tile_index] for tile_index in sorted(tiles)},
+    }
+    tmp_path = os.path.join(slide_output_dir, INDEX_FILENAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(slide_output_dir, INDEX_FILENAME))
+
+
+def create_tile_sink(output_format, slide_output_dir, slide_basename,
+                     encode_workers=DEFAULT_ENCODE_WORKERS, shard_size=1000,
+                     tile_codec=None, mask_codec=None, metrics=None):
+    """
+    Create the tile sink for an output format.
+
+    Parameters:
+    output_format (str): 'files', 'webdataset' or 'tiff'
+    slide_output_dir (str): Output directory of the slide
+    slide_basename (str): Slide name
+    encode_workers (int): Number of encoder/writer threads
+    shard_size (int): Samples per tar shard (webdataset only)
+    tile_codec (ImageCodec): Tile encoder (default JPEG; files and webdataset only)
+    mask_codec (ImageCodec): Mask encoder (default PNG; files and webdataset only),
+                             or a SparseMaskIndex for run-length encoded masks (all formats)
+    metrics (PipelineMetrics): Records the time spent writing output, if given
+
+    Returns:
+    object: Sink with write_tile(tile_index, tile, mask, on_done), encode_stats() and close()
+    """
+    if output_format == 'files':
+        sink = FileTileSink(os.path.join(slide_output_dir, 'tiles'),
+                            os.path.join(slide_output_dir, 'masks'),
+                            encode_workers=encode_workers,
+                            tile_codec=tile_codec, mask_codec=mask_codec)
+    elif output_format == 'webdataset':
+        sink = WebDatasetTileSink(slide_output_dir, slide_basename,
+                                  encode_workers=encode_workers, shard_size=shard_size,
+                                  tile_codec=tile_codec, mask_codec=mask_codec)
+    elif output_format == 'tiff':
+        mask_index = mask_codec if isinstance(mask_codec, SparseMaskIndex) else None
+        sink = TiffTileSink(slide_output_dir, slide_basename, encode_workers=encode_workers,
+                            mask_index=mask_index)
+    else:
+        raise ValueError(f"Unknown output format '{output_format}' "
+                         f"(choose from {', '.join(OUTPUT_FORMATS)})")
+    sink.metrics = metrics
+    return sink
+
+
+def _mask_channel(mask):
+    # WebP has no single-channel mode; lossless masks come back as identical BGR channels
+    return mask[:, :, 0] if mask.ndim == 3 else mask
+
+
+class MaskReader:
+    """
+    Read the masks of a slide output directory without decoding the tiles.
+
+    Works with every output format and with run-length encoded masks. The
+    index files are parsed once, and read() is safe to call from several
+    threads.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    """
+
+    def __init__(self, slide_output_dir):
+        self.slide_output_dir = slide_output_dir
+        self.index = None
+        self.sparse_index = None
+        index_path = os.path.join(slide_output_dir, INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self.index = json.load(f)
+        rle_path = os.path.join(slide_output_dir, MASK_RLE_FILENAME)
+        if os.path.exists(rle_path):
+            with open(rle_path, 'r') as f:
+                self.sparse_index = json.load(f)
+
+    def read(self, tile_index):
+        """
+        Read the mask of one tile.
+
+        Parameters:
+        tile_index (int): Index of the tile
+
+        Returns:
+        np.array: Mask, or None if the tile was not saved
+        """
+        if self.sparse_index is not None:
+            # Empty masks are not stored; unsaved tiles read as background too
+            return load_sparse_mask(self.slide_output_dir, tile_index, index=self.sparse_index)
+
+        if self.index is None:
+            for extension in CODEC_EXTENSIONS.values():
+                mask_path = os.path.join(self.slide_output_dir, 'masks',
+                                         f"Da{tile_index}_mask{extension}")
+                if os.path.exists(mask_path):
+                    with open(mask_path, 'rb') as f:
+                        return _mask_channel(decode_image(f.read(), extension))
+            return None
+
+        entry = self.index['tiles'].get(str(tile_index))
+        if entry is None:
+            return None
+        if self.index['format'] == 'webdataset':
+            offset, size = entry['mask']
+            with open(os.path.join(self.slide_output_dir, 'shards', entry['shard']), 'rb') as f:
+                f.seek(offset)
+                data = f.read(size)
+            return _mask_channel(decode_image(data, self.index.get('mask_extension', '.png')))
+        with tifffile.TiffFile(os.path.join(self.slide_output_dir, entry['file'])) as tif:
+            return tif.pages[entry['mask']].asarray()
+
+
+def load_tile(slide_output_dir, tile_index, reader=None):
+    """
+    Read one tile and its mask from a slide output directory, in any output format.
+
+    Masks stored run-length encoded (masks_rle.json) are decoded on demand.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    tile_index (int): Index of the tile
+    reader (MaskReader): MaskReader of the slide, to avoid re-reading its index
+                         files for every tile
+
+    Returns:
+    tuple: (tile in BGR format, mask)
+    """
+    reader = reader or MaskReader(slide_output_dir)
+    index, sparse_index = reader.index, reader.sparse_index
+    sparse = sparse_index is not None
+    if index is None:
+        tile = mask = None
+        for extension in CODEC_EXTENSIONS.values():
+            tile_path = os.path.join(slide_output_dir, 'tiles', f"Da{tile_index}{extension}")
+            mask_path = os.path.join(slide_output_dir, 'masks', f"Da{tile_index}_mask{extension}")
+            if tile is None and os.path.exists(tile_path):
+                with open(tile_path, 'rb') as f:
+                    tile = decode_image(f.read(), extension)
+            if mask is None and not sparse and os.path.exists(mask_path):
+                with open(mask_path, 'rb') as f:
+                    mask = _mask_channel(decode_image(f.read(), extension))
+        if tile is not None and sparse:
+            mask = load_sparse_mask(slide_output_dir, tile_index, index=sparse_index)
+        if tile is None or mask is None:
+            raise KeyError(f"Tile {tile_index} not found in {slide_output_dir}")
+        return tile, mask
+
+    entry = index['tiles'].get(str(tile_index))
+    if entry is None:
+        raise KeyError(f"Tile {tile_index} not found in {slide_output_dir}")
+
+    if index['format'] == 'webdataset':
+        images = []
+        extensions = (index.get('tile_extension', '.jpg'), index.get('mask_extension', '.png'))
+        members = [entry['tile']] + ([entry['mask']] if 'mask' in entry else [])
+        with open(os.path.join(slide_output_dir, 'shards', entry['shard']), 'rb') as f:
+            for (offset, size), extension in zip(members, extensions):
+                f.seek(offset)
+                images.append(decode_image(f.read(size), extension))
+        if 'mask' not in entry:
+            return images[0], load_sparse_mask(slide_output_dir, tile_index, index=sparse_index)
+        return images[0], _mask_channel(images[1])
+
+    if index['format'] == 'tiff':
+        with tifffile.TiffFile(os.path.join(slide_output_dir, entry['file'])) as tif:
+            tile = cv2.cvtColor(tif.pages[entry['tile']].asarray(), cv2.COLOR_RGB2BGR)
+            if 'mask' not in entry:
+                return tile, load_sparse_mask(slide_output_dir, tile_index, index=sparse_index)
+            mask = tif.pages[entry['mask']].asarray()
+        return tile, mask
+
+    raise ValueError(f"Unknown output format '{index['format']}' in "
+                     f"{os.path.join(slide_output_dir, INDEX_FILENAME)}")
@@ -0,0 +1,175 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+
+
+PROFILE_REPORT_FILENAME = 'profile_report.txt'
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Sample the Python stacks of all threads at a fixed interval.
+
+    cProfile only sees the thread it is enabled in, while the tile pipeline
+    decodes in a reader thread and encodes in writer threads. The sampler
+    records every thread, with the thread name as the root frame, so its
+    collapsed stacks cover the whole pipeline.
+
+    Parameters:
+    interval (float): Seconds between samples (default 5 ms)
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """Start sampling in a daemon thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write_collapsed(self, path):
+        """
+        Write the samples in collapsed-stack format ('frame;frame;... count' per line),
+        as read by flamegraph.pl, speedscope and inferno.
+
+        Parameters:
+        path (str): Output path
+        """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class SlideProfiler:
+    """
+    Profile a block with cProfile and the stack sampler.
+
+    On exit, writes '<prefix>.prof' (cProfile statistics of the calling
+    thread, readable with pstats or snakeviz) and '<prefix>.collapsed'
+    (sampled stacks of all threads, for flame graphs).
+
+    Parameters:
+    prefix (str): Output path without extension, e.g. 'output/DR123/DR123'
+    interval (float): Seconds between stack samples (default 5 ms)
+    """
+
+    def __init__(self, prefix, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.prefix = prefix
+        self.prof_path = prefix + '.prof'
+        self.collapsed_path = prefix + '.collapsed'
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(interval)
+
+    def __enter__(self):
+        self.sampler.start()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.disable()
+        self.sampler.stop()
+        Path(os.path.dirname(self.prof_path) or '.').mkdir(parents=True, exist_ok=True)
+        self.profiler.dump_stats(self.prof_path)
+        self.sampler.write_collapsed(self.collapsed_path)
+        return False
+
+
+def _function_name(key):
+    filename, line, name = key
+    if filename == '~':
+        # Built-in functions, e.g. "<method 'decode' of ...>"
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def _leaf_samples(collapsed_path):
+    samples = Counter()
+    with open(collapsed_path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            samples[stack.rsplit(';', 1)[-1]] += int(count)
+    return samples
+
+
+def write_profile_report(prefixes, report_path, top=25):
+    """
+    Summarize the profiles of several slides in one text report.
+
+    Lists the profiled time of every slide, the top functions by cProfile
+    self time summed over the slides, and the top functions by sampled
+    self time over all threads (waits included).
+
+    Parameters:
+    prefixes (list): Profile prefixes, as passed to SlideProfiler
+    report_path (str): Path of the text report
+    top (int): Number of functions per table (default 25)
+
+    Returns:
+    str: The report text
+    """
+    prof_paths = [prefix + '.prof' for prefix in prefixes if os.path.exists(prefix + '.prof')]
+    lines = [f"Profiled slides: {len(prof_paths)}", ""]
+
+    if prof_paths:
+        lines.append("Profiled time per slide (calling thread):")
+        for path in prof_paths:
+            lines.append(f"  {pstats.Stats(path).total_tt:10.2f}s  {path}")
+        lines.append("")
+
+        stats = pstats.Stats(*prof_paths)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+        lines.append(f"Top {top} functions by self time (cProfile, calling thread):")
+        lines.append(f"  {'tottime':>10} {'cumtime':>10} {'calls':>10}  function")
+        for key, (_, calls, tottime, cumtime, _) in rows:
+            lines.append(f"  {tottime:10.3f} {cumtime:10.3f} {calls:10d}  {_function_name(key)}")
+        lines.append("")
+
+    samples = Counter()
+    for prefix in prefixes:
+        if os.path.exists(prefix + '.collapsed'):
+            samples.update(_leaf_samples(prefix + '.collapsed'))
+    total = sum(samples.values())
+    if total:
+        lines.append(f"Top {top} functions by sampled self time (all threads, waits included):")
+        lines.append(f"  {'samples':>10} {'share':>7}  function")
+        for frame, count in samples.most_common(top):
+            lines.append(f"  {count:10d} {100 * count / total:6.1f}%  {frame}")
+
+    report = '\n'.join(lines) + '\n'
+    with open(report_path, 'w') as f:
+        f.write(report)
+    return report
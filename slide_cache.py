@@ -0,0 +1,282 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+SLIDE_CACHE_META_FILENAME = 'meta.json'
+SLIDE_CACHE_PIXELS_FILENAME = 'pixels.npy'
+DEFAULT_SLIDE_CACHE_BYTES = 64 * 1024 ** 3
+DEFAULT_CHUNK_SIZE = 256
+
+# Entries are built under TMP_PREFIX<pid>-<key> and renamed into place
+TMP_PREFIX = '.tmp-'
+
+# Largest band of slide rows decoded at once while an entry is built
+MAX_BUILD_BAND_ROWS = 1024
+
+
+def pid_alive(pid):
+    """
+    Check whether a process with the given id is running on this host.
+
+    Parameters:
+    pid (int): Process id
+
+    Returns:
+    bool: False only if no such process exists
+    """
+    if os.name == 'nt':
+        # os.kill terminates the process on Windows; keep its entries instead
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Running, but owned by another user
+        return True
+    return True
+
+
+class CachedSlide:
+    """
+    Decoded BGR pixels of one slide level, memory-mapped from a cache entry.
+
+    Pixels are stored as square chunks, (chunk rows, chunk columns, chunk,
+    chunk, 3), so a tile window maps to a few contiguous runs of the file
+    and only those pages are read from disk.
+
+    Parameters:
+    entry_dir (str): Directory of the cache entry
+    """
+
+    def __init__(self, entry_dir):
+        self.entry_dir = entry_dir
+        with open(os.path.join(entry_dir, SLIDE_CACHE_META_FILENAME), 'r') as f:
+            self.meta = json.load(f)
+        self.width = self.meta['width']
+        self.height = self.meta['height']
+        self.chunk_size = self.meta['chunk_size']
+        self.chunks = np.load(os.path.join(entry_dir, SLIDE_CACHE_PIXELS_FILENAME), mmap_mode='r')
+
+    def read_region(self, x, y, width, height):
+        """
+        Read a window of the cached level.
+
+        The window is clipped to the slide bounds, like SlideReader.read_region.
+
+        Parameters:
+        x (int): Left edge of the window in level pixels
+        y (int): Top edge of the window in level pixels
+        width (int): Window width in pixels
+        height (int): Window height in pixels
+
+        Returns:
+        np.array: Region in BGR format with shape (h, w, 3)
+        """
+        width = max(0, min(width, self.width - x))
+        height = max(0, min(height, self.height - y))
+        size = self.chunk_size
+        region = np.empty((height, width, 3), dtype=self.chunks.dtype)
+        for row in range(y // size, (y + height - 1) // size + 1 if height else 0):
+            y0 = max(row * size, y)
+            y1 = min((row + 1) * size, y + height)
+            for col in range(x // size, (x + width - 1) // size + 1 if width else 0):
+                x0 = max(col * size, x)
+                x1 = min((col + 1) * size, x + width)
+                region[y0 - y:y1 - y, x0 - x:x1 - x] = \
+                    self.chunks[row, col, y0 - row * size:y1 - row * size, x0 - col * size:x1 - col * size]
+        return region
+
+
+class SlideCache:
+    """
+    On-disk cache of decoded, BGR-converted slide levels.
+
+    Each entry holds one level of one slide as a memory-mapped .npy array in
+    a chunked layout (see CachedSlide) and is keyed by the slide path, its
+    modification time and the level, so a replaced slide is decoded again.
+    The first open of a level decodes it once into the cache; later runs,
+    with any tile size, stride or annotations, only page in the chunks under
+    the windows they read instead of decompressing the slide.
+
+    Entries are evicted least recently used first to keep the cache under
+    max_bytes. Entries are built under a temporary name and renamed into
+    place, so several processes can share one cache directory; temporary
+    entries left by crashed builds are removed before the next build. The
+    cache is picklable and can be passed to worker processes.
+
+    Parameters:
+    cache_dir (str): Directory of the cache
+    max_bytes (int): Disk budget in bytes (default 64 GiB)
+    chunk_size (int): Side of the square chunks in pixels (default 256)
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_SLIDE_CACHE_BYTES, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.chunk_size = int(chunk_size)
+
+    def entry_key(self, slide_path, level=0):
+        """
+        Cache key of a slide level: its absolute path, modification time and level.
+
+        Returns:
+        str: Hex digest naming the entry directory
+        """
+        stat = os.stat(slide_path)
+        key = f"{os.path.abspath(slide_path)}|{stat.st_mtime_ns}|{stat.st_size}|{level}|{self.chunk_size}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def entries(self):
+        """
+        List the complete entries of the cache.
+
+        Returns:
+        list: (entry directory, bytes, last use time) tuples, least recently used first
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(TMP_PREFIX):
+                continue
+            meta_path = os.path.join(self.cache_dir, name, SLIDE_CACHE_META_FILENAME)
+            try:
+                with open(meta_path, 'r') as f:
+                    nbytes = json.load(f)['nbytes']
+                last_used = os.path.getmtime(meta_path)
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((os.path.join(self.cache_dir, name), nbytes, last_used))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, needed_bytes=0):
+        """
+        Remove least recently used entries until needed_bytes more fit the budget.
+
+        Parameters:
+        needed_bytes (int): Size of an entry about to be added
+
+        Returns:
+        int: Number of removed entries
+        """
+        entries = self.entries()
+        total = sum(nbytes for _, nbytes, _ in entries)
+        removed = 0
+        for entry_dir, nbytes, _ in entries:
+            if total + needed_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= nbytes
+            removed += 1
+        return removed
+
+    def remove_stale_builds(self):
+        """
+        Remove temporary entries left by builds whose process is no longer running.
+
+        Returns:
+        int: Number of removed temporary entries
+        """
+        removed = 0
+        if not os.path.isdir(self.cache_dir):
+            return removed
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith(TMP_PREFIX):
+                continue
+            try:
+                pid = int(name[len(TMP_PREFIX):].split('-', 1)[0])
+            except ValueError:
+                continue
+            if pid == os.getpid() or pid_alive(pid):
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            removed += 1
+        return removed
+
+    def open(self, reader):
+        """
+        Open the cached pixels of a slide level, decoding them into the cache first if needed.
+
+        Parameters:
+        reader (SlideReader): Open reader of the slide level, used to build a missing entry
+
+        Returns:
+        CachedSlide: The cached level, or None if it is larger than the cache budget
+        """
+        key = self.entry_key(reader.slide_path, reader.level)
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry_dir, SLIDE_CACHE_META_FILENAME)
+        try:
+            # The modification time of the metadata records the last use, for LRU eviction
+            os.utime(meta_path)
+            return CachedSlide(entry_dir)
+        except FileNotFoundError:
+            # Missing, or being evicted by another process; clear what is left and build it again
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+        size = self.chunk_size
+        rows = math.ceil(reader.height / size)
+        cols = math.ceil(reader.width / size)
+        dtype = np.dtype(reader.dtype)
+        nbytes = rows * cols * size * size * 3 * dtype.itemsize
+        if nbytes > self.max_bytes:
+            print(f"Not caching {reader.slide_path} level {reader.level}: "
+                  f"{nbytes / 1e9:.2f} GB exceeds the slide cache budget")
+            return None
+        self.remove_stale_builds()
+        self.evict(nbytes)
+
+        print(f"Decoding {reader.slide_path} level {reader.level} into the slide cache "
+              f"({nbytes / 1e9:.2f} GB)")
+        start = time.perf_counter()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = os.path.join(self.cache_dir, f"{TMP_PREFIX}{os.getpid()}-{key}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            chunks = np.lib.format.open_memmap(os.path.join(tmp_dir, SLIDE_CACHE_PIXELS_FILENAME), mode='w+',
+                                               dtype=dtype, shape=(rows, cols, size, size, 3))
+            # Decode bands that cover whole native segment rows, so no segment is decoded twice
+            band_height = size
+            if reader.is_native and math.lcm(size, reader.segment_height) <= MAX_BUILD_BAND_ROWS:
+                band_height = math.lcm(size, reader.segment_height)
+            band = np.zeros((band_height, cols * size, 3), dtype=dtype)
+            for band_y in range(0, reader.height, band_height):
+                region = reader.read_region(0, band_y, reader.width, band_height)
+                band[:region.shape[0], :region.shape[1]] = region
+                band[region.shape[0]:] = 0
+                band_rows = math.ceil(region.shape[0] / size)
+                chunks[band_y // size:band_y // size + band_rows] = (
+                    band[:band_rows * size].reshape(band_rows, size, cols, size, 3).transpose(0, 2, 1, 3, 4)
+                )
+            chunks.flush()
+            del chunks
+
+            meta = {
+                'slide_path': os.path.abspath(reader.slide_path),
+                'mtime_ns': os.stat(reader.slide_path).st_mtime_ns,
+                'level': reader.level,
+                'width': reader.width,
+                'height': reader.height,
+                'chunk_size': size,
+                'dtype': dtype.str,
+                'nbytes': nbytes,
+            }
+            with open(os.path.join(tmp_dir, SLIDE_CACHE_META_FILENAME), 'w') as f:
+                json.dump(meta, f, indent=2)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # Another process finished the same entry first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        print(f"Cached {reader.slide_path} level {reader.level} in {time.perf_counter() - start:.1f}s")
+        return CachedSlide(entry_dir)
@@ -0,0 +1,341 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+import tifffile
+
+from instrumentation import timed
+
+
+def convert_to_bgr(image):
+    """
+    Convert an image or image region to 3-channel BGR (for consistency with OpenCV).
+
+    Parameters:
+    image (np.array): Grayscale, RGB or RGBA image
+
+    Returns:
+    np.array: Image in BGR format
+    """
+    if len(image.shape) == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if len(image.shape) == 3:
+        if image.shape[2] == 1:
+            return cv2.cvtColor(image[:, :, 0], cv2.COLOR_GRAY2BGR)
+        if image.shape[2] == 4:
+            return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+        if image.shape[2] == 3:
+            return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    return image
+
+
+def get_slide_mpp(tif):
+    """
+    Get the base resolution of a slide in microns per pixel.
+
+    Uses the 'MPP' entry of Aperio (SVS) descriptions, otherwise the TIFF
+    XResolution/ResolutionUnit tags of the first level.
+
+    Parameters:
+    tif (tifffile.TiffFile): Open slide file
+
+    Returns:
+    float: Microns per pixel at level 0, or None if unknown
+    """
+    page = tif.series[0].levels[0].keyframe
+    if page.is_svs:
+        match = re.search(r'MPP\s*=\s*([0-9.eE+-]+)', page.description)
+        if match:
+            return float(match.group(1))
+    if page.resolutionunit in (tifffile.RESUNIT.CENTIMETER, tifffile.RESUNIT.INCH,
+                               tifffile.RESUNIT.MILLIMETER, tifffile.RESUNIT.MICROMETER):
+        x_resolution, _ = page.get_resolution(tifffile.RESUNIT.MICROMETER)
+        if x_resolution > 0:
+            return 1.0 / x_resolution
+    return None
+
+
+def select_level(slide_path, level=None, target_mpp=None):
+    """
+    Choose the pyramid level of a slide to read from.
+
+    With `target_mpp`, the level whose resolution is closest (in log scale)
+    to the target is chosen; otherwise `level` is used (default 0).
+
+    Parameters:
+    slide_path (str): Path to slide image
+    level (int): Explicit pyramid level
+    target_mpp (float): Target resolution in microns per pixel
+
+    Returns:
+    int: Pyramid level index
+    """
+    with tifffile.TiffFile(slide_path) as tif:
+        levels = tif.series[0].levels
+        if target_mpp is None:
+            level = level or 0
+            if not 0 <= level < len(levels):
+                raise ValueError(f"Level {level} not available in {slide_path} "
+                                 f"({len(levels)} levels)")
+            return level
+
+        base_mpp = get_slide_mpp(tif)
+        if base_mpp is None:
+            raise ValueError(f"Cannot select a level for target MPP {target_mpp}: "
+                             f"resolution of {slide_path} is unknown")
+        base_width = levels[0].keyframe.imagewidth
+        level_mpps = [base_mpp * base_width / lvl.keyframe.imagewidth for lvl in levels]
+        return min(range(len(levels)),
+                   key=lambda i: abs(math.log(level_mpps[i] / target_mpp)))
+
+
+class SlideReader:
+    """
+    Windowed reader for whole slide images stored as TIFF.
+
+    Regions are assembled from the native tiles or strips of the TIFF page,
+    so only the segments covering a requested window are read and decoded,
+    and colour conversion happens per region. Peak memory is bounded by the
+    region size plus the covering segments rather than by the slide size.
+
+    Pages that cannot be read segment-wise (separate sample planes, volumetric
+    pages) fall back to decoding the whole page once.
+
+    Decoded segments can be kept in a small LRU cache (see set_segment_cache),
+    so overlapping windows do not read and decode shared segments twice.
+
+    If `metrics` (a PipelineMetrics) is set, decode and colour conversion
+    time and the compressed bytes read are recorded.
+
+    For pyramidal slides (SVS, NDPI, SCN, pyramidal TIFF) any level of the
+    pyramid can be read, and only that resolution is decoded. Region
+    coordinates are then in the pixels of that level.
+
+    With a `cache` (a slide_cache.SlideCache) the level is decoded once into
+    the on-disk cache and regions are read from its memory map afterwards.
+
+    Parameters:
+    slide_path (str): Path to slide image
+    level (int): Pyramid level to read (default 0, full resolution)
+    cache (SlideCache): On-disk cache of decoded levels (default None)
+    """
+
+    def __init__(self, slide_path, level=0, cache=None):
+        self.slide_path = slide_path
+        self._tif = tifffile.TiffFile(slide_path)
+        levels = self._tif.series[0].levels
+        if not 0 <= level < len(levels):
+            self._tif.close()
+            raise ValueError(f"Level {level} not available in {slide_path} ({len(levels)} levels)")
+        self.level = level
+        self.level_count = len(levels)
+        self._page = levels[level].keyframe
+        self._lock = threading.RLock()
+        self._full_image = None
+        self._segment_cache = OrderedDict()
+        self._segment_cache_bytes = 0
+        self._segment_cache_max_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.metrics = None
+
+        shaped = self._page.shaped  # (separate samples, depth, length, width, contig samples)
+        self.height = shaped[2]
+        self.width = shaped[3]
+        self.samples = shaped[4]
+        self.dtype = self._page.dtype
+
+        self.is_native = (
+            self._page.planarconfig != 2 and
+            self._page.imagedepth == 1 and
+            shaped[0] == 1
+        )
+        if self._page.is_tiled:
+            self.segment_height = self._page.tilelength
+            self.segment_width = self._page.tilewidth
+        else:
+            self.segment_height = min(self._page.rowsperstrip or self.height, self.height)
+            self.segment_width = self.width
+        self.segments_across = math.ceil(self.width / self.segment_width)
+
+        # Scale factors from level 0 coordinates to this level
+        base_page = levels[0].keyframe
+        self.downsample = (base_page.imagewidth / self.width,
+                           base_page.imagelength / self.height)
+        base_mpp = get_slide_mpp(self._tif)
+        self.mpp = base_mpp * self.downsample[0] if base_mpp is not None else None
+
+        self.cached = None
+        if cache is not None:
+            try:
+                self.cached = cache.open(self)
+            except BaseException:
+                self._tif.close()
+                raise
+
+    @property
+    def dimensions(self):
+        """tuple: (width, height) of the slide in pixels"""
+        return self.width, self.height
+
+    def set_segment_cache(self, max_bytes):
+        """
+        Keep up to max_bytes of decoded native segments in an LRU cache.
+
+        Parameters:
+        max_bytes (int): Cache budget in bytes (0 disables the cache)
+        """
+        with self._lock:
+            self._segment_cache_max_bytes = max(0, int(max_bytes))
+            self._evict_segments()
+
+    def _evict_segments(self):
+        while self._segment_cache and self._segment_cache_bytes > self._segment_cache_max_bytes:
+            _, (segment, _, _) = self._segment_cache.popitem(last=False)
+            self._segment_cache_bytes -= segment.nbytes
+
+    def close(self):
+        """Close the underlying TIFF file."""
+        self._full_image = None
+        self.cached = None
+        self._segment_cache.clear()
+        self._segment_cache_bytes = 0
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _segment_indices(self, x, y, width, height):
+        """Return linear indices of the native segments covering a window."""
+        row_first = y // self.segment_height
+        row_last = (y + height - 1) // self.segment_height
+        col_first = x // self.segment_width
+        col_last = (x + width - 1) // self.segment_width
+        return [
+            row * self.segments_across + col
+            for row in range(row_first, row_last + 1)
+            for col in range(col_first, col_last + 1)
+        ]
+
+    def _read_segments(self, indices):
+        """Read and decode native segments, yielding (index, (segment, y_offset, x_offset))."""
+        if not indices:
+            return
+        page = self._page
+        offsets = [page.dataoffsets[i] for i in indices]
+        bytecounts = [page.databytecounts[i] for i in indices]
+        decodeargs = {'_fullsize': page.is_tiled}
+        if page.compression in {6, 7, 34892, 33007}:  # JPEG
+            decodeargs['jpegtables'] = page.jpegtables
+            decodeargs['jpegheader'] = page.jpegheader
+
+        with self._lock:
+            encoded = list(self._tif.filehandle.read_segments(
+                offsets, bytecounts, indices=indices, lock=self._lock
+            ))
+
+        if self.metrics is not None:
+            self.metrics.add_bytes(read=sum(bytecounts))
+        for data, index in encoded:
+            segment, position, _ = page.decode(data, index, **decodeargs)
+            if segment is None:
+                continue
+            yield index, (segment[0], position[2], position[3])
+
+    def _decode_segments(self, indices):
+        """Decode native segments through the LRU cache, yielding (segment, y_offset, x_offset)."""
+        if self._segment_cache_max_bytes <= 0:
+            for _, entry in self._read_segments(indices):
+                yield entry
+            return
+
+        missing = []
+        cached = []
+        with self._lock:
+            for index in indices:
+                entry = self._segment_cache.get(index)
+                if entry is None:
+                    missing.append(index)
+                else:
+                    self._segment_cache.move_to_end(index)
+                    cached.append(entry)
+            self.cache_hits += len(cached)
+            self.cache_misses += len(missing)
+
+        yield from cached
+        for index, entry in self._read_segments(missing):
+            with self._lock:
+                if index not in self._segment_cache:
+                    self._segment_cache[index] = entry
+                    self._segment_cache_bytes += entry[0].nbytes
+                    self._evict_segments()
+            yield entry
+
+    def _read_native(self, x, y, width, height):
+        region = np.zeros((height, width, self.samples), dtype=self.dtype)
+        for segment, seg_y, seg_x in self._decode_segments(
+                self._segment_indices(x, y, width, height)):
+            y0 = max(seg_y, y)
+            y1 = min(seg_y + segment.shape[0], y + height)
+            x0 = max(seg_x, x)
+            x1 = min(seg_x + segment.shape[1], x + width)
+            if y0 >= y1 or x0 >= x1:
+                continue
+            region[y0 - y:y1 - y, x0 - x:x1 - x] = \
+                segment[y0 - seg_y:y1 - seg_y, x0 - seg_x:x1 - seg_x]
+        return region
+
+    def _read_full(self, x, y, width, height):
+        with self._lock:
+            if self._full_image is None:
+                print(f"Decoding full page for {self.slide_path} "
+                      f"(no segment-wise access for this layout)")
+                image = self._page.asarray()
+                if self.metrics is not None:
+                    self.metrics.add_bytes(read=sum(self._page.databytecounts))
+                if self._page.planarconfig == 2 and image.ndim == 3:
+                    image = np.moveaxis(image, 0, -1)
+                self._full_image = image
+        return self._full_image[y:y + height, x:x + width]
+
+    def read_region(self, x, y, width, height):
+        """
+        Read a window of the slide and convert it to BGR.
+
+        The window is clipped to the slide bounds, so border regions may be
+        smaller than requested.
+
+        Parameters:
+        x (int): Left edge of the window in slide pixels
+        y (int): Top edge of the window in slide pixels
+        width (int): Window width in pixels
+        height (int): Window height in pixels
+
+        Returns:
+        np.array: Region in BGR format with shape (h, w, 3)
+        """
+        width = max(0, min(width, self.width - x))
+        height = max(0, min(height, self.height - y))
+        if width == 0 or height == 0:
+            return np.zeros((height, width, 3), dtype=self.dtype)
+
+        if self.cached is not None:
+            # Cached pixels are already BGR; reading them only pages in the covering chunks
+            with timed(self.metrics, 'decode'):
+                return self.cached.read_region(x, y, width, height)
+
+        with timed(self.metrics, 'decode'):
+            if self.is_native:
+                region = self._read_native(x, y, width, height)
+            else:
+                region = self._read_full(x, y, width, height)
+
+        with timed(self.metrics, 'color'):
+            return convert_to_bgr(np.ascontiguousarray(region))
+
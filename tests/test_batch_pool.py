@@ -0,0 +1,22 @@
+import os
+import time
+
+import batch_geojson_to_tiles_and_masks as batch
+
+
+def fake_process_slide(slide_path, geojson_path, output_dir, **slide_kwargs):
+    time.sleep(0.2)
+    if slide_path == 'crash.tif':
+        # Simulate a worker killed by the OOM killer
+        os._exit(1)
+    return {'slide': slide_path}
+
+
+def test_dead_worker_fails_only_its_slide(monkeypatch):
+    monkeypatch.setattr(batch, 'process_slide', fake_process_slide)
+    jobs = [(name, None, 0) for name in ('a.tif', 'crash.tif', 'b.tif', 'c.tif', 'd.tif')]
+
+    results = batch.run_slides_in_pool(jobs, 'unused', {}, workers=2)
+
+    assert results == [{'slide': 'a.tif'}, None, {'slide': 'b.tif'}, {'slide': 'c.tif'},
+                       {'slide': 'd.tif'}]
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from instrumentation import PipelineMetrics, reset_peak_rss
+
+
+@pytest.mark.skipif(not reset_peak_rss(), reason='peak RSS cannot be reset on this platform')
+def test_peak_rss_covers_only_the_measured_slide():
+    large = np.ones(400 * 1024 * 1024 // 8)
+    del large
+    first = PipelineMetrics().summary()['peak_rss_mb']
+
+    metrics = PipelineMetrics()
+    small = np.ones(100 * 1024 * 1024 // 8)
+    second = metrics.summary()['peak_rss_mb']
+    del small
+
+    assert second < first + 200
+    assert second >= first + 90
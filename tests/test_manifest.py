@@ -0,0 +1,39 @@
+from manifest import SlideManifest
+
+
+PARAMS = {'tile_size': 512, 'stride': 512}
+
+
+def test_resume_after_truncated_line(tmp_path):
+    manifest = SlideManifest(str(tmp_path), flush_every=2)
+    manifest.start('slide', 'geojson', PARAMS)
+    for tile_index in range(4):
+        manifest.record_tile(tile_index, saved=tile_index % 2 == 0)
+    # A crash in the middle of an append leaves a line without its newline
+    with open(manifest.path, 'a') as f:
+        f.write('{"type": "tiles", "saved": [4, 5')
+
+    manifest = SlideManifest(str(tmp_path), flush_every=2)
+    assert manifest.state('slide', 'geojson', PARAMS) == 'partial'
+    assert manifest.completed_tiles == {0: True, 1: False, 2: True, 3: False}
+    for tile_index in range(4, 6):
+        manifest.record_tile(tile_index, saved=True)
+    manifest.complete({'tiles_saved': 4})
+
+    manifest = SlideManifest(str(tmp_path))
+    assert manifest.state('slide', 'geojson', PARAMS) == 'complete'
+    assert manifest.stats == {'tiles_saved': 4}
+    assert manifest.completed_tiles == {0: True, 1: False, 2: True, 3: False, 4: True, 5: True}
+
+
+def test_unreadable_line_is_skipped(tmp_path):
+    manifest = SlideManifest(str(tmp_path), flush_every=1)
+    manifest.start('slide', 'geojson', PARAMS)
+    with open(manifest.path, 'a') as f:
+        f.write('{"type": "tiles", "saved": [0\n')
+    manifest.record_tile(1, saved=True)
+    manifest.complete({})
+
+    manifest = SlideManifest(str(tmp_path))
+    assert manifest.state('slide', 'geojson', PARAMS) == 'complete'
+    assert manifest.completed_tiles == {1: True}
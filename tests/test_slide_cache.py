@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import tifffile
+
+from slide_cache import TMP_PREFIX, SlideCache
+from slide_reader import SlideReader
+
+
+def write_slide(path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+    tifffile.imwrite(path, image, tile=(128, 128), photometric='rgb')
+    return image
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_stale_builds_are_removed(tmp_path):
+    slide_path = str(tmp_path / 'slide.tif')
+    image = write_slide(slide_path)
+    cache_dir = tmp_path / 'cache'
+    stale_dir = cache_dir / f"{TMP_PREFIX}{dead_pid()}-0123abcd"
+    live_dir = cache_dir / f"{TMP_PREFIX}{os.getppid()}-4567ef01"
+    stale_dir.mkdir(parents=True)
+    live_dir.mkdir()
+
+    cache = SlideCache(str(cache_dir), chunk_size=128)
+    with SlideReader(slide_path) as reader:
+        cached = cache.open(reader)
+    assert not stale_dir.exists()
+    assert live_dir.exists()
+    assert np.array_equal(cached.read_region(50, 60, 200, 100), image[60:160, 50:250, ::-1])
+
+
+def test_evicted_entry_is_rebuilt(tmp_path):
+    slide_path = str(tmp_path / 'slide.tif')
+    image = write_slide(slide_path)
+    cache = SlideCache(str(tmp_path / 'cache'), chunk_size=128)
+    with SlideReader(slide_path) as reader:
+        cache.open(reader)
+        # Another process evicts the entry between the lookup and the open
+        os.remove(os.path.join(cache.entries()[0][0], 'pixels.npy'))
+        cached = cache.open(reader)
+    assert np.array_equal(cached.read_region(0, 0, 400, 300), image[:, :, ::-1])
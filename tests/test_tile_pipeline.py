@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Polygon, box
+
+from annotation_index import AnnotationIndex
+from tile_pipeline import (BandMaskRasterizer, fill_geometries, iter_tile_windows,
+                           rasterize_tile_mask)
+
+
+def fill(geometries, shape=(20, 20), x_offset=0, y_offset=0):
+    mask = np.zeros(shape, dtype=np.uint8)
+    fill_geometries(mask, geometries, [False] * len(geometries), x_offset, y_offset,
+                    [1] * len(geometries))
+    return mask
+
+
+def test_box_fills_exactly_its_pixels():
+    mask = fill([box(2, 2, 10, 10)])
+    assert mask.sum() == 64
+    assert mask[2:10, 2:10].all()
+
+
+def test_hole_stays_background():
+    annulus = box(2, 2, 12, 12).difference(box(5, 5, 8, 8))
+    mask = fill([annulus])
+    assert mask.sum() == 91
+    assert not mask[5:8, 5:8].any()
+
+
+def test_round_annulus_fills_pixel_centres():
+    angles = np.linspace(0, 2 * np.pi, 50)
+    ring = Polygon(np.column_stack([10 + 8 * np.cos(angles), 10 + 8 * np.sin(angles)]))
+    annulus = ring.difference(ring.buffer(-4))
+    mask = fill([annulus])
+    rows, cols = np.indices(mask.shape)
+    assert np.array_equal(mask.astype(bool), shapely.contains_xy(annulus, cols + 0.5, rows + 0.5))
+
+
+def test_shared_edge_fills_each_pixel_once():
+    mask = np.zeros((10, 10), dtype=np.uint8)
+    fill_geometries(mask, [box(1, 1, 5, 8), box(5, 1, 9, 8)], [True, True], 0, 0, [1, 2])
+    assert (mask == 1).sum() == 28 and (mask == 2).sum() == 28
+
+
+@pytest.mark.parametrize('offset', [(0, 0), (3.25, 7.5)])
+def test_offset(offset):
+    mask = fill([box(2 + offset[0], 2 + offset[1], 10 + offset[0], 10 + offset[1])],
+                x_offset=offset[0], y_offset=offset[1])
+    assert mask.sum() == 64
+
+
+def test_tile_and_band_masks_agree():
+    annotations = [box(5, 5, 45, 30), box(20, 10, 70, 60).difference(box(30, 20, 40, 40))]
+    index = AnnotationIndex(annotations)
+    band = BandMaskRasterizer(index, 80, 70, 32, stride=24)
+    for _, x_start, y_start, x_end, y_end in iter_tile_windows(80, 70, 32, stride=24):
+        tile_mask, _ = rasterize_tile_mask(index, x_start, y_start, x_end, y_end, 32)
+        band_mask, _ = band.tile_mask(x_start, y_start, x_end, y_end)
+        assert np.array_equal(tile_mask, band_mask)
+        expected = np.maximum(*[fill([annotation], (32, 32), x_start, y_start)
+                                for annotation in annotations]) * 255
+        expected[:, x_end - x_start:] = 0
+        expected[y_end - y_start:] = 0
+        assert np.array_equal(tile_mask, expected)
@@ -0,0 +1,77 @@
+import numpy as np
+import cv2
+import pytest
+
+from annotation_index import AnnotationIndex
+from geojson_loader import load_annotations
+from tile_pipeline import BandMaskRasterizer, rasterize_tile_mask
+from vectorize import mask_polygons, output_tile_layout, vectorize_tiles
+
+
+def rasterize(polygons, shape):
+    """Rasterize polygons with the tiling pipeline's rasterizer."""
+    height, width = shape
+    mask, _ = rasterize_tile_mask(AnnotationIndex(polygons), 0, 0, width, height, max(shape))
+    return mask[:height, :width] > 0
+
+
+def assert_round_trip(mask):
+    polygons = [polygon for _, polygon in mask_polygons(mask.astype(np.uint8))]
+    assert np.array_equal(rasterize(polygons, mask.shape), mask)
+    assert all(polygon.is_valid for polygon in polygons)
+    assert sum(polygon.area for polygon in polygons) == mask.sum()
+    return polygons
+
+
+def test_diagonal_ring_keeps_its_centre_empty():
+    mask = np.array([[0, 0, 0, 0, 0],
+                     [0, 0, 1, 0, 0],
+                     [0, 1, 0, 1, 0],
+                     [0, 0, 1, 0, 0],
+                     [0, 0, 0, 0, 0]], dtype=bool)
+    assert len(assert_round_trip(mask)) == 4
+
+
+def test_checkerboard():
+    assert_round_trip(np.indices((5, 5)).sum(axis=0) % 2 == 0)
+
+
+def test_hole_closed_at_a_corner():
+    mask = np.zeros((6, 6), dtype=bool)
+    mask[1:5, 1] = mask[4, 1:5] = mask[1:4, 4] = True
+    mask[1, 2] = mask[2, 3] = True
+    polygons = assert_round_trip(mask)
+    assert len(polygons) == 1 and len(polygons[0].interiors) == 1
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_masks(seed):
+    rng = np.random.default_rng(seed)
+    mask = rng.random((24, 24)) < rng.random()
+    polygons = assert_round_trip(mask)
+    num_regions = cv2.connectedComponents(mask.astype(np.uint8), connectivity=4)[0] - 1
+    assert len(polygons) == num_regions
+
+
+def test_polygons_are_merged_across_tiles(tmp_path):
+    rng = np.random.default_rng(0)
+    mask = np.zeros((300, 400), dtype=np.uint8)
+    for _ in range(40):
+        center = (int(rng.integers(0, 400)), int(rng.integers(0, 300)))
+        cv2.circle(mask, center, int(rng.integers(2, 40)), 255, -1)
+    mask[rng.random(mask.shape) < 0.02] = 255
+
+    output_path = str(tmp_path / 'mask.geojson')
+    rows = output_tile_layout(400, 300, 64)
+    vectorize_tiles(rows, lambda tile_index, x0, y0, x1, y1: mask[y0:y1, x0:x1], output_path,
+                    400, 300, workers=2)
+    polygons, _ = load_annotations(output_path, cache=False)
+
+    foreground = mask > 0
+    assert np.array_equal(rasterize(polygons, mask.shape), foreground)
+    num_regions = cv2.connectedComponents(foreground.astype(np.uint8), connectivity=4)[0] - 1
+    assert len(polygons) == num_regions
+
+    band = BandMaskRasterizer(AnnotationIndex(polygons), 400, 300, 300)
+    band_mask, _ = band.tile_mask(0, 0, 300, 300)
+    assert np.array_equal(band_mask > 0, foreground[:, :300])
@@ -0,0 +1,387 @@
+import argparse
+import csv
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from output_formats import INDEX_FILENAME, MaskReader, load_tile
+
+
+SUMMARY_FILENAME = 'batch_processing_summary.csv'
+NPY_TILES_FILENAME = 'tiles.npy'
+NPY_MASKS_FILENAME = 'masks.npy'
+NPY_SAMPLES_FILENAME = 'samples.json'
+
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+DEFAULT_PREFETCH = 32
+DEFAULT_READ_WORKERS = min(8, os.cpu_count() or 1)
+
+TILE_FILE_PATTERN = re.compile(r'^Da(\d+)\.\w+$')
+
+
+def index_slide_output(slide_output_dir):
+    """
+    List the saved tiles of one slide output directory.
+
+    Uses index.json for the container formats and the file names in tiles/
+    otherwise.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+
+    Returns:
+    list: Sorted tile indices
+    """
+    index_path = os.path.join(slide_output_dir, INDEX_FILENAME)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            return sorted(int(tile_index) for tile_index in json.load(f)['tiles'])
+    tiles_dir = os.path.join(slide_output_dir, 'tiles')
+    if not os.path.isdir(tiles_dir):
+        return []
+    matches = (TILE_FILE_PATTERN.match(name) for name in os.listdir(tiles_dir))
+    return sorted({int(match.group(1)) for match in matches if match})
+
+
+def index_output_dir(output_dir, slides=None):
+    """
+    List the saved tiles of a batch output directory.
+
+    Slides are taken from batch_processing_summary.csv, or from the slide
+    subdirectories when there is no summary (e.g. an interrupted run).
+
+    Parameters:
+    output_dir (str): Output directory of batch_geojson_to_tiles_and_masks.py
+    slides (list): Only index these slides, by name without extension (default all)
+
+    Returns:
+    list: (slide name, tile index) samples, sorted by slide and tile
+    """
+    summary_path = os.path.join(output_dir, SUMMARY_FILENAME)
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r', newline='') as f:
+            names = [row['filename'] for row in csv.DictReader(f)]
+    else:
+        names = [name for name in os.listdir(output_dir)
+                 if os.path.isdir(os.path.join(output_dir, name, 'tiles')) or
+                 os.path.exists(os.path.join(output_dir, name, INDEX_FILENAME))]
+    if slides is not None:
+        wanted = set(slides)
+        names = [name for name in names if name in wanted]
+    return [(name, tile_index) for name in sorted(names)
+            for tile_index in index_slide_output(os.path.join(output_dir, name))]
+
+
+def shard_samples(num_samples, shard_index=0, num_shards=1, shuffle=False, seed=0, epoch=0,
+                  drop_last=False):
+    """
+    Positions of the samples in one shard, the same in every process.
+
+    With shuffle the order is permuted by (seed, epoch), so all shards of an
+    epoch share one permutation and never overlap. For distributed training
+    with loader workers use shard_index = rank * num_workers + worker_id and
+    num_shards = world_size * num_workers.
+
+    Parameters:
+    num_samples (int): Number of samples in the dataset
+    shard_index (int): Index of this shard (default 0)
+    num_shards (int): Number of shards (default 1)
+    shuffle (bool): Permute the samples per epoch (default False)
+    seed (int): Seed of the permutation (default 0)
+    epoch (int): Epoch of the permutation (default 0)
+    drop_last (bool): Drop the remainder so all shards have the same length (default False)
+
+    Returns:
+    np.array: Sample positions of the shard
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard {shard_index} of {num_shards}")
+    order = np.arange(num_samples)
+    if shuffle:
+        order = np.random.default_rng([seed, epoch]).permutation(num_samples)
+    if drop_last:
+        order = order[:num_samples - num_samples % num_shards]
+    return order[shard_index::num_shards]
+
+
+class DecodedCache:
+    """
+    Thread-safe LRU cache of decoded arrays under a byte budget.
+
+    Cached arrays are made read-only, since every reader shares them.
+
+    Parameters:
+    max_bytes (int): Cache budget in bytes (0 disables the cache)
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max(0, int(max_bytes))
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            arrays = self._items.get(key)
+            if arrays is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return arrays
+
+    def put(self, key, arrays):
+        size = sum(array.nbytes for array in arrays)
+        if size > self.max_bytes:
+            return
+        for array in arrays:
+            array.setflags(write=False)
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = arrays
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= sum(array.nbytes for array in evicted)
+
+
+def export_npy(output_dir, npy_dir, slides=None, workers=DEFAULT_READ_WORKERS):
+    """
+    Decode all tiles and masks of a batch output directory into .npy arrays.
+
+    Writes tiles.npy (N, H, W, 3, BGR), masks.npy (N, H, W) and samples.json
+    with the (slide, tile index) of every row, for memory-mapped reading with
+    TileDataset(npy_dir=...). The arrays are filled through memory maps, so
+    the output does not have to fit in memory.
+
+    Parameters:
+    output_dir (str): Output directory of batch_geojson_to_tiles_and_masks.py
+    npy_dir (str): Directory for the arrays
+    slides (list): Only export these slides (default all)
+    workers (int): Decoding threads
+
+    Returns:
+    int: Number of exported samples
+    """
+    samples = index_output_dir(output_dir, slides)
+    if not samples:
+        raise ValueError(f"No saved tiles in {output_dir}")
+    os.makedirs(npy_dir, exist_ok=True)
+    readers = {name: MaskReader(os.path.join(output_dir, name)) for name in {name for name, _ in samples}}
+
+    def read(sample):
+        name, tile_index = sample
+        return load_tile(os.path.join(output_dir, name), tile_index, readers[name])
+
+    tile, mask = read(samples[0])
+    # Written under temporary names, so an interrupted export is never mistaken for a complete one
+    tiles_path = os.path.join(npy_dir, NPY_TILES_FILENAME)
+    masks_path = os.path.join(npy_dir, NPY_MASKS_FILENAME)
+    tiles = np.lib.format.open_memmap(tiles_path + '.tmp', mode='w+', dtype=tile.dtype,
+                                      shape=(len(samples),) + tile.shape)
+    masks = np.lib.format.open_memmap(masks_path + '.tmp', mode='w+', dtype=mask.dtype,
+                                      shape=(len(samples),) + mask.shape)
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        for position, (tile, mask) in enumerate(pool.map(read, samples)):
+            if tile.shape != tiles.shape[1:] or mask.shape != masks.shape[1:]:
+                raise ValueError(f"Tile {samples[position]} has shape {tile.shape}, expected "
+                                 f"{tiles.shape[1:]}; export slides of one tile size together")
+            tiles[position] = tile
+            masks[position] = mask
+    tiles.flush()
+    masks.flush()
+    del tiles, masks
+    os.replace(tiles_path + '.tmp', tiles_path)
+    os.replace(masks_path + '.tmp', masks_path)
+    with open(os.path.join(npy_dir, NPY_SAMPLES_FILENAME), 'w') as f:
+        json.dump([list(sample) for sample in samples], f)
+    return len(samples)
+
+
+class TileDataset:
+    """
+    Serve (tile, mask) pairs of a batch output directory to any training framework.
+
+    The output directory is indexed once (see index_output_dir). Samples are
+    decoded by a thread pool that reads ahead of the consumer, and decoded
+    arrays are kept in an LRU cache, so later epochs over a dataset that fits
+    the cache skip decoding. With npy_dir the samples are read from
+    memory-mapped .npy arrays instead, exported on first use.
+
+    Only NumPy arrays are returned: tiles in BGR order (H, W, 3) and masks (H, W),
+    both uint8. Arrays served from the cache are read-only; copy them before
+    modifying them in place. Iterating yields the samples of this shard in order; len() and
+    indexing refer to the shard as well.
+
+    Parameters:
+    output_dir (str): Output directory of batch_geojson_to_tiles_and_masks.py
+    slides (list): Only use these slides, by name without extension (default all)
+    shard_index (int): Index of this shard (default 0)
+    num_shards (int): Number of shards, e.g. world_size * num_workers (default 1)
+    shuffle (bool): Permute the samples every epoch (default False)
+    seed (int): Seed of the permutation, equal in all processes (default 0)
+    drop_last (bool): Give all shards the same length (default False)
+    transform (callable): transform(tile, mask) applied in the reader threads (default None)
+    cache_bytes (int): Budget of the decoded-array cache (default 512 MB, 0 disables it)
+    prefetch (int): Number of samples read ahead while iterating (default 32)
+    workers (int): Reader threads (default up to 8)
+    npy_dir (str): Directory of memory-mapped .npy arrays (see export_npy); exported
+                   from output_dir if they do not exist yet, and reused as they are
+                   otherwise (default None)
+    """
+
+    def __init__(self, output_dir, slides=None, shard_index=0, num_shards=1, shuffle=False,
+                 seed=0, drop_last=False, transform=None, cache_bytes=DEFAULT_CACHE_BYTES,
+                 prefetch=DEFAULT_PREFETCH, workers=DEFAULT_READ_WORKERS, npy_dir=None):
+        self.output_dir = output_dir
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.transform = transform
+        self.prefetch = max(1, prefetch)
+        self.workers = max(1, workers)
+        self.epoch = 0
+
+        self.tiles = self.masks = None
+        if npy_dir is not None:
+            samples_path = os.path.join(npy_dir, NPY_SAMPLES_FILENAME)
+            if not os.path.exists(samples_path):
+                export_npy(output_dir, npy_dir, slides, workers)
+            with open(samples_path, 'r') as f:
+                self.samples = [tuple(sample) for sample in json.load(f)]
+            self.tiles = np.load(os.path.join(npy_dir, NPY_TILES_FILENAME), mmap_mode='r')
+            self.masks = np.load(os.path.join(npy_dir, NPY_MASKS_FILENAME), mmap_mode='r')
+            if slides is not None:
+                wanted = set(slides)
+                self._rows = [row for row, (name, _) in enumerate(self.samples) if name in wanted]
+                self.samples = [self.samples[row] for row in self._rows]
+            else:
+                self._rows = list(range(len(self.samples)))
+        else:
+            self.samples = index_output_dir(output_dir, slides)
+
+        # Memory-mapped arrays are cached by the page cache already
+        self.cache = DecodedCache(cache_bytes if self.tiles is None else 0)
+        self._readers = {}
+        self._readers_lock = threading.Lock()
+        self._positions = shard_samples(len(self.samples), shard_index, num_shards, shuffle,
+                                        seed, self.epoch, drop_last)
+
+    def set_epoch(self, epoch):
+        """
+        Select the epoch, which changes the order of the samples when shuffling.
+
+        Parameters:
+        epoch (int): Epoch number, the same in all processes
+        """
+        self.epoch = epoch
+        self._positions = shard_samples(len(self.samples), self.shard_index, self.num_shards,
+                                        self.shuffle, self.seed, epoch, self.drop_last)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def sample(self, i):
+        """
+        Slide and tile index of the i-th sample of the shard.
+
+        Returns:
+        tuple: (slide name, tile index)
+        """
+        return self.samples[self._positions[i]]
+
+    def _reader(self, name):
+        with self._readers_lock:
+            reader = self._readers.get(name)
+            if reader is None:
+                reader = self._readers[name] = MaskReader(os.path.join(self.output_dir, name))
+            return reader
+
+    def _load(self, position):
+        if self.tiles is not None:
+            row = self._rows[position]
+            tile, mask = np.array(self.tiles[row]), np.array(self.masks[row])
+        else:
+            name, tile_index = self.samples[position]
+            arrays = self.cache.get((name, tile_index))
+            if arrays is None:
+                arrays = load_tile(os.path.join(self.output_dir, name), tile_index, self._reader(name))
+                self.cache.put((name, tile_index), arrays)
+            tile, mask = arrays
+        if self.transform is not None:
+            return self.transform(tile, mask)
+        return tile, mask
+
+    def __getitem__(self, i):
+        return self._load(self._positions[i])
+
+    def __iter__(self):
+        positions = self._positions
+        pool = ThreadPoolExecutor(self.workers)
+        pending = deque()
+        try:
+            for position in positions:
+                pending.append(pool.submit(self._load, position))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Stopping early must not wait for the samples read ahead: queued reads are
+            # cancelled and the ones already running finish in the background
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Index a batch output directory, export it to .npy arrays or measure read throughput'
+    )
+    parser.add_argument('--output_dir', required=True,
+                        help='Output directory of batch_geojson_to_tiles_and_masks.py')
+    parser.add_argument('--npy_dir', default=None,
+                        help='Export the tiles and masks to memory-mapped .npy arrays in this directory')
+    parser.add_argument('--slides', type=str, default=None,
+                        help='Comma-separated slide names to use (default all)')
+    parser.add_argument('--epochs', type=int, default=1,
+                        help='Epochs to read for the throughput measurement (default 1, 0 to skip)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_READ_WORKERS,
+                        help=f'Reader threads (default {DEFAULT_READ_WORKERS})')
+    parser.add_argument('--cache_mb', type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024),
+                        help=f'Decoded-array cache in MB (default {DEFAULT_CACHE_BYTES // (1024 * 1024)})')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='Read in a shuffled order')
+
+    args = parser.parse_args()
+    slides = [name.strip() for name in args.slides.split(',')] if args.slides else None
+
+    start = time.perf_counter()
+    try:
+        dataset = TileDataset(args.output_dir, slides=slides, shuffle=args.shuffle,
+                              cache_bytes=args.cache_mb * 1024 * 1024, workers=args.workers,
+                              npy_dir=args.npy_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Indexed {len(dataset)} samples from {len({name for name, _ in dataset.samples})} slides "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    for epoch in range(args.epochs):
+        dataset.set_epoch(epoch)
+        start = time.perf_counter()
+        nbytes = 0
+        for tile, mask in dataset:
+            nbytes += tile.nbytes + mask.nbytes
+        elapsed = time.perf_counter() - start
+        print(f"Epoch {epoch}: {len(dataset) / elapsed:.1f} samples/s, "
+              f"{nbytes / elapsed / (1024 * 1024):.1f} MB/s decoded "
+              f"(cache hits {dataset.cache.hits}, misses {dataset.cache.misses})")
@@ -0,0 +1,882 @@
+import functools
+import math
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import numpy as np
+import cv2
+from shapely.geometry import Polygon
+
+from instrumentation import timed
+from slide_reader import SlideReader
+from tissue_detection import detect_tissue
+
+
+DEFAULT_ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+MASK_MODES = ('tile', 'band')
+
+# 'grid' tiles the whole slide; 'annotation' cuts patches around annotations
+SAMPLING_MODES = ('grid', 'annotation')
+
+# Mean span length in pixels below which fill_rings scatters pixels instead of slicing rows
+SHORT_SPAN_PIXELS = 128
+
+# Largest mask band rasterized at once; slides below it are rasterized whole
+MAX_MASK_BAND_BYTES = 256 * 1024 * 1024
+
+# Largest cache of decoded slide segments shared by overlapping tiles
+MAX_SEGMENT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def tile_grid_size(slide_width, slide_height, tile_size, stride=None):
+    """
+    Number of tile columns and rows needed to cover a slide.
+
+    Parameters:
+    slide_width (int): Slide width in pixels
+    slide_height (int): Slide height in pixels
+    tile_size (int): Size of tiles
+    stride (int): Distance between tile origins (default tile_size, no overlap)
+
+    Returns:
+    tuple: (num_tiles_x, num_tiles_y)
+    """
+    stride = stride or tile_size
+    num_tiles_x = max(1, math.ceil(max(0, slide_width - tile_size) / stride) + 1)
+    num_tiles_y = max(1, math.ceil(max(0, slide_height - tile_size) / stride) + 1)
+    return num_tiles_x, num_tiles_y
+
+
+def iter_tile_windows(slide_width, slide_height, tile_size, stride=None):
+    """
+    Yield the tile grid of a slide in row-major order.
+
+    With a stride smaller than the tile size neighbouring tiles overlap by
+    tile_size - stride pixels; the last row and column still reach the
+    slide border.
+
+    Parameters:
+    slide_width (int): Slide width in pixels
+    slide_height (int): Slide height in pixels
+    tile_size (int): Size of tiles
+    stride (int): Distance between tile origins (default tile_size, no overlap)
+
+    Yields:
+    tuple: (tile_index, x_start, y_start, x_end, y_end), clipped to the slide
+    """
+    stride = stride or tile_size
+    num_tiles_x, num_tiles_y = tile_grid_size(slide_width, slide_height, tile_size, stride)
+    tile_index = 0
+    for row in range(num_tiles_y):
+        for col in range(num_tiles_x):
+            x_start = col * stride
+            y_start = row * stride
+            x_end = min(x_start + tile_size, slide_width)
+            y_end = min(y_start + tile_size, slide_height)
+            yield tile_index, x_start, y_start, x_end, y_end
+            tile_index += 1
+
+
+def _patch_starts(low, high, tile_size, limit):
+    # Origins of the patches covering [low, high] along one axis, clamped to the slide
+    extent = high - low
+    if extent <= tile_size:
+        starts = [(low + high - tile_size) / 2.0]
+    else:
+        starts = np.linspace(low, high - tile_size, math.ceil(extent / tile_size))
+    return [min(max(0, int(round(start))), max(0, limit - tile_size)) for start in starts]
+
+
+def sample_annotation_windows(annotation_bounds, annotation_index, slide_width, slide_height,
+                              tile_size, max_negative_patches=100, seed=0, tissue_mask=None,
+                              min_tissue_fraction=0.05):
+    """
+    Choose patch windows around annotations instead of tiling the whole slide.
+
+    Annotations that fit in a patch get one patch centred on their bounding
+    box; larger ones are covered by an evenly spaced grid of patches. Up to
+    max_negative_patches patches without annotations are then drawn at random
+    (on tissue, if a tissue mask is given). Patches are clamped to the slide
+    and returned in row-major order, so neighbouring reads share segments.
+
+    Parameters:
+    annotation_bounds (list): (x_min, y_min, x_max, y_max) of every annotation
+    annotation_index (AnnotationIndex): Spatial index over the slide annotations
+    slide_width (int): Slide width in pixels
+    slide_height (int): Slide height in pixels
+    tile_size (int): Size of patches
+    max_negative_patches (int): Maximum number of patches without annotations (default 100)
+    seed (int): Seed of the negative patch sampler, so reruns pick the same patches
+    tissue_mask (TissueMask): If given, negative patches need min_tissue_fraction tissue
+    min_tissue_fraction (float): Minimum tissue fraction of a negative patch (default 0.05)
+
+    Returns:
+    tuple: (list of (tile_index, x_start, y_start, x_end, y_end) windows,
+           number of patches around annotations)
+    """
+    origins = set()
+    for x_min, y_min, x_max, y_max in annotation_bounds:
+        for y_start in _patch_starts(y_min, y_max, tile_size, slide_height):
+            for x_start in _patch_starts(x_min, x_max, tile_size, slide_width):
+                origins.add((y_start, x_start))
+    num_positive = len(origins)
+
+    rng = np.random.default_rng(seed)
+    negatives = 0
+    for _ in range(20 * max_negative_patches):
+        if negatives >= max_negative_patches:
+            break
+        x_start = int(rng.integers(0, max(0, slide_width - tile_size) + 1))
+        y_start = int(rng.integers(0, max(0, slide_height - tile_size) + 1))
+        x_end = min(x_start + tile_size, slide_width)
+        y_end = min(y_start + tile_size, slide_height)
+        if (y_start, x_start) in origins:
+            continue
+        if annotation_index.query_indices(x_start, y_start, x_end, y_end):
+            continue
+        if (tissue_mask is not None and
+                tissue_mask.fraction(x_start, y_start, x_end, y_end) < min_tissue_fraction):
+            continue
+        origins.add((y_start, x_start))
+        negatives += 1
+
+    windows = [
+        (tile_index, x_start, y_start,
+         min(x_start + tile_size, slide_width), min(y_start + tile_size, slide_height))
+        for tile_index, (y_start, x_start) in enumerate(sorted(origins))
+    ]
+    return windows, num_positive
+
+
+def cache_overlapping_segments(reader, tile_size):
+    """
+    Size the segment cache of a reader for overlapping windows.
+
+    The cache holds one band of segment rows as tall as a tile (capped at
+    MAX_SEGMENT_CACHE_BYTES), which covers every segment shared by
+    neighbouring windows read in row-major order.
+
+    Parameters:
+    reader (SlideReader): Open slide reader
+    tile_size (int): Size of the windows
+    """
+    if not reader.is_native:
+        return
+    segment_rows = math.ceil(tile_size / reader.segment_height) + 1
+    row_bytes = (reader.segments_across * reader.segment_width * reader.segment_height
+                 * reader.samples * np.dtype(reader.dtype).itemsize)
+    reader.set_segment_cache(min(MAX_SEGMENT_CACHE_BYTES, segment_rows * row_bytes))
+
+
+def prefetch(iterable, depth=2):
+    """
+    Run an iterator in a background thread, buffering up to `depth` items.
+
+    Used for the reader stage, so tile windows are read and decoded while
+    the previous tiles are rasterized.
+
+    Parameters:
+    iterable: Items to produce
+    depth (int): Maximum number of buffered items
+
+    Yields:
+    Items of the iterable, in order
+    """
+    buffer = queue.Queue(maxsize=max(1, depth))
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                buffer.put((item, None))
+        except BaseException as e:
+            buffer.put((None, e))
+            return
+        buffer.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting on a full buffer
+        while thread.is_alive():
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=0.01)
+
+
+def read_tiles(reader, windows):
+    """
+    Reader stage: read each tile window from the slide.
+
+    Parameters:
+    reader (SlideReader): Open slide reader
+    windows: Iterable of (tile_index, x_start, y_start, x_end, y_end)
+
+    Yields:
+    tuple: (window, tile) with the tile in BGR format
+    """
+    for window in windows:
+        _, x_start, y_start, x_end, y_end = window
+        yield window, reader.read_region(x_start, y_start, x_end - x_start, y_end - y_start)
+
+
+def polygon_rings(geometry, x_offset=0, y_offset=0):
+    """
+    Rings of a polygonal geometry in mask pixel coordinates.
+
+    Parameters:
+    geometry: Polygon, MultiPolygon or GeometryCollection; other parts are ignored
+    x_offset, y_offset (float): Origin of the mask in slide pixels
+
+    Returns:
+    list: Closed (n, 2) float arrays for every exterior and interior ring
+    """
+    if geometry.geom_type == 'Polygon':
+        polygons = [geometry]
+    elif geometry.geom_type in ('MultiPolygon', 'GeometryCollection'):
+        polygons = [part for part in geometry.geoms if part.geom_type == 'Polygon']
+    else:
+        return []
+
+    rings = []
+    for polygon in polygons:
+        if polygon.is_empty:
+            continue
+        for ring in [polygon.exterior, *polygon.interiors]:
+            rings.append(np.asarray(ring.coords)[:, :2] - [x_offset, y_offset])
+    return rings
+
+
+def fill_rings(mask, rings, value):
+    """
+    Fill rings into a mask with the even-odd rule, sampling at pixel centres.
+
+    Pixel (i, j) covers [i, i + 1) x [j, j + 1) and is filled when its
+    centre (i + 0.5, j + 0.5) lies inside an odd number of rings; centres on
+    a left or top edge count as inside, those on a right or bottom edge as
+    outside. A polygon therefore fills exactly the pixels whose centres it
+    contains, and polygons sharing an edge never fill the same pixel.
+    cv2.fillPoly instead fills the pixels under both ends of every span,
+    growing polygons by a pixel on their right and bottom edges.
+
+    Parameters:
+    mask (np.array): Mask to fill in place
+    rings (list): Closed (n, 2) arrays of ring vertices in mask pixel coordinates
+    value (int): Fill value
+    """
+    if not rings:
+        return
+    height, width = mask.shape[:2]
+    x0 = np.concatenate([ring[:-1, 0] for ring in rings])
+    y0 = np.concatenate([ring[:-1, 1] for ring in rings])
+    x1 = np.concatenate([ring[1:, 0] for ring in rings])
+    y1 = np.concatenate([ring[1:, 1] for ring in rings])
+
+    # Each edge crosses the centre lines y = row + 0.5 of the rows in [first_row, end_row)
+    first_row = np.clip(np.ceil(np.minimum(y0, y1) - 0.5), 0, height).astype(np.int64)
+    end_row = np.clip(np.ceil(np.maximum(y0, y1) - 0.5), 0, height).astype(np.int64)
+    counts = end_row - first_row
+    total = int(counts.sum())
+    if total == 0:
+        return
+    edges = np.repeat(np.arange(len(counts)), counts)
+    rows = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + first_row[edges]
+    crossing = x0[edges] + (rows + 0.5 - y0[edges]) * (
+        (x1[edges] - x0[edges]) / (y1[edges] - y0[edges]))
+
+    # Sorted along each row, crossings pair up into the spans inside an odd number of rings;
+    # a span [start, end) holds the pixels whose centres lie at or right of its first crossing
+    cols = np.clip(np.ceil(crossing - 0.5), 0, width).astype(np.int64)
+    order = np.lexsort((cols, rows))
+    rows = rows[order][0::2]
+    starts = cols[order][0::2]
+    ends = cols[order][1::2]
+    keep = starts < ends
+    rows, starts, ends = rows[keep], starts[keep], ends[keep]
+    lengths = ends - starts
+    if lengths.sum() < SHORT_SPAN_PIXELS * len(lengths):
+        # Many short spans, e.g. small objects: scatter their pixels in one call
+        span_rows = np.repeat(rows, lengths)
+        span_cols = np.arange(len(span_rows)) - np.repeat(np.cumsum(lengths) - lengths - starts,
+                                                          lengths)
+        mask[span_rows, span_cols] = value
+    else:
+        for row, start, end in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+            mask[row, start:end] = value
+
+
+def fill_geometries(mask, geometries, overlapping, x_offset, y_offset, values):
+    """
+    Fill polygons, including their holes, into a mask.
+
+    fill_rings applies the even-odd rule to all rings of a call, which
+    leaves holes empty but would also cut out the overlap of two annotations.
+    All rings of annotations with the same value that touch no other
+    annotation are therefore filled in a single call, and the others get one
+    call each. Values are filled in ascending order, so where annotations of
+    different classes overlap the higher value wins.
+
+    Parameters:
+    mask (np.array): Mask to fill in place
+    geometries (list): Polygonal geometries in slide pixels
+    overlapping (list): Per geometry, whether it may touch another one
+    x_offset, y_offset (float): Origin of the mask in slide pixels
+    values (list): Fill value of every geometry
+    """
+    order = np.argsort(np.asarray(values), kind='stable')
+    batched = []
+    batch_value = None
+    for position in order:
+        value = int(values[position])
+        if value != batch_value:
+            fill_rings(mask, batched, batch_value)
+            batched = []
+            batch_value = value
+        rings = polygon_rings(geometries[position], x_offset, y_offset)
+        if not rings:
+            continue
+        if overlapping[position]:
+            fill_rings(mask, rings, value)
+        else:
+            batched.extend(rings)
+    fill_rings(mask, batched, batch_value)
+
+
+class BufferPool:
+    """
+    Free list of equally shaped arrays reused from tile to tile.
+
+    A buffer handed to the writer threads is released once its tile is on
+    disk. When every buffer is still queued for writing a new one is
+    allocated instead of waiting, so a failed write can never stall the
+    pipeline; at most `max_free` released buffers are kept, which should
+    match the writer queue depth plus the tile being rasterized.
+
+    Parameters:
+    shape (tuple): Shape of the buffers
+    dtype: Data type of the buffers (default uint8)
+    max_free (int): Maximum number of released buffers kept for reuse
+    """
+
+    def __init__(self, shape, dtype=np.uint8, max_free=4):
+        self.shape = shape
+        self.dtype = dtype
+        self.max_free = max_free
+        self.allocations = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a buffer from the pool; its contents are undefined.
+
+        Returns:
+        np.array: Buffer of the pool's shape and dtype
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocations += 1
+        return np.empty(self.shape, dtype=self.dtype)
+
+    def release(self, buffer):
+        """
+        Return a buffer to the pool once nothing reads it any more.
+
+        Parameters:
+        buffer (np.array): Buffer obtained from acquire
+        """
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
+
+
+def pad_tile(tile, out):
+    """
+    Copy a border tile into the top-left corner of a full-sized buffer.
+
+    Parameters:
+    tile (np.array): Tile clipped to the slide, at most the size of out
+    out (np.array): Full-sized tile buffer; the area outside the tile is zeroed
+
+    Returns:
+    np.array: out
+    """
+    height, width = tile.shape[:2]
+    out[:height, :width] = tile
+    out[:height, width:] = 0
+    out[height:] = 0
+    return out
+
+
+def rasterize_tile_mask(annotation_index, x_start, y_start, x_end, y_end, tile_size,
+                        mask_value=255, background_value=0, out=None, metrics=None):
+    """
+    Rasterizer stage: build the mask of one tile from the annotations.
+
+    Parameters:
+    annotation_index (AnnotationIndex): Spatial index over the slide annotations
+    x_start, y_start, x_end, y_end (int): Tile window in slide pixels
+    tile_size (int): Size of the (padded) mask
+    mask_value (int): Pixel value for annotated regions in mask, unless the
+                      index holds per-annotation values
+    background_value (int): Pixel value for background in mask
+    out (np.array): Reusable (tile_size, tile_size) uint8 buffer to draw into
+                    (default None, a new mask is allocated)
+    metrics (PipelineMetrics): Records 'geometry' and 'rasterize' time if given
+
+    Returns:
+    tuple: (mask, has_annotation)
+    """
+    if out is None:
+        mask = np.full((tile_size, tile_size), background_value, dtype=np.uint8)
+    else:
+        mask = out
+        mask[...] = background_value
+
+    with timed(metrics, 'geometry'):
+        tile_bbox = Polygon([
+            [x_start, y_start],
+            [x_end, y_start],
+            [x_end, y_end],
+            [x_start, y_end],
+            [x_start, y_start]
+        ])
+
+        # Only annotations returned by the spatial index can intersect
+        indices = annotation_index.query_indices(x_start, y_start, x_end, y_end)
+
+        # Clip to the tile
+        clipped = [annotation_index.annotations[i].intersection(tile_bbox) for i in indices]
+
+    with timed(metrics, 'rasterize'):
+        # Fill all rings, holes included
+        fill_geometries(mask, clipped, annotation_index.overlapping[indices],
+                        x_start, y_start, annotation_index.mask_values(indices, mask_value))
+
+        # Keep the padding outside the slide background
+        mask[:, x_end - x_start:] = background_value
+        mask[y_end - y_start:, :] = background_value
+
+    return mask, len(indices) > 0
+
+
+class BandMaskRasterizer:
+    """
+    Rasterizer stage that fills every annotation once per band of tile rows.
+
+    Instead of clipping each annotation against every tile it overlaps, the
+    annotations of a band of tile rows are filled into one mask covering the
+    full slide width, and tile masks are sliced out of it as views. Slides
+    whose mask fits in `max_band_bytes` are rasterized in a single band.
+
+    Tiles must be requested in row-major order; a band is rasterized when its
+    first tile is requested. Masks handed to writers keep their band alive,
+    so each band gets a new buffer.
+
+    Parameters:
+    annotation_index (AnnotationIndex): Spatial index over the slide annotations
+    slide_width (int): Slide width in pixels
+    slide_height (int): Slide height in pixels
+    tile_size (int): Size of tiles
+    mask_value (int): Pixel value for annotated regions in mask
+    background_value (int): Pixel value for background in mask
+    max_band_bytes (int): Maximum size of one mask band
+    stride (int): Distance between tile origins (default tile_size)
+    """
+
+    def __init__(self, annotation_index, slide_width, slide_height, tile_size,
+                 mask_value=255, background_value=0, max_band_bytes=MAX_MASK_BAND_BYTES,
+                 stride=None):
+        self.annotation_index = annotation_index
+        self.slide_width = slide_width
+        self.slide_height = slide_height
+        self.tile_size = tile_size
+        self.stride = stride or tile_size
+        self.mask_value = mask_value
+        self.background_value = background_value
+        num_tiles_x, self.num_tiles_y = tile_grid_size(slide_width, slide_height,
+                                                       tile_size, self.stride)
+        self.band_width = (num_tiles_x - 1) * self.stride + tile_size
+        max_band_height = max_band_bytes // self.band_width
+        self.band_rows = max(1, min(self.num_tiles_y,
+                                    (max_band_height - tile_size) // self.stride + 1))
+        self._band_start = None
+        self._band = None
+
+    def _rasterize_band(self, band_start):
+        rows = min(self.band_rows, self.num_tiles_y - band_start)
+        y_start = band_start * self.stride
+        band_height = (rows - 1) * self.stride + self.tile_size
+        y_end = min(y_start + band_height, self.slide_height)
+        band = np.full((band_height, self.band_width), self.background_value, dtype=np.uint8)
+
+        # Fill in band coordinates; fill_rings clips polygons to the band
+        indices = self.annotation_index.query_indices(0, y_start, self.slide_width, y_end)
+        fill_geometries(band, [self.annotation_index.annotations[i] for i in indices],
+                        self.annotation_index.overlapping[indices], 0, y_start,
+                        self.annotation_index.mask_values(indices, self.mask_value))
+
+        # Padding outside the slide stays background, as with clipped polygons
+        band[:, self.slide_width:] = self.background_value
+        band[y_end - y_start:, :] = self.background_value
+        return band
+
+    def tile_mask(self, x_start, y_start, x_end, y_end):
+        """
+        Mask of one tile, sliced from the band containing it.
+
+        Parameters:
+        x_start, y_start, x_end, y_end (int): Tile window in slide pixels
+
+        Returns:
+        tuple: (mask view of shape (tile_size, tile_size), has_annotation)
+        """
+        row = y_start // self.stride
+        band_start = row - row % self.band_rows
+        if band_start != self._band_start:
+            self._band = self._rasterize_band(band_start)
+            self._band_start = band_start
+
+        band_y = y_start - band_start * self.stride
+        mask = self._band[band_y:band_y + self.tile_size, x_start:x_start + self.tile_size]
+        has_annotation = bool(self.annotation_index.query_indices(x_start, y_start, x_end, y_end))
+        return mask, has_annotation
+
+
+def write_file_atomic(path, data):
+    """
+    Write bytes to a temporary file and rename it into place.
+
+    Parameters:
+    path (str): Output file path
+    data (bytes): File contents
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class TileWriterPool:
+    """
+    Thread pool that encodes and writes images.
+
+    OpenCV releases the GIL while encoding, so writes run in parallel with
+    reading and rasterizing. At most `max_pending` writes are queued; further
+    submissions block until a writer is free (back-pressure), which bounds
+    the memory held by queued tiles. With `workers=0` images are written
+    synchronously.
+
+    Each file is encoded in memory and moved into place with an atomic
+    rename, so a file that exists on disk is always complete.
+
+    Parameters:
+    workers (int): Number of encoder/writer threads
+    max_pending (int): Maximum number of queued writes (default 2 * workers)
+    """
+
+    def __init__(self, workers=DEFAULT_ENCODE_WORKERS, max_pending=None):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.max_pending = max_pending or max(1, 2 * workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._error = None
+
+    def _write_file(self, path, image):
+        ok, encoded = cv2.imencode(os.path.splitext(path)[1], image)
+        if not ok:
+            raise IOError(f"Could not encode image for {path}")
+        write_file_atomic(path, encoded.tobytes())
+
+    def _write_files(self, files):
+        for path, image in files:
+            self._write_file(path, image)
+
+    def _run(self, func, args, on_done):
+        func(*args)
+        if on_done is not None:
+            on_done()
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def run(self, func, *args, on_done=None):
+        """
+        Queue a write task, e.g. encoding a tile and appending it to a container.
+
+        Parameters:
+        func (callable): Task to run in a writer thread as func(*args)
+        on_done (callable): Called without arguments after the task succeeded
+        """
+        if self._error is not None:
+            raise self._error
+        if self._executor is None:
+            self._run(func, args, on_done)
+            return
+        self._slots.acquire()
+        future = self._executor.submit(self._run, func, args, on_done)
+        future.add_done_callback(self._done)
+
+    def submit(self, files, on_done=None):
+        """
+        Queue a group of images to be encoded and written.
+
+        The images must not be modified after they have been submitted.
+
+        Parameters:
+        files (list): List of (path, image) pairs; the format is chosen from the extension
+        on_done (callable): Called without arguments once every file of the group is written
+        """
+        self.run(self._write_files, files, on_done=on_done)
+
+    def write(self, path, image):
+        """
+        Queue an image to be encoded and written to path.
+
+        Parameters:
+        path (str): Output file path (format chosen from the extension)
+        image (np.array): Image to write
+        """
+        self.submit([(path, image)])
+
+    def close(self):
+        """Wait for all queued writes and raise the first write error, if any."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def _release_buffers(buffers):
+    for pool, buffer in buffers:
+        pool.release(buffer)
+
+
+def _tile_written(buffers, on_tile_done, tile_index):
+    # Writer callback: the tile is on disk, so its buffers can be reused
+    _release_buffers(buffers)
+    if on_tile_done is not None:
+        on_tile_done(tile_index, True)
+
+
+def run_tile_pipeline(slide_path, annotation_index, sink, tile_size=2000,
+                      mask_value=255, background_value=0, save_only_annotated=False, level=0,
+                      completed_tiles=None, on_tile_done=None,
+                      skip_background=False, min_tissue_fraction=0.05, mask_mode='tile',
+                      stride=None, annotation_bounds=None, max_negative_patches=100,
+                      sampling_seed=0, metrics=None, slide_cache=None):
+    """
+    Tile a slide into images and masks with a producer/consumer pipeline.
+
+    A reader thread decodes tile windows ahead of the rasterizer, the calling
+    thread builds each mask, and the sink encodes and writes the outputs in
+    its TileWriterPool with a bounded queue.
+
+    Parameters:
+    slide_path (str): Path to the whole slide image
+    annotation_index (AnnotationIndex): Spatial index over the slide annotations
+    sink: Output sink (see output_formats.create_tile_sink); closed when done
+    tile_size (int): Size of output tiles (default 2000x2000)
+    mask_value (int): Pixel value for annotated regions in mask (default 255)
+    background_value (int): Pixel value for background in mask (default 0)
+    save_only_annotated (bool): If True, only save tiles that contain annotations
+    level (int): Pyramid level to tile; annotations must be in its coordinates
+    completed_tiles (dict): Tiles finished by an earlier run, mapping tile index
+                            to whether it was saved; these are not read or written again
+    on_tile_done (callable): Called as on_tile_done(tile_index, saved) once a tile
+                             and its mask are on disk (or the tile was skipped)
+    skip_background (bool): If True, detect tissue on a thumbnail first and skip
+                            tiles without annotations whose tissue fraction is
+                            below min_tissue_fraction, before they are decoded
+    min_tissue_fraction (float): Minimum tissue fraction of a kept tile (default 0.05)
+    mask_mode (str): 'tile' clips the annotations against each tile (default);
+                     'band' rasterizes them once per band of tile rows and slices
+                     the tile masks out of it (see BandMaskRasterizer)
+    stride (int): Distance between tile origins (default tile_size). A smaller
+                  stride gives overlapping tiles; decoded slide segments are then
+                  cached so the overlap is read and decoded only once
+    annotation_bounds (list): Bounding boxes of the annotations. If given, patches
+                              are cut around them (see sample_annotation_windows)
+                              instead of tiling the whole slide
+    max_negative_patches (int): Maximum number of sampled patches without annotations
+    sampling_seed (int): Seed of the negative patch sampler
+    metrics (PipelineMetrics): If given, per-stage times and bytes read are recorded
+                               (see instrumentation.PipelineMetrics)
+    slide_cache (SlideCache): If given, tiles are read from the decoded level in this
+                              on-disk cache, which is filled on first use
+
+    Returns:
+    dict: Counts of total, annotated, saved and skipped background tiles
+    """
+    if mask_mode not in MASK_MODES:
+        raise ValueError(f"Unknown mask mode '{mask_mode}' (choose from {', '.join(MASK_MODES)})")
+    if mask_mode == 'band' and annotation_bounds is not None:
+        raise ValueError("mask_mode 'band' needs the tile grid and cannot be used with sampled patches")
+
+    processed_tiles = 0
+    saved_tiles = 0
+    tiles_with_annotations = 0
+    background_skipped = 0
+
+    with SlideReader(slide_path, level, cache=slide_cache) as reader, sink:
+        reader.metrics = metrics
+        slide_width, slide_height = reader.dimensions
+        print(f"Slide dimensions: {slide_width} x {slide_height}"
+              + (f" (level {level}, downsample {reader.downsample[0]:.2f})" if level else ""))
+
+        # Tissue pre-pass on a thumbnail, so glass tiles are never decoded
+        tissue_mask = None
+        if skip_background:
+            with timed(metrics, 'tissue'):
+                tissue_mask = detect_tissue(slide_path, level=level)
+
+        # Calculate number of tiles needed
+        stride = stride or tile_size
+        if annotation_bounds is not None:
+            tile_windows, num_positive = sample_annotation_windows(
+                annotation_bounds, annotation_index, slide_width, slide_height, tile_size,
+                max_negative_patches=max_negative_patches, seed=sampling_seed,
+                tissue_mask=tissue_mask, min_tissue_fraction=min_tissue_fraction
+            )
+            total_tiles = len(tile_windows)
+            print(f"Will process {total_tiles} sampled patches ({num_positive} around annotations, "
+                  f"{total_tiles - num_positive} negative)")
+        else:
+            num_tiles_x, num_tiles_y = tile_grid_size(slide_width, slide_height, tile_size, stride)
+            tile_windows = iter_tile_windows(slide_width, slide_height, tile_size, stride)
+            total_tiles = num_tiles_x * num_tiles_y
+            print(f"Will process {num_tiles_x} x {num_tiles_y} = {total_tiles} tiles"
+                  + (f" (stride {stride}, overlap {tile_size - stride})" if stride < tile_size else ""))
+
+        # Overlapping tiles and patches share segments; cache a band of segment rows
+        if stride < tile_size or annotation_bounds is not None:
+            cache_overlapping_segments(reader, tile_size)
+        if save_only_annotated:
+            print("Only saving tiles with annotations")
+
+        band_rasterizer = None
+        if mask_mode == 'band':
+            band_rasterizer = BandMaskRasterizer(
+                annotation_index, slide_width, slide_height, tile_size,
+                mask_value=mask_value, background_value=background_value, stride=stride
+            )
+            print(f"Rasterizing masks in bands of {band_rasterizer.band_rows} tile rows")
+
+        # Decide which tiles need reading: tiles finished by an earlier run
+        # and background tiles only need their counts
+        windows = []
+        for window in tile_windows:
+            tile_index, x_start, y_start, x_end, y_end = window
+            if completed_tiles and tile_index in completed_tiles:
+                if annotation_index.query_indices(x_start, y_start, x_end, y_end):
+                    tiles_with_annotations += 1
+                saved_tiles += int(completed_tiles[tile_index])
+                processed_tiles += 1
+            elif (tissue_mask is not None and
+                    tissue_mask.fraction(x_start, y_start, x_end, y_end) < min_tissue_fraction and
+                    not annotation_index.query_indices(x_start, y_start, x_end, y_end)):
+                background_skipped += 1
+                processed_tiles += 1
+            else:
+                windows.append(window)
+
+        if completed_tiles:
+            print(f"Resuming: {len(completed_tiles)} tiles already done")
+        if tissue_mask is not None:
+            print(f"Skipping {background_skipped} background tiles without tissue")
+
+        # Border tiles and masks are drawn into buffers that are reused once
+        # written; one per queued write plus the tile being rasterized
+        pool_depth = sink.writer.max_pending + 1
+        tile_buffers = BufferPool((tile_size, tile_size, 3), max_free=pool_depth)
+        mask_buffers = BufferPool((tile_size, tile_size), max_free=pool_depth)
+
+        with closing(prefetch(read_tiles(reader, windows))) as tiles:
+            for window, tile in tiles:
+                tile_index, x_start, y_start, x_end, y_end = window
+                buffers = []
+
+                # Interior tiles are written as read; only border tiles are padded
+                if tile.shape[:2] == (tile_size, tile_size) and tile.dtype == np.uint8:
+                    tile_full = tile
+                else:
+                    tile_full = pad_tile(tile, tile_buffers.acquire())
+                    buffers.append((tile_buffers, tile_full))
+
+                if band_rasterizer is not None:
+                    with timed(metrics, 'rasterize'):
+                        mask, has_annotation = band_rasterizer.tile_mask(x_start, y_start,
+                                                                         x_end, y_end)
+                else:
+                    mask, has_annotation = rasterize_tile_mask(
+                        annotation_index, x_start, y_start, x_end, y_end, tile_size,
+                        mask_value=mask_value, background_value=background_value,
+                        out=mask_buffers.acquire(), metrics=metrics
+                    )
+                    buffers.append((mask_buffers, mask))
+
+                # Decide whether to save this tile
+                should_save = not save_only_annotated or has_annotation
+
+                if should_save:
+                    # Save tile and mask with Da{tile_index} naming
+                    on_done = functools.partial(_tile_written, buffers, on_tile_done, tile_index)
+                    # Blocks while the writer queue is full (or writes, without writer threads)
+                    with timed(metrics, 'writer_wait'):
+                        sink.write_tile(tile_index, tile_full, mask, on_done=on_done)
+                    saved_tiles += 1
+                else:
+                    _release_buffers(buffers)
+                    if on_tile_done is not None:
+                        on_tile_done(tile_index, False)
+
+                if has_annotation:
+                    tiles_with_annotations += 1
+
+                processed_tiles += 1
+
+                if processed_tiles % 100 == 0:
+                    print(f"  Processed {processed_tiles}/{total_tiles} tiles "
+                          f"({tiles_with_annotations} with annotations, {saved_tiles} saved)")
+
+        if reader.cache_hits:
+            print(f"Reused {reader.cache_hits} of {reader.cache_hits + reader.cache_misses} "
+                  f"decoded slide segments across overlapping tiles")
+
+    return {
+        'total_tiles': processed_tiles,
+        'tiles_with_annotations': tiles_with_annotations,
+        'saved_tiles': saved_tiles,
+        'background_tiles_skipped': background_skipped,
+    }
@@ -0,0 +1,137 @@
+import numpy as np
+import cv2
+
+from slide_reader import SlideReader
+
+
+def read_thumbnail(slide_path, level=0, thumbnail_size=2048, block_size=4096):
+    """
+    Read a low-resolution overview of a slide.
+
+    The lowest-resolution pyramid level that is at least 1024 px on its longer
+    side (and no finer than `level`) is read. If it is still larger than `thumbnail_size`,
+    e.g. for slides without a pyramid, it is downsampled block by block so the
+    full-resolution image is never held in memory.
+
+    Parameters:
+    slide_path (str): Path to slide image
+    level (int): Pyramid level being tiled
+    thumbnail_size (int): Maximum thumbnail width/height in pixels
+    block_size (int): Size of the blocks read when downsampling
+
+    Returns:
+    tuple: (thumbnail in BGR format, (x, y) downsample relative to `level`)
+    """
+    with SlideReader(slide_path, level) as tiled:
+        level_count = tiled.level_count
+        tiled_downsample = tiled.downsample
+
+    # Lowest-resolution level that still shows enough detail
+    source_level = level
+    for candidate in range(level_count - 1, level, -1):
+        with SlideReader(slide_path, candidate) as reader:
+            if max(reader.dimensions) >= 1024:
+                source_level = candidate
+                break
+
+    with SlideReader(slide_path, source_level) as reader:
+        width, height = reader.dimensions
+        factor = max(1.0, max(width, height) / thumbnail_size)
+        thumb_width = max(1, int(round(width / factor)))
+        thumb_height = max(1, int(round(height / factor)))
+
+        if factor == 1.0:
+            thumbnail = reader.read_region(0, 0, width, height)
+        else:
+            thumbnail = np.zeros((thumb_height, thumb_width, 3), dtype=np.uint8)
+            for y in range(0, height, block_size):
+                for x in range(0, width, block_size):
+                    block = reader.read_region(x, y, block_size, block_size)
+                    x0 = int(round(x / factor))
+                    y0 = int(round(y / factor))
+                    x1 = min(thumb_width, int(round((x + block.shape[1]) / factor)))
+                    y1 = min(thumb_height, int(round((y + block.shape[0]) / factor)))
+                    if x1 > x0 and y1 > y0:
+                        thumbnail[y0:y1, x0:x1] = cv2.resize(
+                            block, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+
+        downsample = (reader.downsample[0] * width / thumb_width / tiled_downsample[0],
+                      reader.downsample[1] * height / thumb_height / tiled_downsample[1])
+
+    return thumbnail, downsample
+
+
+class TissueMask:
+    """
+    Binary tissue mask of a slide at thumbnail resolution.
+
+    Tissue fractions of tile windows are looked up in constant time from an
+    integral image, so the occupancy of every tile can be decided before any
+    full-resolution pixel is decoded.
+
+    Parameters:
+    mask (np.array): Binary mask (non-zero = tissue) at thumbnail resolution
+    downsample (tuple): (x, y) downsample of the mask relative to the tiled level
+    """
+
+    def __init__(self, mask, downsample):
+        self.mask = (mask > 0).astype(np.uint8)
+        self.downsample = downsample
+        self._integral = cv2.integral(self.mask)
+
+    def fraction(self, x_start, y_start, x_end, y_end):
+        """
+        Fraction of tissue pixels inside a window of the tiled level.
+
+        Parameters:
+        x_start, y_start, x_end, y_end (int): Window in pixels of the tiled level
+
+        Returns:
+        float: Tissue fraction between 0 and 1
+        """
+        height, width = self.mask.shape
+        x0 = min(width, max(0, int(x_start / self.downsample[0])))
+        y0 = min(height, max(0, int(y_start / self.downsample[1])))
+        x1 = min(width, max(x0 + 1, int(np.ceil(x_end / self.downsample[0]))))
+        y1 = min(height, max(y0 + 1, int(np.ceil(y_end / self.downsample[1]))))
+        if x1 <= x0 or y1 <= y0:
+            return 0.0
+        total = (self._integral[y1, x1] - self._integral[y0, x1]
+                 - self._integral[y1, x0] + self._integral[y0, x0])
+        return float(total) / ((x1 - x0) * (y1 - y0))
+
+
+def detect_tissue(slide_path, level=0, thumbnail_size=2048, min_saturation=15):
+    """
+    Detect tissue on a low-resolution thumbnail with Otsu thresholding.
+
+    Stained tissue is saturated while glass is white or grey, so the
+    saturation channel is thresholded with Otsu's method. The threshold is
+    never lower than `min_saturation`, so blank slides are not turned into
+    tissue by a threshold fitted to noise.
+
+    Parameters:
+    slide_path (str): Path to slide image
+    level (int): Pyramid level being tiled
+    thumbnail_size (int): Maximum thumbnail width/height in pixels
+    min_saturation (int): Lower bound for the saturation threshold (0-255)
+
+    Returns:
+    TissueMask: Tissue mask with tile fraction lookups in tiled-level coordinates
+    """
+    thumbnail, downsample = read_thumbnail(slide_path, level=level, thumbnail_size=thumbnail_size)
+
+    saturation = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2HSV)[:, :, 1]
+    saturation = cv2.GaussianBlur(saturation, (5, 5), 0)
+    otsu_threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    threshold = max(otsu_threshold, min_saturation)
+    mask = (saturation > threshold).astype(np.uint8)
+
+    # Close small gaps inside tissue and drop isolated specks
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+
+    print(f"Tissue detection: threshold {threshold:.0f} on {thumbnail.shape[1]} x "
+          f"{thumbnail.shape[0]} thumbnail, {mask.mean() * 100:.1f}% tissue")
+    return TissueMask(mask, downsample)
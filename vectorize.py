@@ -0,0 +1,542 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+import shapely
+from shapely import STRtree
+
+from geojson_loader import parse_class_values
+from manifest import SlideManifest
+from output_formats import MaskReader
+from slide_reader import SlideReader
+from tile_pipeline import tile_grid_size
+
+
+# Boundary edge directions east, south, west, north in image coordinates (y down),
+# with the turn to the left and to the right of each
+EDGE_DX = np.array([1, 0, -1, 0])
+EDGE_DY = np.array([0, 1, 0, -1])
+TURN_LEFT = np.array([3, 0, 1, 2])
+TURN_RIGHT = np.array([1, 2, 3, 0])
+
+DEFAULT_VECTORIZE_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def pixel_edge_polygons(foreground, x_offset=0, y_offset=0):
+    """
+    Outline the connected regions of a binary mask along pixel edges.
+
+    Every boundary edge between a foreground and a background pixel is
+    directed with the foreground on its left, and the edges are linked into
+    rings at the pixel corners. Regions are 4-connected: pixels touching only
+    at a corner belong to separate polygons, unless they are connected
+    elsewhere, in which case the enclosed background becomes a hole touching
+    the outline at that corner. Rasterizing the polygons at pixel centres,
+    as tile_pipeline.fill_geometries does, gives back the mask exactly, and
+    outlines cut at a tile border share the border edge with the next tile.
+
+    Rings are linked with vectorized pointer jumping instead of a walk per
+    pixel, so the cost grows linearly with the number of boundary edges,
+    also for speckled masks.
+
+    Parameters:
+    foreground (np.array): 2D boolean mask
+    x_offset, y_offset (int): Position of the mask in the slide
+
+    Returns:
+    np.array: Shapely polygons (with holes) in slide coordinates, one per region
+    """
+    height, width = foreground.shape
+    padded = np.zeros((height + 2, width + 2), dtype=bool)
+    padded[1:-1, 1:-1] = foreground
+    above, below = padded[:-1, 1:-1], padded[1:, 1:-1]
+    left, right = padded[1:-1, :-1], padded[1:-1, 1:]
+
+    # Start corner (x, y) and direction of every boundary edge
+    starts_x, starts_y, directions = [], [], []
+    for edges, dx, dy, direction in ((above & ~below, 0, 0, 0), (right & ~left, 0, 0, 1),
+                                     (below & ~above, 1, 0, 2), (left & ~right, 0, 1, 3)):
+        rows, cols = np.nonzero(edges)
+        starts_x.append(cols + dx)
+        starts_y.append(rows + dy)
+        directions.append(np.full(len(rows), direction))
+    x = np.concatenate(starts_x)
+    y = np.concatenate(starts_y)
+    d = np.concatenate(directions)
+    num_edges = len(x)
+    if num_edges == 0:
+        return np.array([], dtype=object)
+
+    # Successor of every edge: the edge leaving its end corner. Corners where two
+    # regions meet diagonally have two; turning left keeps different regions apart,
+    # turning right joins two pixels of the same region
+    corners_across = width + 1
+    outgoing = np.full(((height + 1) * corners_across, 4), -1, dtype=np.int64)
+    outgoing[y * corners_across + x, d] = np.arange(num_edges)
+    end_x, end_y = x + EDGE_DX[d], y + EDGE_DY[d]
+    end = end_y * corners_across + end_x
+    successor = outgoing[end, TURN_LEFT[d]]
+    for turn in (d, TURN_RIGHT[d]):
+        missing = successor < 0
+        successor[missing] = outgoing[end[missing], turn[missing]]
+
+    _, components = cv2.connectedComponents(foreground.astype(np.uint8), connectivity=4)
+    labels = np.zeros((height + 2, width + 2), dtype=np.int32)
+    labels[1:-1, 1:-1] = components
+    top_left, top_right = labels[end_y, end_x], labels[end_y, end_x + 1]
+    bottom_left, bottom_right = labels[end_y + 1, end_x], labels[end_y + 1, end_x + 1]
+    joined = (((top_left > 0) & (top_left == bottom_right) & (top_right == 0) & (bottom_left == 0)) |
+              ((top_right > 0) & (top_right == bottom_left) & (top_left == 0) & (bottom_right == 0)))
+    successor[joined] = outgoing[end[joined], TURN_RIGHT[d[joined]]]
+
+    # Ring of every edge (its smallest edge index) and its position in the ring,
+    # both by pointer jumping
+    edge_ids = np.arange(num_edges)
+    ring = edge_ids.copy()
+    jump = successor.copy()
+    span = 1
+    while span < num_edges:
+        ring = np.minimum(ring, ring[jump])
+        jump = jump[jump]
+        span *= 2
+    last = ring[successor] == successor
+    jump = np.where(last, edge_ids, successor)
+    steps_to_last = (~last).astype(np.int64)
+    while True:
+        steps_to_last += steps_to_last[jump]
+        next_jump = jump[jump]
+        if np.array_equal(next_jump, jump):
+            break
+        jump = next_jump
+    order = np.lexsort((-steps_to_last, ring))
+    x, y, d, ring = x[order], y[order], d[order], ring[order]
+
+    # Keep the corners where a ring turns
+    first = np.r_[True, ring[1:] != ring[:-1]]
+    corner = first | (d != np.r_[-1, d[:-1]])
+    coords = np.stack([x[corner] + x_offset, y[corner] + y_offset], axis=1).astype(np.float64)
+    rings = shapely.linearrings(coords, indices=np.cumsum(first[corner]) - 1)
+
+    # Each ring bounds the region of the pixel left of its first edge; outlines run
+    # clockwise (as seen with y up) and holes counter-clockwise
+    first_x, first_y, first_d = x[first], y[first], d[first]
+    pixel_x = np.choose(first_d, [first_x, first_x, first_x - 1, first_x - 1])
+    pixel_y = np.choose(first_d, [first_y - 1, first_y, first_y, first_y - 1])
+    region = components[pixel_y, pixel_x]
+    order = np.lexsort((shapely.is_ccw(rings), region))
+    _, polygon_index = np.unique(region[order], return_inverse=True)
+    return shapely.polygons(rings[order], indices=polygon_index)
+
+
+def mask_polygons(mask, x_offset=0, y_offset=0, background_value=0, threshold=None,
+                  label_values=False):
+    """
+    Outline the foreground of a mask as polygons (see pixel_edge_polygons).
+
+    Outlines follow pixel edges exactly and keep holes (e.g. vessel lumens).
+
+    Parameters:
+    mask (np.array): 2D mask
+    x_offset, y_offset (int): Position of the mask in the slide
+    background_value (int): Background value of the mask (default 0)
+    threshold (int): If given, pixels >= threshold are foreground (e.g. for
+                     probability maps) instead of pixels != background_value
+    label_values (bool): Trace every mask value separately, for multi-class
+                         label masks
+
+    Returns:
+    list: (value, polygon) pairs in slide coordinates; value is None unless label_values
+    """
+    if threshold is not None:
+        groups = [(None, mask >= threshold)]
+    elif label_values:
+        groups = [(int(value), mask == value) for value in np.unique(mask)
+                  if value != background_value]
+    else:
+        groups = [(None, mask != background_value)]
+
+    polygons = []
+    for value, foreground in groups:
+        polygons.extend((value, polygon) for polygon
+                        in pixel_edge_polygons(foreground, x_offset, y_offset))
+    return polygons
+
+
+def merge_polygons(polygons):
+    """
+    Merge polygons of the same value that share an edge or overlap.
+
+    Polygons touching only at a corner stay apart, as within a tile
+    (see pixel_edge_polygons).
+
+    Parameters:
+    polygons (list): (value, polygon) pairs
+
+    Returns:
+    list: (value, polygon) pairs, one per connected group
+    """
+    merged = []
+    for value in {value for value, _ in polygons}:
+        geometries = np.array([polygon for v, polygon in polygons if v == value], dtype=object)
+        if len(geometries) == 1:
+            merged.append((value, geometries[0]))
+            continue
+        # Connected groups of polygons sharing more than a corner, by union-find over the index pairs
+        left, right = STRtree(geometries).query(geometries, predicate='intersects')
+        sharing = (shapely.relate_pattern(geometries[left], geometries[right], 'T********') |
+                   shapely.relate_pattern(geometries[left], geometries[right], '****1****'))
+        left, right = left[sharing], right[sharing]
+        parent = np.arange(len(geometries))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, j in zip(left, right):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[root_j] = root_i
+        groups = {}
+        for i in range(len(geometries)):
+            groups.setdefault(find(i), []).append(i)
+        for members in groups.values():
+            if len(members) == 1:
+                merged.append((value, geometries[members[0]]))
+            else:
+                merged.append((value, shapely.union_all(geometries[members])))
+    return merged
+
+
+class GeoJSONFeatureWriter:
+    """
+    Stream QuPath annotations into a GeoJSON FeatureCollection.
+
+    Features are written as they arrive, so no polygon is kept after it is
+    written. The file is written under a temporary name and renamed on close.
+
+    Parameters:
+    path (str): Output path
+    object_type (str): QuPath object type, 'annotation' (default) or 'detection'
+    """
+
+    def __init__(self, path, object_type='annotation'):
+        self.path = path
+        self.object_type = object_type
+        self.count = 0
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'w')
+        self._file.write('{"type": "FeatureCollection", "features": [\n')
+
+    def write(self, geometries, class_name=None):
+        """
+        Write polygons as features of one class.
+
+        Parameters:
+        geometries (list): Shapely polygons or multipolygons
+        class_name (str): QuPath classification (default None, unclassified)
+        """
+        properties = {'objectType': self.object_type}
+        if class_name:
+            properties['classification'] = {'name': class_name}
+        properties = json.dumps(properties)
+        for geometry in shapely.to_geojson(np.array(geometries, dtype=object)):
+            self._file.write(('' if self.count == 0 else ',\n')
+                             + f'{{"type": "Feature", "geometry": {geometry}, "properties": {properties}}}')
+            self.count += 1
+
+    def close(self):
+        """Finish the FeatureCollection and move it into place."""
+        self._file.write('\n]}\n')
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+
+def output_tile_layout(slide_width, slide_height, tile_size, stride=None):
+    """
+    Tile rows of an output directory, with the part of every tile that is traced.
+
+    Overlapping tiles are cut back to their first `stride` pixels (the last
+    row and column keep the rest), so the traced cores partition the slide.
+
+    Parameters:
+    slide_width (int): Width of the tiled level
+    slide_height (int): Height of the tiled level
+    tile_size (int): Size of tiles
+    stride (int): Distance between tile origins (default tile_size)
+
+    Returns:
+    list: Rows of (tile_index, x_start, y_start, x_end, y_end) cores in slide coordinates
+    """
+    stride = stride or tile_size
+    num_tiles_x, num_tiles_y = tile_grid_size(slide_width, slide_height, tile_size, stride)
+    rows = []
+    for row in range(num_tiles_y):
+        y_start = row * stride
+        y_end = min(y_start + (stride if row < num_tiles_y - 1 else tile_size), slide_height)
+        cores = []
+        for col in range(num_tiles_x):
+            x_start = col * stride
+            x_end = min(x_start + (stride if col < num_tiles_x - 1 else tile_size), slide_width)
+            cores.append((row * num_tiles_x + col, x_start, y_start, x_end, y_end))
+        rows.append(cores)
+    return rows
+
+
+def vectorize_tiles(rows, read_mask, output_path, slide_width, slide_height,
+                    background_value=0, threshold=None, class_names=None, class_name=None,
+                    downsample=(1.0, 1.0), min_area=0, simplify=0, workers=DEFAULT_VECTORIZE_WORKERS):
+    """
+    Trace mask tiles into polygons, merge them across tile borders and stream them to GeoJSON.
+
+    Tiles are traced in parallel one row ahead. Polygons inside a tile are
+    written at once; polygons touching an inner tile border wait until their
+    neighbours are traced, are merged with them, and are written as soon as
+    they cannot grow any further. Only polygons along the current tile row
+    are held in memory.
+
+    Parameters:
+    rows (list): Rows of (tile_index, x_start, y_start, x_end, y_end) cores
+                 (see output_tile_layout)
+    read_mask (callable): read_mask(tile_index, x_start, y_start, x_end, y_end) returns
+                          the mask of the core (or a larger mask with the core at its
+                          top-left), or None for tiles that were not saved
+    output_path (str): Path of the GeoJSON file
+    slide_width (int): Width of the traced level
+    slide_height (int): Height of the traced level
+    background_value (int): Background value of the masks (default 0)
+    threshold (int): If given, pixels >= threshold are foreground (probability maps)
+    class_names (dict): Class name per mask value, to trace label masks per class
+    class_name (str): Classification of all polygons without class_names (default None)
+    downsample (tuple): (x, y) downsample of the traced level; coordinates are
+                        scaled to level 0 for QuPath
+    min_area (float): Drop polygons smaller than this, in level 0 pixels (default 0)
+    simplify (float): Douglas-Peucker tolerance in level 0 pixels (default 0, none)
+    workers (int): Tracing threads (default up to 4)
+
+    Returns:
+    dict: Counts of tiles and features
+    """
+    label_values = threshold is None and bool(class_names)
+    scale = np.array(downsample, dtype=np.float64)
+
+    def trace(core):
+        tile_index, x_start, y_start, x_end, y_end = core
+        mask = read_mask(tile_index, x_start, y_start, x_end, y_end)
+        if mask is None:
+            return [], []
+        mask = mask[:y_end - y_start, :x_end - x_start]
+        complete, touching = [], []
+        for value, polygon in mask_polygons(mask, x_start, y_start, background_value,
+                                            threshold, label_values):
+            min_x, min_y, max_x, max_y = polygon.bounds
+            # Edges shared with another tile; the slide border needs no merging
+            if ((x_start > 0 and min_x <= x_start + 0.5) or
+                    (y_start > 0 and min_y <= y_start + 0.5) or
+                    (x_end < slide_width and max_x >= x_end - 0.5) or
+                    (y_end < slide_height and max_y >= y_end - 0.5)):
+                touching.append((value, polygon))
+            else:
+                complete.append((value, polygon))
+        return complete, touching
+
+    def write(writer, polygons):
+        by_value = {}
+        for value, polygon in polygons:
+            by_value.setdefault(value, []).append(polygon)
+        for value, geometries in by_value.items():
+            geometries = np.array(geometries, dtype=object)
+            if tuple(downsample) != (1.0, 1.0):
+                geometries = shapely.transform(geometries, lambda coords: coords * scale)
+            if simplify:
+                geometries = shapely.simplify(geometries, simplify, preserve_topology=True)
+            if min_area:
+                geometries = geometries[shapely.area(geometries) >= min_area]
+            name = class_names.get(value) if label_values else class_name
+            writer.write(list(geometries), name)
+
+    tiles = 0
+    pending = []
+    with GeoJSONFeatureWriter(output_path) as writer, ThreadPoolExecutor(max(1, workers)) as pool:
+        futures = [pool.submit(trace, core) for core in rows[0]] if rows else []
+        for row_index, row in enumerate(rows):
+            # Trace the next row while this one is merged and written
+            results = [future.result() for future in futures]
+            futures = ([pool.submit(trace, core) for core in rows[row_index + 1]]
+                       if row_index + 1 < len(rows) else [])
+            for complete, touching in results:
+                write(writer, complete)
+                pending.extend(touching)
+            tiles += len(row)
+
+            pending = merge_polygons(pending)
+            row_end = row[0][4]
+            last_row = row_index == len(rows) - 1
+            done = [(value, polygon) for value, polygon in pending
+                    if last_row or polygon.bounds[3] < row_end - 0.5]
+            pending = [(value, polygon) for value, polygon in pending
+                       if not (last_row or polygon.bounds[3] < row_end - 0.5)]
+            write(writer, done)
+    return {'tiles': tiles, 'features': writer.count}
+
+
+def vectorize_slide_output(slide_output_dir, output_path, slide_width, slide_height,
+                           tile_size=None, stride=None, **kwargs):
+    """
+    Vectorize the masks of one slide output directory (any output format).
+
+    tile_size, stride, the background value and the class values default to
+    those recorded in the slide's manifest.
+
+    Parameters:
+    slide_output_dir (str): Output directory of the slide
+    output_path (str): Path of the GeoJSON file
+    slide_width (int): Width of the tiled level
+    slide_height (int): Height of the tiled level
+    tile_size (int): Size of the tiles (default from the manifest)
+    stride (int): Distance between tile origins (default from the manifest)
+    **kwargs: Further options of vectorize_tiles
+
+    Returns:
+    dict: Counts of tiles and features
+    """
+    params = (SlideManifest(slide_output_dir).header or {}).get('params', {})
+    if params.get('sampling', 'grid') != 'grid':
+        raise ValueError(f"{slide_output_dir} holds sampled patches, not a tile grid")
+    tile_size = tile_size or params.get('tile_size')
+    if tile_size is None:
+        raise ValueError(f"No manifest in {slide_output_dir}; pass the tile size")
+    stride = stride or params.get('stride') or tile_size
+    kwargs.setdefault('background_value', params.get('background_value', 0))
+    if params.get('class_values') and kwargs.get('threshold') is None:
+        # Label masks are traced per class unless a mapping was passed
+        kwargs.setdefault('class_names', {value: name for name, value
+                                          in params['class_values'].items()})
+
+    reader = MaskReader(slide_output_dir)
+    rows = output_tile_layout(slide_width, slide_height, tile_size, stride)
+    return vectorize_tiles(rows, lambda tile_index, *window: reader.read(tile_index),
+                           output_path, slide_width, slide_height, **kwargs)
+
+
+def vectorize_mask_image(mask_path, output_path, level=0, block_size=2048, **kwargs):
+    """
+    Vectorize a stitched mask image, e.g. a prediction TIFF from inference.py.
+
+    The image is read in block_size blocks, so it never has to fit in memory.
+    Coordinates are scaled to level 0 of the mask image.
+
+    Parameters:
+    mask_path (str): Path of the (pyramidal) mask TIFF
+    output_path (str): Path of the GeoJSON file
+    level (int): Pyramid level to trace (default 0)
+    block_size (int): Size of the traced blocks (default 2048)
+    **kwargs: Further options of vectorize_tiles
+
+    Returns:
+    dict: Counts of tiles and features
+    """
+    with SlideReader(mask_path, level) as reader:
+        width, height = reader.dimensions
+        kwargs.setdefault('downsample', reader.downsample)
+        rows = output_tile_layout(width, height, block_size)
+
+        def read_block(tile_index, x_start, y_start, x_end, y_end):
+            # Single-channel masks are read back as identical BGR channels
+            return reader.read_region(x_start, y_start, x_end - x_start, y_end - y_start)[:, :, 0]
+
+        return vectorize_tiles(rows, read_block, output_path, width, height, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Convert mask tiles or stitched masks into QuPath GeoJSON annotations'
+    )
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('--slide_output_dir',
+                              help='Output directory of one slide from the tiling scripts (any output format)')
+    source_group.add_argument('--mask',
+                              help='Stitched mask or probability TIFF, e.g. from inference.py')
+    parser.add_argument('--output', required=True,
+                        help='Path of the GeoJSON file to write')
+    parser.add_argument('--slide', default=None,
+                        help='Slide the tiles were cut from, for its dimensions (with --slide_output_dir)')
+    parser.add_argument('--slide_width', type=int, default=None,
+                        help='Width of the tiled level, instead of --slide')
+    parser.add_argument('--slide_height', type=int, default=None,
+                        help='Height of the tiled level, instead of --slide')
+    parser.add_argument('--tile_size', type=int, default=None,
+                        help='Tile size of the output directory (default: from its manifest)')
+    parser.add_argument('--stride', type=int, default=None,
+                        help='Tile stride of the output directory (default: from its manifest)')
+    parser.add_argument('--level', type=int, default=None,
+                        help='Pyramid level that was tiled (default: from the manifest) or, with --mask, '
+                             'the level to trace (default 0)')
+    parser.add_argument('--background_value', type=int, default=None,
+                        help='Background value of the masks (default: from the manifest, else 0)')
+    parser.add_argument('--threshold', type=int, default=None,
+                        help='Foreground where mask >= threshold, e.g. 128 for probability maps')
+    parser.add_argument('--class_name', type=str, default=None,
+                        help='QuPath classification of the polygons, e.g. Vessel (default unclassified)')
+    parser.add_argument('--class_values', type=str, default=None,
+                        help='Label mask values per class, e.g. "Vessel=1,Tumor=2", to trace each class separately')
+    parser.add_argument('--min_area', type=float, default=0,
+                        help='Drop polygons smaller than this many level 0 pixels (default 0)')
+    parser.add_argument('--simplify', type=float, default=0,
+                        help='Simplification tolerance in level 0 pixels (default 0, exact pixel outlines)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_VECTORIZE_WORKERS,
+                        help=f'Tracing threads (default {DEFAULT_VECTORIZE_WORKERS})')
+
+    args = parser.parse_args()
+
+    options = {'threshold': args.threshold, 'class_name': args.class_name, 'min_area': args.min_area,
+               'simplify': args.simplify, 'workers': args.workers}
+    if args.background_value is not None:
+        options['background_value'] = args.background_value
+    if args.class_values:
+        options['class_names'] = {value: name for name, value
+                                  in parse_class_values(args.class_values).items()}
+
+    start = time.perf_counter()
+    if args.mask:
+        counts = vectorize_mask_image(args.mask, args.output, level=args.level or 0, **options)
+    else:
+        level = args.level
+        if level is None:
+            header = SlideManifest(args.slide_output_dir).header or {}
+            level = header.get('params', {}).get('level', 0)
+        downsample = (1.0, 1.0)
+        if args.slide:
+            with SlideReader(args.slide, level) as reader:
+                slide_width, slide_height = reader.dimensions
+                downsample = reader.downsample
+        elif args.slide_width and args.slide_height:
+            slide_width, slide_height = args.slide_width, args.slide_height
+            if level:
+                print(f"WARNING: coordinates are in pixels of level {level}; pass --slide to scale them to level 0")
+        else:
+            parser.error('--slide_output_dir needs --slide or --slide_width and --slide_height')
+        try:
+            counts = vectorize_slide_output(args.slide_output_dir, args.output, slide_width, slide_height,
+                                            tile_size=args.tile_size, stride=args.stride,
+                                            downsample=downsample, **options)
+        except ValueError as e:
+            parser.error(str(e))
+
+    print(f"Wrote {counts['features']} features from {counts['tiles']} tiles to {args.output} "
+          f"in {time.perf_counter() - start:.1f}s")